@@ -0,0 +1,60 @@
+"""
+Минимальные подделки объектов python-telegram-bot для прямого вызова хэндлеров:
+ровно те атрибуты и методы, которыми пользуются src/handlers.
+"""
+from __future__ import annotations
+
+import datetime as dt
+import itertools
+from types import SimpleNamespace
+from typing import Any, List, Optional
+
+_ids = itertools.count(1)
+
+
+class FakeMessage:
+    def __init__(self, chat: "FakeChat", text: str):
+        self.chat = chat
+        self.message_id = next(_ids)
+        self.text = text
+        self.edits = 0
+
+    async def edit_text(self, text: str, **kwargs: Any) -> "FakeMessage":
+        self.text = text
+        self.edits += 1
+        return self
+
+
+class FakeChat:
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+        self.sent: List[FakeMessage] = []
+
+    async def send_message(self, text: str, **kwargs: Any) -> FakeMessage:
+        m = FakeMessage(self, text)
+        self.sent.append(m)
+        return m
+
+
+def fake_user(user_id: int) -> SimpleNamespace:
+    first, last = f"User{user_id}", "Bench"
+    return SimpleNamespace(
+        id=user_id, username=f"user{user_id}", first_name=first, last_name=last,
+        full_name=f"{first} {last}",
+    )
+
+def message_update(chat: FakeChat, msg_id: int, user_id: int, text: str,
+                   date: Optional[dt.datetime] = None) -> SimpleNamespace:
+    """Update с обычным текстовым сообщением (для on_msg)."""
+    msg = SimpleNamespace(
+        chat_id=chat.id, message_id=msg_id, text=text,
+        date=date or dt.datetime.now(dt.timezone.utc), from_user=fake_user(user_id),
+    )
+    return SimpleNamespace(effective_message=msg, effective_chat=chat)
+
+def command_update(chat: FakeChat) -> SimpleNamespace:
+    """Update команды (/t, /b, /stats): хэндлерам нужен только effective_chat."""
+    return SimpleNamespace(effective_chat=chat, effective_message=None)
+
+def command_context(*args: str) -> SimpleNamespace:
+    return SimpleNamespace(args=list(args))
@@ -0,0 +1,69 @@
+"""
+Данные для бенчмарков в отдельной базе ClickHouse: схема — теми же миграциями,
+что и у бота, сообщения и пользователи — пакетными вставками.
+"""
+from __future__ import annotations
+
+import datetime as dt
+import random
+from typing import List
+
+import clickhouse_connect
+
+from src.configs import CLICKHOUSE_HOST, CLICKHOUSE_PORT, CLICKHOUSE_DB, CLICKHOUSE_USER, CLICKHOUSE_PASSWORD
+from src.schemas import Msg
+from src.db.migrations import apply_migrations
+from src.db.messages import insert_messages
+from src.db.users import import_users
+
+_VOCAB = (
+    "релиз сборка тест деплой сервер база кэш запрос индекс очередь логи метрики "
+    "встреча созвон задача баг фикс ревью ветка мерж прод стенд клиент ответ вопрос "
+    "вчера сегодня завтра неделя идея план срок отпуск обед кофе погода"
+).split()
+
+
+def prepare_database(fresh: bool) -> None:
+    """Создаёт базу CLICKHOUSE_DB (fresh — пересоздаёт) и применяет миграции."""
+    if CLICKHOUSE_DB in ("", "default"):
+        raise SystemExit("бенчмарк пишет в базу: задайте отдельную --db, не default")
+    admin = clickhouse_connect.get_client(
+        host=CLICKHOUSE_HOST, port=CLICKHOUSE_PORT,
+        username=CLICKHOUSE_USER, password=CLICKHOUSE_PASSWORD,
+    )
+    if fresh:
+        admin.command(f"DROP DATABASE IF EXISTS {CLICKHOUSE_DB}")
+    admin.command(f"CREATE DATABASE IF NOT EXISTS {CLICKHOUSE_DB}")
+    admin.close()
+    apply_migrations()
+
+
+def random_text(rng: random.Random, words: int = 12) -> str:
+    return " ".join(rng.choice(_VOCAB) for _ in range(rng.randint(3, words)))
+
+
+def seed_messages(chat_id: int, count: int, users: int, start_id: int = 1,
+                  batch: int = 10000, seed: int = 1) -> int:
+    """count сообщений от users авторов, по секунде друг за другом до «сейчас». Возвращает последний id."""
+    rng = random.Random(seed)
+    t0 = dt.datetime.utcnow().replace(microsecond=0) - dt.timedelta(seconds=count)
+    rows: List[Msg] = []
+    msg_id = start_id - 1
+    for i in range(count):
+        msg_id = start_id + i
+        rows.append(Msg(
+            chat_id=chat_id, tg_msg_id=msg_id, user_id=1 + rng.randrange(users),
+            text=random_text(rng), ts=t0 + dt.timedelta(seconds=i),
+        ))
+        if len(rows) >= batch:
+            insert_messages(rows)
+            rows = []
+    insert_messages(rows)
+    return msg_id
+
+
+def seed_users(count: int, first_id: int = 1) -> None:
+    now = dt.datetime.utcnow().replace(microsecond=0)
+    ids = range(first_id, first_id + count)
+    for lo in range(0, count, 10000):
+        import_users({uid: (f"User{uid} Bench", now, now) for uid in ids[lo:lo + 10000]})
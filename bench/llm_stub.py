@@ -0,0 +1,127 @@
+"""
+Локальный OpenAI-совместимый сервер для бенчмарков: POST /chat/completions
+(обычный ответ и SSE при stream: true) с настраиваемой задержкой и числом токенов.
+Только stdlib; запускается в фоновом потоке процесса бенчмарка или отдельно:
+
+    python -m bench.llm_stub --port 8899 --latency-ms 300 --tokens 200 --token-ms 5
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+
+# Первый шаг /b: какие инструменты «просит» заглушка (два параллельных вызова).
+TOOL_REPLY = (
+    'TOOL: [{"name":"search_messages","args":{"query":"релиз","limit":50}},'
+    ' {"name":"get_summaries","args":{"limit":10}}]'
+)
+WORD = "слово "
+
+
+class StubConfig:
+    __slots__ = ("latency_ms", "tokens", "token_ms", "requests")
+
+    def __init__(self, latency_ms: float = 300, tokens: int = 200, token_ms: float = 5):
+        self.latency_ms = latency_ms  # до первого байта (и до первого токена в потоке)
+        self.tokens = tokens          # completion_tokens в каждом ответе
+        self.token_ms = token_ms      # пауза между токенами в потоке
+        self.requests = 0
+
+
+def _reply_text(messages: List[Dict[str, Any]], tokens: int) -> str:
+    system = messages[0].get("content", "") if messages else ""
+    first_rag_step = "TOOL:" in system and not any(m.get("role") == "assistant" for m in messages)
+    return TOOL_REPLY if first_rag_step else WORD * tokens
+
+
+def _usage(body: bytes, completion: int) -> Dict[str, int]:
+    prompt = len(body) // 4
+    return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+
+def make_handler(cfg: StubConfig):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+        def do_POST(self) -> None:
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            req = json.loads(body or b"{}")
+            cfg.requests += 1
+            text = _reply_text(req.get("messages") or [], cfg.tokens)
+            usage = _usage(body, cfg.tokens)
+            time.sleep(cfg.latency_ms / 1000)
+            if req.get("stream"):
+                self._stream(text, usage)
+            else:
+                self._json({
+                    "id": "stub", "object": "chat.completion", "model": req.get("model"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                                 "finish_reason": "stop"}],
+                    "usage": usage,
+                })
+
+        def _json(self, data: Dict[str, Any]) -> None:
+            raw = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def _chunk(self, data: bytes) -> None:
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def _event(self, data: Any) -> None:
+            payload = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)
+            self._chunk(f"data: {payload}\n\n".encode("utf-8"))
+
+        def _stream(self, text: str, usage: Dict[str, int]) -> None:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            # TOOL-ответ отдаётся одним куском, текст — по «токену» (слову).
+            pieces = [text] if text.startswith("TOOL:") else [WORD] * text.count(WORD)
+            for i, piece in enumerate(pieces):
+                if i and cfg.token_ms:
+                    time.sleep(cfg.token_ms / 1000)
+                self._event({"choices": [{"index": 0, "delta": {"content": piece}}]})
+            self._event({"choices": [], "usage": usage})
+            self._event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+
+    return Handler
+
+
+def start_stub(cfg: StubConfig, host: str = "127.0.0.1", port: int = 0) -> Tuple[ThreadingHTTPServer, str]:
+    """Запускает сервер в фоновом потоке; возвращает (server, base_url) для OPENAI_BASE_URL."""
+    server = ThreadingHTTPServer((host, port), make_handler(cfg))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="llm-stub", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="OpenAI-совместимая заглушка для бенчмарков")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8899)
+    ap.add_argument("--latency-ms", type=float, default=300)
+    ap.add_argument("--tokens", type=int, default=200)
+    ap.add_argument("--token-ms", type=float, default=5)
+    args = ap.parse_args()
+    cfg = StubConfig(args.latency_ms, args.tokens, args.token_ms)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(cfg))
+    print(f"http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Микробенчмарк построения строк сообщений без БД: сколько стоит одна строка
+выборки (tg_msg_id, user_id, text, ts) до и после перехода на MsgRow.
+
+    python -m bench.rows --rows 100000 --reps 5
+
+«before» — прежний путь: pydantic Msg на строку, затем отдельный проход с
+присвоением author и запись окна из атрибутов модели. «after» — MsgRow с автором
+в одном проходе и запись окна из MsgRow (как messages._window_record). Результат — JSON в stdout.
+"""
+from __future__ import annotations
+
+import argparse
+import datetime as dt
+import gc
+import json
+import random
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+from src.schemas import Msg, MsgRow
+
+# Без bench.fixtures: тот тянет clickhouse_connect и src.db, а здесь БД не нужна.
+_WORDS = "релиз сборка тест деплой сервер база кэш запрос индекс очередь логи метрики".split()
+
+
+def _rows(count: int, users: int) -> List[tuple]:
+    rng = random.Random(11)
+    t0 = dt.datetime(2024, 1, 1)
+    return [
+        (i, 1 + rng.randrange(users), " ".join(rng.choices(_WORDS, k=rng.randint(3, 12))),
+         t0 + dt.timedelta(seconds=i))
+        for i in range(1, count + 1)
+    ]
+
+
+def _before_msgs(chat_id: int, rows: List[tuple], names: Dict[int, str]) -> list:
+    msgs = [Msg(chat_id=chat_id, tg_msg_id=r[0], user_id=r[1], text=r[2], ts=r[3]) for r in rows]
+    for m in msgs:
+        m.author = names.get(m.user_id, str(m.user_id))
+    return msgs
+
+def _after_msgs(chat_id: int, rows: List[tuple], names: Dict[int, str]) -> list:
+    return [
+        MsgRow(chat_id, msg_id, user_id, text, ts, names.get(user_id) or str(user_id))
+        for msg_id, user_id, text, ts in rows
+    ]
+
+def _before_window(chat_id: int, rows: List[tuple], names: Dict[int, str]) -> list:
+    return [
+        {"tg_msg_id": m.tg_msg_id, "user_id": m.user_id, "author": m.author,
+         "text": m.text, "ts": m.ts.isoformat() + "Z"}
+        for m in _before_msgs(chat_id, rows, names)
+    ]
+
+def _after_window(chat_id: int, rows: List[tuple], names: Dict[int, str]) -> list:
+    return [
+        {"tg_msg_id": m.tg_msg_id, "user_id": m.user_id, "author": m.author,
+         "text": m.text, "ts": m.ts.isoformat() + "Z"}
+        for m in _after_msgs(chat_id, rows, names)
+    ]
+
+
+def _measure(fn: Callable[..., list], rows: List[tuple], names: Dict[int, str], reps: int) -> Dict[str, Any]:
+    best = float("inf")
+    for _ in range(reps):
+        gc.collect()
+        t0 = time.perf_counter()
+        out = fn(-1, rows, names)
+        best = min(best, time.perf_counter() - t0)
+        del out
+    return {"best_ms": round(best * 1000, 3), "ns_per_row": round(best * 1e9 / len(rows), 1)}
+
+def _size(obj: Any) -> int:
+    """Память одной строки: сам объект плюс __dict__ у моделей."""
+    size = sys.getsizeof(obj)
+    d = getattr(obj, "__dict__", None)
+    if d is not None:
+        size += sys.getsizeof(d)
+    return size
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Стоимость строки сообщения: pydantic Msg против MsgRow")
+    ap.add_argument("--rows", type=int, default=100000)
+    ap.add_argument("--users", type=int, default=50)
+    ap.add_argument("--reps", type=int, default=5)
+    args = ap.parse_args()
+
+    rows = _rows(args.rows, args.users)
+    names = {uid: f"User{uid} Bench" for uid in range(1, args.users + 1)}
+    results: Dict[str, Any] = {}
+    for path, before, after in (("batch", _before_msgs, _after_msgs), ("window", _before_window, _after_window)):
+        b = _measure(before, rows, names, args.reps)
+        a = _measure(after, rows, names, args.reps)
+        results[path] = {"before": b, "after": a, "speedup": round(b["best_ms"] / a["best_ms"], 2)}
+    results["bytes_per_row"] = {
+        "before": _size(_before_msgs(-1, rows[:1], names)[0]),
+        "after": _size(_after_msgs(-1, rows[:1], names)[0]),
+    }
+    print(json.dumps({"args": vars(args), "results": results}, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
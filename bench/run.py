@@ -0,0 +1,175 @@
+"""
+Офлайн-бенчмарк: локальный ClickHouse (отдельная база) + заглушка OpenAI-совместимого API.
+
+    python -m bench.run --db tg_bench --out bench.json
+    python -m bench.run --only t,b --t-ns 100,1000,10000 --llm-latency-ms 50
+    python -m bench.run --only updates --updates-messages 5000 --updates-rate 1000
+
+Результат — JSON (в --out или stdout): параметры прогона и замеры по сценариям,
+чтобы сравнивать прогоны между собой. Боевой .env не читается (SKIP_DOTENV=1).
+Проверка самих заглушек без ClickHouse — python -m bench.smoke.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import datetime as dt
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Dict
+
+from .llm_stub import StubConfig, start_stub
+from .telegram_fake import FakeTelegram, start_fake_telegram
+
+SCENARIOS = ("ingest", "summarizer", "t", "b", "users", "updates")
+
+
+def _args() -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="Бенчмарк tg-chat-logger")
+    ap.add_argument("--db", default="tg_bench", help="база ClickHouse для прогона (пересоздаётся)")
+    ap.add_argument("--ch-host", default="localhost")
+    ap.add_argument("--ch-port", type=int, default=8123)
+    ap.add_argument("--keep-db", action="store_true", help="не пересоздавать базу перед прогоном")
+    ap.add_argument("--only", default=",".join(SCENARIOS), help="сценарии через запятую: " + ",".join(SCENARIOS))
+    ap.add_argument("--out", default="", help="файл для JSON (по умолчанию stdout)")
+
+    ap.add_argument("--llm-latency-ms", type=float, default=300)
+    ap.add_argument("--llm-tokens", type=int, default=200)
+    ap.add_argument("--llm-token-ms", type=float, default=5)
+
+    ap.add_argument("--ingest-messages", type=int, default=5000)
+    ap.add_argument("--backlog-messages", type=int, default=20000)
+    ap.add_argument("--users", type=int, default=50, help="авторов в сгенерированных чатах")
+    ap.add_argument("--t-ns", default="100,1000,10000")
+    ap.add_argument("--reps", type=int, default=5)
+    ap.add_argument("--name-users", type=int, default=100000)
+    ap.add_argument("--name-lookup", type=int, default=5000)
+    ap.add_argument("--updates-modes", default="polling,webhook")
+    ap.add_argument("--updates-messages", type=int, default=5000)
+    ap.add_argument("--updates-rate", type=float, default=0, help="апдейтов в секунду, 0 — без пауз")
+    ap.add_argument("--updates-concurrency", type=int, default=40, help="одновременных POST'ов в режиме webhook")
+    return ap.parse_args()
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _configure_env(args: argparse.Namespace, llm_url: str, telegram_url: str) -> None:
+    """До импорта src: configs читает окружение один раз при импорте."""
+    os.environ.update({
+        "SKIP_DOTENV": "1",
+        "CLICKHOUSE_HOST": args.ch_host,
+        "CLICKHOUSE_PORT": str(args.ch_port),
+        "CLICKHOUSE_DB": args.db,
+        "LLM_PROVIDER": "openai",
+        "OPENAI_BASE_URL": llm_url,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_MODEL": "stub",
+        "LLM_HTTP2": "0",
+        "BOT_TOKEN": "1:bench",
+        "TELEGRAM_API_URL": telegram_url,
+        "WEBHOOK_LISTEN": "127.0.0.1",
+        "WEBHOOK_PORT": str(_free_port()),
+        "WEBHOOK_URL": "",
+    })
+
+
+def _git_rev() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return ""
+
+
+async def _run(args: argparse.Namespace, only: set, telegram: FakeTelegram) -> Dict[str, Any]:
+    from src.llm import start_llm_client, close_llm_client
+    from src.db.logger import flush_all_logs
+    from . import scenarios as sc
+
+    ingest_chat, backlog_chat, updates_chat = -1001, -1002, -1003
+    results: Dict[str, Any] = {}
+    await start_llm_client()
+    try:
+        if "ingest" in only:
+            results["ingest"] = await sc.ingest(ingest_chat, args.ingest_messages, args.users)
+        # /t и /b меряются на чате, прошедшем догонку: дерево выжимок уже построено.
+        if only & {"summarizer", "t", "b"}:
+            results["summarizer"] = await sc.summarizer_backlog(backlog_chat, args.backlog_messages, args.users)
+        if "t" in only:
+            ns = [int(x) for x in args.t_ns.split(",") if x]
+            results["t"] = await sc.t_latency(backlog_chat, ns, args.reps)
+        if "b" in only:
+            results["b"] = await sc.b_latency(backlog_chat, args.reps)
+        if "users" in only:
+            results["users"] = await sc.display_names(args.name_users, args.name_lookup)
+        if "updates" in only:
+            # Каждый режим — в свой чат, чтобы message_id не повторялись.
+            results["updates"] = {
+                mode: await sc.updates(telegram, mode, updates_chat - i, args.updates_messages, args.users,
+                                       args.updates_rate, args.updates_concurrency)
+                for i, mode in enumerate(m.strip() for m in args.updates_modes.split(",") if m.strip())
+            }
+    finally:
+        await close_llm_client()
+        flush_all_logs()
+    return results
+
+
+def main() -> int:
+    args = _args()
+    only = {s.strip() for s in args.only.split(",") if s.strip()}
+    unknown = only - set(SCENARIOS)
+    if unknown:
+        print(f"неизвестные сценарии: {', '.join(sorted(unknown))}", file=sys.stderr)
+        return 2
+
+    stub = StubConfig(args.llm_latency_ms, args.llm_tokens, args.llm_token_ms)
+    server, llm_url = start_stub(stub)
+    telegram = FakeTelegram()
+    tg_server, telegram_url = start_fake_telegram(telegram)
+    _configure_env(args, llm_url, telegram_url)
+
+    from src.db import shutdown_db
+    from .fixtures import prepare_database
+
+    started = dt.datetime.now(dt.timezone.utc)
+    t0 = time.perf_counter()
+    prepare_database(fresh=not args.keep_db)
+    try:
+        results = asyncio.run(_run(args, only, telegram))
+    finally:
+        shutdown_db()
+        server.shutdown()
+        tg_server.shutdown()
+
+    report = {
+        "meta": {
+            "started_at": started.isoformat(),
+            "elapsed_s": round(time.perf_counter() - t0, 3),
+            "git_rev": _git_rev(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+            "llm_requests": stub.requests,
+        },
+        "results": results,
+    }
+    raw = json.dumps(report, ensure_ascii=False, indent=2, default=str)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(raw + "\n")
+    else:
+        print(raw)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+"""
+Сценарии бенчмарка. Каждый — корутина, возвращающая JSON-совместимый dict с замерами.
+Хэндлеры вызываются напрямую с поддельными Update (bench/fakes.py), LLM — локальная заглушка.
+"""
+from __future__ import annotations
+
+import asyncio
+import random
+import time
+from typing import Any, Callable, Dict, List, Sequence
+
+from telegram import Update
+from telegram.ext import TypeHandler, filters
+
+from src.db import run_db
+from src.db import users as users_db
+from src.db.ingest import flush_messages_async, ingest_stats
+from src.db.users import load_display_names
+from src.handlers.messages import on_msg
+from src.handlers import register_handlers
+from src.handlers.commands import cmd_t, cmd_b
+from src.updates import build_application, start_updates, stop_updates
+from src.t_cache import t_cache
+from src.workers import ChatSummarizer
+from src.configs import N
+
+from .fakes import FakeChat, message_update, command_update, command_context
+from .fixtures import seed_messages, seed_users, random_text
+from .telegram_fake import FakeTelegram, deliver, delivery_ms, make_updates
+
+
+def percentiles(samples_ms: Sequence[float]) -> Dict[str, float]:
+    if not samples_ms:
+        return {}
+    xs = sorted(samples_ms)
+    pick = lambda q: xs[min(len(xs) - 1, int(q * len(xs)))]
+    return {
+        "n": len(xs),
+        "min_ms": round(xs[0], 3),
+        "p50_ms": round(pick(0.50), 3),
+        "p95_ms": round(pick(0.95), 3),
+        "p99_ms": round(pick(0.99), 3),
+        "max_ms": round(xs[-1], 3),
+        "mean_ms": round(sum(xs) / len(xs), 3),
+    }
+
+async def _timed(fn: Callable[[], Any]) -> float:
+    t0 = time.perf_counter()
+    await fn()
+    return (time.perf_counter() - t0) * 1000
+
+
+async def ingest(chat_id: int, messages: int, users: int) -> Dict[str, Any]:
+    """Поток сообщений через on_msg (upsert_user + буфер), затем сброс хвоста буфера."""
+    chat = FakeChat(chat_id)
+    rng = random.Random(7)
+    samples: List[float] = []
+    t0 = time.perf_counter()
+    for i in range(1, messages + 1):
+        update = message_update(chat, i, 1 + rng.randrange(users), random_text(rng))
+        samples.append(await _timed(lambda: on_msg(update, None)))
+    await flush_messages_async()
+    elapsed = time.perf_counter() - t0
+    return {
+        "messages": messages,
+        "elapsed_s": round(elapsed, 3),
+        "messages_per_s": round(messages / elapsed, 1),
+        "on_msg": percentiles(samples),
+        "ingest": ingest_stats(),
+    }
+
+
+async def summarizer_backlog(chat_id: int, messages: int, users: int) -> Dict[str, Any]:
+    """Бэклог из messages сообщений: сколько батчей в секунду переваривает догонка (с заглушкой LLM)."""
+    seed_t0 = time.perf_counter()
+    await run_db(seed_messages, chat_id, messages, users)
+    seed_s = time.perf_counter() - seed_t0
+
+    t0 = time.perf_counter()
+    await ChatSummarizer(chat_id).backfill()
+    elapsed = time.perf_counter() - t0
+    batches = messages // N
+    return {
+        "messages": messages,
+        "seed_s": round(seed_s, 3),
+        "seed_rows_per_s": round(messages / seed_s, 1),
+        "batches": batches,
+        "elapsed_s": round(elapsed, 3),
+        "batches_per_s": round(batches / elapsed, 2),
+        "messages_per_s": round(batches * N / elapsed, 1),
+    }
+
+
+async def t_latency(chat_id: int, ns: Sequence[int], reps: int) -> Dict[str, Any]:
+    """/t n на уже суммаризированном чате: холодный путь (кэш /t сброшен) и повтор из кэша."""
+    chat = FakeChat(chat_id)
+    out: Dict[str, Any] = {}
+    for n in ns:
+        cold: List[float] = []
+        for _ in range(reps):
+            t_cache._entries.clear()
+            cold.append(await _timed(lambda: cmd_t(command_update(chat), command_context(str(n)))))
+        warm = [await _timed(lambda: cmd_t(command_update(chat), command_context(str(n))))
+                for _ in range(reps)]
+        out[str(n)] = {"cold": percentiles(cold), "cached": percentiles(warm)}
+    return out
+
+
+async def b_latency(chat_id: int, reps: int) -> Dict[str, Any]:
+    """/b целиком: первый шаг (заглушка просит два инструмента), инструменты, второй шаг."""
+    chat = FakeChat(chat_id)
+    samples = [
+        await _timed(lambda: cmd_b(command_update(chat), command_context("что", "решили", "про", "релиз?")))
+        for _ in range(reps)
+    ]
+    return {"end_to_end": percentiles(samples)}
+
+
+async def display_names(users: int, lookup: int) -> Dict[str, Any]:
+    """load_display_names по lookup случайным id из users: холодный LRU и тёплый."""
+    seed_t0 = time.perf_counter()
+    await run_db(seed_users, users)
+    seed_s = time.perf_counter() - seed_t0
+
+    ids = random.Random(3).sample(range(1, users + 1), min(lookup, users))
+    with users_db._lock:
+        users_db._cache.clear()
+    cold = await _timed(lambda: run_db(load_display_names, ids))
+    warm = await _timed(lambda: run_db(load_display_names, ids))
+    return {
+        "users": users,
+        "lookup": len(ids),
+        "seed_s": round(seed_s, 3),
+        "cold_ms": round(cold, 3),
+        "warm_ms": round(warm, 3),
+        "cold_us_per_id": round(cold * 1000 / len(ids), 3),
+        "warm_us_per_id": round(warm * 1000 / len(ids), 3),
+    }
+
+
+async def updates(fake: FakeTelegram, mode: str, chat_id: int, messages: int, users: int,
+                  rate: float, concurrency: int, timeout_s: float = 300) -> Dict[str, Any]:
+    """
+    Приём апдейтов настоящим Application (register_handlers как в main.py) через подделку
+    Telegram в режиме mode. Задержка приёма — от отправки апдейта до конца его обработки:
+    замыкающий TypeHandler в последней группе срабатывает после on_msg.
+    """
+    fake.reset()
+    app = build_application()
+    register_handlers(app, filters.Chat(chat_id=[chat_id]))
+    handled: Dict[int, float] = {}
+    all_handled = asyncio.Event()
+
+    async def probe(update: Update, ctx: Any) -> None:
+        handled[update.update_id] = time.perf_counter()
+        if len(handled) >= messages:
+            all_handled.set()
+
+    app.add_handler(TypeHandler(Update, probe), group=1000)
+
+    await app.initialize()
+    await app.start()
+    try:
+        await start_updates(app, mode)
+        t0 = time.perf_counter()
+        sent, post_ms = await deliver(fake, mode, make_updates(chat_id, messages, users), rate, concurrency)
+        try:
+            await asyncio.wait_for(all_handled.wait(), timeout_s)
+        except asyncio.TimeoutError:
+            pass
+        elapsed = time.perf_counter() - t0
+    finally:
+        await stop_updates(app)
+        await app.stop()
+        await app.shutdown()
+    await flush_messages_async()
+
+    latency = [(handled[u] - t) * 1000 for u, t in sent.items() if u in handled]
+    return {
+        "mode": mode,
+        "messages": messages,
+        "rate": rate,
+        "elapsed_s": round(elapsed, 3),
+        "handled_per_s": round(len(handled) / elapsed, 1),
+        "lost": messages - len(latency),
+        "ingest": percentiles(latency),
+        "delivery": percentiles(delivery_ms(fake, mode, sent, post_ms)),
+        "api_calls": dict(fake.calls),
+    }
@@ -0,0 +1,119 @@
+"""
+Дымовой прогон стенда без ClickHouse: настоящий клиент LLM (src.llm) против заглушки
+и настоящий Application (src.updates) против подделки Telegram в обоих режимах приёма.
+Замеров не делает — проверяет, что заглушки не разошлись с кодом бота (его гоняет
+tests/test_bench_smoke.py).
+
+    python -m bench.smoke
+
+Печатает JSON с итогами сценариев; код возврата 1, если какой-то сценарий не сошёлся.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from typing import Any, Dict
+
+from .llm_stub import TOOL_REPLY, WORD, StubConfig, start_stub
+from .run import _configure_env
+from .telegram_fake import FakeTelegram, deliver, make_updates, start_fake_telegram
+
+TOKENS = 20
+MESSAGES = 50
+TIMEOUT_S = 30
+
+
+async def llm(stub: StubConfig) -> Dict[str, Any]:
+    """Поток chat_stream и обычный _chat_complete с первым шагом /b (заглушка просит инструменты)."""
+    from src.llm import _chat_complete, chat_stream, parse_tool_calls
+
+    parts = [d async for d in chat_stream([{"role": "user", "content": "привет"}], purpose="smoke")]
+    text, _, tokens_out = await _chat_complete(
+        [{"role": "system", "content": "TOOL: ..."}, {"role": "user", "content": "что решили?"}],
+        purpose="smoke",
+    )
+    calls = parse_tool_calls(text)
+    return {
+        "ok": "".join(parts) == WORD * TOKENS and text == TOOL_REPLY and len(calls) == 2,
+        "stream_parts": len(parts),
+        "tokens_out": tokens_out,
+        "tool_calls": [c.get("name") for c in calls],
+        "llm_requests": stub.requests,
+    }
+
+
+async def updates(fake: FakeTelegram, mode: str, chat_id: int) -> Dict[str, Any]:
+    """Приём MESSAGES апдейтов в режиме mode: дошли ли все до хэндлера (без on_msg — ему нужна база)."""
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    from src.updates import build_application, start_updates, stop_updates
+
+    fake.reset()
+    app = build_application()
+    handled = set()
+    all_handled = asyncio.Event()
+
+    async def probe(update: Update, ctx: Any) -> None:
+        handled.add(update.update_id)
+        if len(handled) >= MESSAGES:
+            all_handled.set()
+
+    app.add_handler(TypeHandler(Update, probe))
+
+    await app.initialize()
+    await app.start()
+    try:
+        await start_updates(app, mode)
+        sent, _ = await deliver(fake, mode, make_updates(chat_id, MESSAGES, users=5))
+        try:
+            await asyncio.wait_for(all_handled.wait(), TIMEOUT_S)
+        except asyncio.TimeoutError:
+            pass
+    finally:
+        await stop_updates(app)
+        await app.stop()
+        await app.shutdown()
+    lost = len(set(sent) - handled)
+    return {"ok": lost == 0, "mode": mode, "messages": MESSAGES, "lost": lost, "api_calls": dict(fake.calls)}
+
+
+async def _run(stub: StubConfig, telegram: FakeTelegram) -> Dict[str, Any]:
+    from src.llm import start_llm_client, close_llm_client
+
+    await start_llm_client()
+    try:
+        results: Dict[str, Any] = {"llm": await llm(stub)}
+    finally:
+        await close_llm_client()
+    for i, mode in enumerate(("polling", "webhook")):
+        results[f"updates_{mode}"] = await updates(telegram, mode, -1001 - i)
+    return results
+
+
+def main() -> int:
+    stub = StubConfig(latency_ms=0, tokens=TOKENS, token_ms=0)
+    server, llm_url = start_stub(stub)
+    telegram = FakeTelegram()
+    tg_server, telegram_url = start_fake_telegram(telegram)
+    # ClickHouse в этих сценариях не открывается: база указана только для полноты окружения.
+    _configure_env(argparse.Namespace(ch_host="localhost", ch_port=8123, db="tg_smoke"), llm_url, telegram_url)
+
+    t0 = time.perf_counter()
+    try:
+        results = asyncio.run(_run(stub, telegram))
+    finally:
+        server.shutdown()
+        tg_server.shutdown()
+
+    failed = sorted(name for name, r in results.items() if not r["ok"])
+    print(json.dumps({"elapsed_s": round(time.perf_counter() - t0, 3), "failed": failed, "results": results},
+                     ensure_ascii=False, indent=2))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
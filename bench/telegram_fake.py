@@ -0,0 +1,279 @@
+"""
+Подделка Telegram для нагрузочных прогонов приёма апдейтов: Bot API (getMe,
+setWebhook/deleteWebhook, long polling getUpdates, остальные методы — «ok»)
+и отправитель апдейтов с сообщениями. В режиме webhook апдейты уходят POST'ом
+на адрес из setWebhook (с секретом в заголовке), в режиме polling — в очередь getUpdates.
+
+Бот направляется сюда через TELEGRAM_API_URL. Отдельно от bench.run — против
+запущенного бота (режим определяется тем, что бот вызвал у API):
+
+    python -m bench.telegram_fake --port 8081 --chat-id -1001 --updates 5000 --rate 500
+    TELEGRAM_API_URL=http://127.0.0.1:8081/bot UPDATES_MODE=webhook python main.py
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+from collections import Counter, deque
+from itertools import islice
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+import httpx
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+_WORDS = "релиз сборка тест деплой сервер база кэш запрос индекс очередь логи метрики".split()
+
+
+class FakeTelegram:
+    """Состояние подделки: зарегистрированный webhook, очередь getUpdates, счётчики вызовов."""
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self.calls: Counter = Counter()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._cond:
+            self.queue: Deque[dict] = deque()
+            self.fetched: Dict[int, float] = {}  # update_id -> perf_counter выдачи через getUpdates
+            self.webhook_url: Optional[str] = None
+            self.secret: Optional[str] = None
+            self.calls.clear()
+
+    def push(self, update: dict) -> None:
+        with self._cond:
+            self.queue.append(update)
+            self._cond.notify_all()
+
+    def get_updates(self, offset: int, limit: int, timeout: float) -> List[dict]:
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                while self.queue and self.queue[0]["update_id"] < offset:
+                    self.queue.popleft()  # подтверждены смещением
+                if self.queue:
+                    out = list(islice(self.queue, limit))
+                    now = time.perf_counter()
+                    for u in out:
+                        self.fetched.setdefault(u["update_id"], now)
+                    return out
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return []
+                self._cond.wait(left)
+
+    def call(self, method: str, params: Dict[str, Any]) -> Any:
+        self.calls[method] += 1
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "getUpdates":
+            return self.get_updates(int(params.get("offset") or 0), int(params.get("limit") or 100),
+                                    float(params.get("timeout") or 0))
+        if method == "setWebhook":
+            with self._cond:
+                self.webhook_url = params.get("url")
+                self.secret = params.get("secret_token")
+                self._cond.notify_all()
+            return True
+        if method == "deleteWebhook":
+            with self._cond:
+                self.webhook_url = self.secret = None
+            return True
+        if method == "sendMessage":
+            return {"message_id": random.randrange(1, 1 << 30), "date": int(time.time()),
+                    "chat": {"id": int(params.get("chat_id") or 0), "type": "supergroup"},
+                    "text": params.get("text", "")}
+        return True
+
+    def wait_mode(self, timeout: float) -> Optional[str]:
+        """Ждёт, пока бот выберет транспорт: setWebhook — «webhook», getUpdates — «polling»."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while time.monotonic() < deadline:
+                if self.webhook_url:
+                    return "webhook"
+                if self.calls["getUpdates"]:
+                    return "polling"
+                self._cond.wait(0.05)
+        return None
+
+
+def _params(content_type: str, body: bytes) -> Dict[str, Any]:
+    """PTB шлёт параметры формой со значениями в JSON; на всякий случай понимаем и JSON-тело."""
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    out: Dict[str, Any] = {}
+    for key, values in parse_qs(body.decode("utf-8")).items():
+        try:
+            out[key] = json.loads(values[-1])
+        except ValueError:
+            out[key] = values[-1]
+    return out
+
+
+def make_handler(fake: FakeTelegram):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+        def do_POST(self) -> None:
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            # /bot<token>/<method>
+            method = self.path.rstrip("/").rsplit("/", 1)[-1].split("?")[0]
+            result = fake.call(method, _params(self.headers.get("Content-Type", ""), body))
+            raw = json.dumps({"ok": True, "result": result}, ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        do_GET = do_POST
+
+    return Handler
+
+
+def start_fake_telegram(fake: FakeTelegram, host: str = "127.0.0.1",
+                        port: int = 0) -> Tuple[ThreadingHTTPServer, str]:
+    """Запускает Bot API в фоновом потоке; возвращает (server, url) для TELEGRAM_API_URL."""
+    server = ThreadingHTTPServer((host, port), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="tg-fake", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/bot"
+
+
+def message_update(update_id: int, chat_id: int, msg_id: int, user_id: int, text: str) -> dict:
+    """JSON апдейта с текстовым сообщением — как его присылает Telegram."""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": msg_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "Bench"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}",
+                     "last_name": "Bench", "username": f"user{user_id}"},
+            "text": text,
+        },
+    }
+
+def make_updates(chat_id: int, count: int, users: int, first_id: int = 1, seed: int = 5) -> List[dict]:
+    rng = random.Random(seed)
+    return [
+        message_update(first_id + i, chat_id, first_id + i, 1 + rng.randrange(users),
+                       " ".join(rng.choices(_WORDS, k=rng.randint(3, 12))))
+        for i in range(count)
+    ]
+
+
+async def deliver(fake: FakeTelegram, mode: str, updates: List[dict], rate: float = 0,
+                  concurrency: int = 40) -> Tuple[Dict[int, float], List[float]]:
+    """
+    Отправляет апдейты с темпом rate в секунду (0 — без пауз). webhook — POST'ы на
+    зарегистрированный адрес, не больше concurrency одновременно (как max_connections
+    у Telegram); polling — в очередь getUpdates.
+    Возвращает (update_id -> perf_counter отправки, длительности POST'ов в мс).
+    """
+    sent: Dict[int, float] = {}
+    post_ms: List[float] = []
+    t0 = time.perf_counter()
+
+    async def pace(i: int) -> None:
+        if rate > 0:
+            delay = t0 + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    if mode == "polling":
+        for i, u in enumerate(updates):
+            await pace(i)
+            sent[u["update_id"]] = time.perf_counter()
+            fake.push(u)
+        return sent, post_ms
+
+    if not fake.webhook_url:
+        raise RuntimeError("бот не вызвал setWebhook")
+    headers = {SECRET_HEADER: fake.secret} if fake.secret else {}
+    sem = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        async def post(u: dict) -> None:
+            try:
+                started = sent[u["update_id"]] = time.perf_counter()
+                r = await client.post(fake.webhook_url, json=u, headers=headers)
+                r.raise_for_status()
+                post_ms.append((time.perf_counter() - started) * 1000)
+            finally:
+                sem.release()
+
+        tasks = []
+        for i, u in enumerate(updates):
+            await pace(i)
+            await sem.acquire()
+            tasks.append(asyncio.create_task(post(u)))
+        await asyncio.gather(*tasks)
+    return sent, post_ms
+
+
+def delivery_ms(fake: FakeTelegram, mode: str, sent: Dict[int, float], post_ms: List[float]) -> List[float]:
+    """Задержка доставки до бота: POST (webhook) или от постановки в очередь до выдачи getUpdates."""
+    if mode == "webhook":
+        return post_ms
+    return [(fake.fetched[u] - t) * 1000 for u, t in sent.items() if u in fake.fetched]
+
+
+async def _drive(fake: FakeTelegram, args: argparse.Namespace) -> Dict[str, Any]:
+    from .scenarios import percentiles
+
+    mode = await asyncio.to_thread(fake.wait_mode, args.wait_s)
+    if mode is None:
+        raise SystemExit("бот не обратился к API: проверьте TELEGRAM_API_URL")
+    updates = make_updates(args.chat_id, args.updates, args.users, first_id=args.first_id)
+    t0 = time.perf_counter()
+    sent, post_ms = await deliver(fake, mode, updates, args.rate, args.concurrency)
+    while mode == "polling" and len(fake.fetched) < len(sent) and time.perf_counter() - t0 < args.wait_s:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - t0
+    return {
+        "mode": mode,
+        "updates": len(updates),
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(len(updates) / elapsed, 1),
+        "delivery": percentiles(delivery_ms(fake, mode, sent, post_ms)),
+        "api_calls": dict(fake.calls),
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Подделка Telegram: Bot API и отправитель апдейтов")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--chat-id", type=int, required=True, help="чат из ALLOWED_CHAT_IDS бота")
+    ap.add_argument("--updates", type=int, default=5000)
+    ap.add_argument("--users", type=int, default=50)
+    ap.add_argument("--first-id", type=int, default=1, help="первый update_id и message_id")
+    ap.add_argument("--rate", type=float, default=0, help="апдейтов в секунду, 0 — без пауз")
+    ap.add_argument("--concurrency", type=int, default=40)
+    ap.add_argument("--wait-s", type=float, default=60, help="сколько ждать подключения бота")
+    args = ap.parse_args()
+
+    fake = FakeTelegram()
+    server, url = start_fake_telegram(fake, args.host, args.port)
+    print(f"TELEGRAM_API_URL={url}", flush=True)
+    try:
+        print(json.dumps(asyncio.run(_drive(fake, args)), ensure_ascii=False, indent=2))
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""
+Импорт истории из экспорта Telegram Desktop (result.json) в tg_messages/tg_users.
+
+    python import_history.py result.json [--chat-id -100123...] [--batch-size 5000] [--no-summarize]
+
+Файл читается потоково (ijson): память не зависит от размера экспорта.
+Прогресс сохраняется в чекпоинт после каждой записанной пачки — прерванный импорт
+продолжается с места остановки. Сообщения, которые уже есть в tg_messages (бот их
+записал сам или пачка успела записаться до сбоя), пропускаются. После импорта
+строятся выжимки импортированного диапазона и догоняется бэклог чата.
+"""
+import argparse
+import asyncio
+import datetime as dt
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import ijson
+
+from src.schemas import Msg
+from src.db import shutdown_db
+from src.db.migrations import apply_migrations
+from src.db.messages import insert_messages, existing_msg_ids, get_max_msg_id_upto
+from src.db.users import import_users
+from src.db.logger import log_event, flush_all_logs
+from src.db.aio import get_last_summarized_msg_id
+from src.llm import start_llm_client, close_llm_client
+from src.workers import ChatSummarizer
+
+_SUPERGROUP_TYPES = {"public_supergroup", "private_supergroup", "public_channel", "private_channel"}
+
+
+def _read_header(path: str) -> Tuple[Optional[int], str]:
+    """(id, type) чата из начала экспорта — парсер останавливается на первых ключах."""
+    chat_id, kind = None, ""
+    with open(path, "rb") as f:
+        for prefix, event, value in ijson.parse(f):
+            if prefix == "id" and event == "number":
+                chat_id = int(value)
+            elif prefix == "type" and event == "string":
+                kind = value
+            elif prefix == "messages":
+                break
+    return chat_id, kind
+
+def _bot_chat_id(export_id: int, kind: str) -> int:
+    """В экспорте id без префикса; Bot API видит супергруппы/каналы как -100<id>, группы — как -<id>."""
+    if kind in _SUPERGROUP_TYPES:
+        return int(f"-100{export_id}")
+    if kind == "private_group":
+        return -export_id
+    return export_id
+
+def _sender_id(from_id: str) -> Optional[int]:
+    """'user123' → 123, 'channel123' → -100123 (как в Bot API)."""
+    if not from_id:
+        return None
+    for prefix, fmt in (("user", "{}"), ("channel", "-100{}"), ("chat", "-{}")):
+        if from_id.startswith(prefix) and from_id[len(prefix):].isdigit():
+            return int(fmt.format(from_id[len(prefix):]))
+    return None
+
+def _flatten_text(text: Any) -> str:
+    """text в экспорте — строка или список из строк и сущностей {"type", "text"}."""
+    if isinstance(text, str):
+        return text
+    if isinstance(text, list):
+        return "".join(p if isinstance(p, str) else str(p.get("text", "")) for p in text)
+    return ""
+
+def _ts(rec: Dict[str, Any]) -> dt.datetime:
+    if rec.get("date_unixtime"):
+        return dt.datetime.fromtimestamp(int(rec["date_unixtime"]), dt.timezone.utc).replace(tzinfo=None)
+    return dt.datetime.fromisoformat(rec["date"])
+
+def iter_messages(path: str, chat_id: int, after_id: int) -> Iterator[Msg]:
+    """Текстовые сообщения экспорта с id > after_id, по одному — без загрузки файла целиком."""
+    with open(path, "rb") as f:
+        for rec in ijson.items(f, "messages.item", use_float=True):
+            if rec.get("type") != "message" or int(rec.get("id", 0)) <= after_id:
+                continue
+            text = _flatten_text(rec.get("text"))
+            user_id = _sender_id(rec.get("from_id") or "")
+            if not text or user_id is None:
+                continue
+            yield Msg(
+                chat_id=chat_id,
+                tg_msg_id=int(rec["id"]),
+                user_id=user_id,
+                text=text,
+                ts=_ts(rec),
+                author=rec.get("from") or str(user_id),
+            )
+
+
+def _load_checkpoint(path: str) -> Dict[str, int]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"last_msg_id": 0, "rows": 0, "first_msg_id": 0}
+
+def _save_checkpoint(path: str, state: Dict[str, int]) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def _write_batch(chat_id: int, batch: List[Msg]) -> Tuple[List[Msg], int, int]:
+    """
+    Пишет сообщения пачки, которых ещё нет в tg_messages. Возвращает
+    (записанные, новых пользователей, max(tg_msg_id) в БД до конца пачки — для чекпоинта).
+    """
+    lo, hi = batch[0].tg_msg_id, batch[-1].tg_msg_id
+    known = existing_msg_ids(chat_id, lo, hi)
+    fresh = [m for m in batch if m.tg_msg_id not in known]
+    seen: Dict[int, Tuple[str, dt.datetime, dt.datetime]] = {}
+    for m in fresh:
+        prev = seen.get(m.user_id)
+        seen[m.user_id] = (m.author, prev[1] if prev else m.ts, m.ts)
+    users = import_users(seen)
+    insert_messages(fresh)
+    return fresh, users, get_max_msg_id_upto(chat_id, hi)
+
+def import_export(path: str, chat_id: int, checkpoint: str, batch_size: int) -> Dict[str, Any]:
+    state = _load_checkpoint(checkpoint)
+    if state["last_msg_id"]:
+        print(f"продолжаю после message_id={state['last_msg_id']} (уже {state['rows']} строк)")
+
+    state.setdefault("first_msg_id", 0)
+    t0 = time.perf_counter()
+    rows = users = skipped = 0
+    batch: List[Msg] = []
+
+    def flush() -> None:
+        nonlocal rows, users, skipped
+        fresh, new_users, confirmed = _write_batch(chat_id, batch)
+        users += new_users
+        rows += len(fresh)
+        skipped += len(batch) - len(fresh)
+        if fresh and not state["first_msg_id"]:
+            state["first_msg_id"] = fresh[0].tg_msg_id
+        # Чекпоинт — по тому, что реально лежит в БД, а не по прочитанному из файла.
+        state["last_msg_id"] = max(state["last_msg_id"], confirmed)
+        state["rows"] += len(fresh)
+        _save_checkpoint(checkpoint, state)
+        elapsed = max(time.perf_counter() - t0, 1e-6)
+        print(f"{state['rows']} строк, до message_id={state['last_msg_id']}, "
+              f"пропущено уже записанных: {skipped}, {rows / elapsed:.0f} строк/с", flush=True)
+        batch.clear()
+
+    for m in iter_messages(path, chat_id, state["last_msg_id"]):
+        batch.append(m)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    elapsed = time.perf_counter() - t0
+    report = {
+        "type": "import.done",
+        "chat_id": chat_id,
+        "rows": rows,
+        "skipped_existing": skipped,
+        "new_users": users,
+        "first_msg_id": state["first_msg_id"],
+        "last_msg_id": state["last_msg_id"],
+        "elapsed_s": round(elapsed, 1),
+        "rows_per_s": round(rows / elapsed, 1) if elapsed > 0 else None,
+    }
+    log_event(report)
+    return report
+
+
+async def summarize_backlog(chat_id: int, first_id: int, last_id: int) -> None:
+    """
+    Выжимки для импортированного диапазона [first_id, last_id] и догонка бэклога.
+    Если у чата уже есть выжимки (бот его ведёт), часть диапазона до последней из них
+    суммаризируется отдельным проходом по непокрытым промежуткам — конвейер сам идёт
+    только вперёд от своей отметки; всё, что после, догоняет обычный backfill().
+    """
+    await start_llm_client()
+    try:
+        t0 = time.perf_counter()
+        summarizer = ChatSummarizer(chat_id)
+        last_to = await get_last_summarized_msg_id(chat_id)
+        if first_id and last_to >= first_id:
+            made = await summarizer.backfill_range(first_id, min(last_id, last_to))
+            print(f"выжимок по импортированной истории: {made}")
+        await summarizer.backfill()
+        print(f"выжимки догнаны за {time.perf_counter() - t0:.0f} с")
+    finally:
+        await close_llm_client()
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Импорт экспорта Telegram Desktop (result.json)")
+    ap.add_argument("path", help="путь к result.json")
+    ap.add_argument("--chat-id", type=int, default=None,
+                    help="chat_id как его видит бот (по умолчанию — из экспорта)")
+    ap.add_argument("--checkpoint", default=None, help="файл чекпоинта (по умолчанию <path>.checkpoint)")
+    ap.add_argument("--batch-size", type=int, default=5000, help="строк в одной вставке")
+    ap.add_argument("--no-summarize", action="store_true",
+                    help="не запускать догонку выжимок (например, если бот сейчас работает)")
+    args = ap.parse_args()
+
+    chat_id = args.chat_id
+    if chat_id is None:
+        export_id, kind = _read_header(args.path)
+        if export_id is None:
+            print("в экспорте нет id чата — укажите --chat-id", file=sys.stderr)
+            return 2
+        chat_id = _bot_chat_id(export_id, kind)
+    print(f"chat_id={chat_id}")
+
+    apply_migrations()
+    try:
+        report = import_export(args.path, chat_id, args.checkpoint or args.path + ".checkpoint", args.batch_size)
+        print(f"импортировано {report['rows']} строк за {report['elapsed_s']} с "
+              f"({report['rows_per_s']} строк/с), новых пользователей: {report['new_users']}")
+        if not args.no_summarize:
+            asyncio.run(summarize_backlog(chat_id, report["first_msg_id"], report["last_msg_id"]))
+    finally:
+        flush_all_logs()
+        shutdown_db()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
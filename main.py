@@ -1,30 +1,56 @@
 import asyncio
 
-from telegram.ext import Application, filters
+from telegram.ext import filters
 
-from src.configs import BOT_TOKEN, ALLOWED_CHAT_IDS
+from src.configs import ALLOWED_CHAT_IDS
 from src.handlers import register_handlers
-from src.workers import summarizer_loop
+from src.updates import build_application, start_updates, stop_updates
+from src.workers import (
+    summarizer_loop, ingest_flush_loop, log_writer_loop, backfill_search, search_repair_loop,
+    online_migrations,
+)
+from src.db import shutdown_db
+from src.db.migrations import apply_migrations
+from src.db.search import search_backfill_bound
+from src.llm import start_llm_client, close_llm_client
+from src.metrics import start_metrics_server, close_metrics_server
+from src.db.ingest import flush_messages
+from src.db.logger import flush_all_logs
 
 
 async def main():
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = build_application()
 
     chat_whitelist = filters.Chat(chat_id=list(ALLOWED_CHAT_IDS))
 
     register_handlers(app, chat_whitelist)
 
-    task = asyncio.create_task(summarizer_loop())
+    # Быстрые миграции — до приёма сообщений, перестройка таблиц — фоном (online_migrations).
+    apply_migrations(skip_online=True)
+    # Границы доиндексации — до начала приёма сообщений, дальше индекс ведёт путь вставки.
+    search_bounds = {chat_id: search_backfill_bound(chat_id) for chat_id in ALLOWED_CHAT_IDS}
+    await start_llm_client()
+    await start_metrics_server()
+    task = asyncio.gather(
+        summarizer_loop(), ingest_flush_loop(), log_writer_loop(),
+        backfill_search(search_bounds), search_repair_loop(), online_migrations(),
+    )
 
     await app.initialize()
     await app.start()
     try:
-        await app.updater.start_polling()
+        await start_updates(app)
         await task
     finally:
-        await app.updater.stop()
+        await stop_updates(app)
+        # app.stop() дообрабатывает апдейты из очереди — буфер сбрасывается после него.
         await app.stop()
         await app.shutdown()
+        flush_messages()
+        await close_llm_client()
+        await close_metrics_server()
+        flush_all_logs()
+        shutdown_db()
 
 
 if __name__ == "__main__":
@@ -3,13 +3,72 @@ from os import getenv
 from dotenv import find_dotenv, load_dotenv
 
 
-load_dotenv(find_dotenv(), override=True)
+# SKIP_DOTENV=1 — только переменные окружения процесса (бенчмарки не должны подхватить боевой .env).
+if getenv("SKIP_DOTENV") != "1":
+    load_dotenv(find_dotenv(), override=True)
 
 BOT_TOKEN = getenv("BOT_TOKEN")
+# Адрес Bot API вместе с префиксом /bot (пусто — api.telegram.org); для локального сервера или подделки.
+TELEGRAM_API_URL = getenv("TELEGRAM_API_URL", "")
+
+# Приём апдейтов: polling (getUpdates) или webhook (Telegram сам шлёт POST на WEBHOOK_URL).
+UPDATES_MODE = getenv("UPDATES_MODE", "polling")
+WEBHOOK_LISTEN = getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = getenv("WEBHOOK_PATH", "telegram")
+# Публичный https-URL за reverse proxy, который регистрируется через setWebhook;
+# пусто — http://WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_PATH (годится только для локальной подделки).
+WEBHOOK_URL = getenv("WEBHOOK_URL", "")
+# Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token; пусто — случайный на каждый запуск.
+WEBHOOK_SECRET = getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
 
 N = int(getenv("N", "100"))
 K = int(getenv("K", "10"))
 
+SUMMARIZER_CATCHUP_MIN_BATCHES = int(getenv("SUMMARIZER_CATCHUP_MIN_BATCHES", "3"))
+SUMMARIZER_CATCHUP_CONCURRENCY = int(getenv("SUMMARIZER_CATCHUP_CONCURRENCY", "4"))
+SUMMARIZER_CATCHUP_REPORT_EVERY = int(getenv("SUMMARIZER_CATCHUP_REPORT_EVERY", "10"))
+ROLLUP_MAX_LEVEL = int(getenv("ROLLUP_MAX_LEVEL", "8"))
+# Пауза перед повтором упавшей фоновой задачи: удваивается с каждым сбоем подряд, не больше MAX.
+WORKER_RETRY_BASE_DELAY = float(getenv("WORKER_RETRY_BASE_DELAY", "5"))
+WORKER_RETRY_MAX_DELAY = float(getenv("WORKER_RETRY_MAX_DELAY", "300"))
+
+INGEST_BATCH_SIZE = int(getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_FLUSH_INTERVAL = float(getenv("INGEST_FLUSH_INTERVAL", "2"))
+# Потолок буфера при недоступном ClickHouse (сверх него сообщения отбрасываются и считаются)
+# и пауза между повторами неудачного сброса: от INGEST_FLUSH_INTERVAL с удвоением до этого значения.
+INGEST_MAX_BUFFER = int(getenv("INGEST_MAX_BUFFER", "50000"))
+INGEST_RETRY_MAX_DELAY = float(getenv("INGEST_RETRY_MAX_DELAY", "60"))
+
+T_CACHE_SIZE = int(getenv("T_CACHE_SIZE", "64"))
+T_CACHE_TTL = float(getenv("T_CACHE_TTL", "3600"))
+T_CACHE_DELTA_MAX = int(getenv("T_CACHE_DELTA_MAX", "20"))
+RECENT_TAIL_SIZE = int(getenv("RECENT_TAIL_SIZE", "50"))
+
+TOOL_RING_SIZE = int(getenv("TOOL_RING_SIZE", "200"))
+TOOL_WINDOW_CACHE_SIZE = int(getenv("TOOL_WINDOW_CACHE_SIZE", "32"))
+TOOL_WINDOW_MAX_N = int(getenv("TOOL_WINDOW_MAX_N", "2000"))
+
+LOG_QUEUE_SIZE = int(getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = int(getenv("LOG_BATCH_SIZE", "500"))
+LOG_FLUSH_INTERVAL = float(getenv("LOG_FLUSH_INTERVAL", "2"))
+LOG_PROMPT_SAMPLE_RATE = float(getenv("LOG_PROMPT_SAMPLE_RATE", "0.1"))
+LOG_MAX_EVENT_CHARS = int(getenv("LOG_MAX_EVENT_CHARS", "200000"))
+LOG_TTL_DAYS = int(getenv("LOG_TTL_DAYS", "90"))
+
+SEARCH_STEM_LEN = int(getenv("SEARCH_STEM_LEN", "6"))
+SEARCH_RECENCY_WEIGHT = float(getenv("SEARCH_RECENCY_WEIGHT", "0.3"))
+SEARCH_RECENCY_HALFLIFE = float(getenv("SEARCH_RECENCY_HALFLIFE", "5000"))
+SEARCH_BACKFILL_CHUNK = int(getenv("SEARCH_BACKFILL_CHUNK", "20000"))
+# Как часто доиндексировать пачки, которые не попали в индекс при вставке.
+SEARCH_REPAIR_INTERVAL = float(getenv("SEARCH_REPAIR_INTERVAL", "30"))
+
+VECTOR_DIM = int(getenv("VECTOR_DIM", "256"))
+
+USER_CACHE_SIZE = int(getenv("USER_CACHE_SIZE", "10000"))
+USER_LAST_SEEN_REFRESH = float(getenv("USER_LAST_SEEN_REFRESH", "3600"))
+
 PROXY = getenv("OUTBOUND_PROXY", "")
 
 LLM_PROVIDER = getenv("LLM_PROVIDER", "groq").lower()
@@ -22,10 +81,34 @@ OPENAI_API_KEY = getenv("OPENAI_API_KEY", "")
 OPENAI_MODEL   = getenv("OPENAI_MODEL", "gpt-5")
 OPENAI_BASEURL = getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
 
+GROQ_PROMPT_BUDGET = int(getenv("GROQ_PROMPT_BUDGET", "6000"))
+OPENAI_PROMPT_BUDGET = int(getenv("OPENAI_PROMPT_BUDGET", "32000"))
+
+B_MAX_TOOL_CALLS = int(getenv("B_MAX_TOOL_CALLS", "4"))
+
+STATS_DEFAULT_DAYS = int(getenv("STATS_DEFAULT_DAYS", "7"))
+STATS_TOP_USERS = int(getenv("STATS_TOP_USERS", "10"))
+
+STREAM_EDIT_INTERVAL = float(getenv("STREAM_EDIT_INTERVAL", "1.0"))
 
+LLM_HTTP2 = getenv("LLM_HTTP2", "1") == "1"
+LLM_MAX_CONCURRENCY = int(getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_MAX_RETRIES = int(getenv("LLM_MAX_RETRIES", "3"))
+LLM_RETRY_BASE_DELAY = float(getenv("LLM_RETRY_BASE_DELAY", "1"))
+LLM_RETRY_MAX_DELAY = float(getenv("LLM_RETRY_MAX_DELAY", "30"))
+
+
+CLICKHOUSE_HOST = getenv("CLICKHOUSE_HOST", "localhost")
+CLICKHOUSE_PORT = int(getenv("CLICKHOUSE_PORT", "8123"))
 CLICKHOUSE_DB = getenv("CLICKHOUSE_DB", "default")
 CLICKHOUSE_USER = getenv("CLICKHOUSE_USER","default")
 CLICKHOUSE_PASSWORD = getenv("CLICKHOUSE_PASSWORD","")
+CH_POOL_SIZE = int(getenv("CH_POOL_SIZE", "4"))
+# Строк в блоке потоковых выборок (stream_rows/stream_blocks): верхняя граница памяти на один блок.
+CH_STREAM_BLOCK_ROWS = int(getenv("CH_STREAM_BLOCK_ROWS", "10000"))
+
+METRICS_HOST = getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(getenv("METRICS_PORT", "9108"))
 
 
 def _parse_ids(val: str) -> set[int]:
@@ -43,3 +126,5 @@ ALLOWED_CHAT_IDS = _parse_ids(getenv("ALLOWED_CHAT_IDS", ""))
 single = getenv("ALLOWED_CHAT_ID")
 if single:
     ALLOWED_CHAT_IDS.add(int(single))
+
+LEGACY_CHAT_ID = int(getenv("LEGACY_CHAT_ID", "0"))
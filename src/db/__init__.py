@@ -1,21 +1,121 @@
 from __future__ import annotations
 
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Iterator, List, Optional, Sequence, TypeVar
+
 import clickhouse_connect
-from typing import Optional
 
-from ..configs import CLICKHOUSE_DB, CLICKHOUSE_USER, CLICKHOUSE_PASSWORD
+from ..metrics import DB_CALL_SECONDS, DB_CALL_ERRORS, observe_ch_summary
+from ..configs import (
+    CLICKHOUSE_HOST, CLICKHOUSE_PORT, CLICKHOUSE_DB, CLICKHOUSE_USER, CLICKHOUSE_PASSWORD,
+    CH_POOL_SIZE, CH_STREAM_BLOCK_ROWS,
+)
 
 
-__ch_client: Optional[clickhouse_connect.driver.Client] = None
+T = TypeVar("T")
 
-def get_ch() -> clickhouse_connect.driver.Client:
-    global __ch_client
-    if __ch_client is None:
-        __ch_client = clickhouse_connect.get_client(
-            host="localhost",
-            port=8123,
+# Клиент clickhouse-connect не допускает параллельных запросов в одной сессии,
+# поэтому у каждого потока пула свой клиент — и отдельный для потоковых выборок:
+# пока читается поток, тот же поток пула делает обычные запросы и вставки через get_ch().
+_local = threading.local()
+_executor: Optional[ThreadPoolExecutor] = None
+
+def _summary(result: Any) -> Optional[dict]:
+    summary = getattr(result, "summary", None)
+    return summary if isinstance(summary, dict) else None
+
+def _observed(client: clickhouse_connect.driver.Client) -> clickhouse_connect.driver.Client:
+    """
+    Серверное время и объём чтения каждого query/insert/command — из X-ClickHouse-Summary,
+    с меткой функции src/db, выполняемой сейчас в этом потоке (см. run_db).
+    Потоковые выборки не учитываются: сводка приходит только после дочитывания ответа.
+    """
+    for method in ("query", "insert", "command"):
+        call = getattr(client, method)
+
+        def observed(*args: Any, _call: Callable = call, **kwargs: Any) -> Any:
+            result = _call(*args, **kwargs)
+            observe_ch_summary(getattr(_local, "fn", "direct"), _summary(result))
+            return result
+
+        setattr(client, method, observed)
+    return client
+
+def _client(attr: str) -> clickhouse_connect.driver.Client:
+    client = getattr(_local, attr, None)
+    if client is None:
+        client = clickhouse_connect.get_client(
+            host=CLICKHOUSE_HOST,
+            port=CLICKHOUSE_PORT,
             database=CLICKHOUSE_DB,
             username=CLICKHOUSE_USER,
             password=CLICKHOUSE_PASSWORD,
         )
-    return __ch_client
+        setattr(_local, attr, _observed(client))
+    return getattr(_local, attr)
+
+def get_ch() -> clickhouse_connect.driver.Client:
+    return _client("client")
+
+def stream_blocks(query: str, parameters: Optional[dict] = None) -> Iterator[List[Sequence]]:
+    """
+    Результат запроса блоками строк по мере чтения ответа (query_row_block_stream):
+    в памяти держится один блок до CH_STREAM_BLOCK_ROWS строк, а не весь result_rows.
+    Читается отдельным потоковым клиентом потока пула, поэтому внутри цикла можно
+    обращаться к get_ch() (имена авторов, вставки), но не открывать второй поток.
+    Потреблять целиком внутри одной функции под run_db и не держать поток открытым
+    между await'ами — сервер обрывает соединение, если клиент долго не читает.
+    """
+    stream = _client("stream_client").query_row_block_stream(
+        query, parameters=parameters, settings={"max_block_size": CH_STREAM_BLOCK_ROWS},
+    )
+    with stream:
+        for block in stream:
+            yield block
+
+def stream_rows(query: str, parameters: Optional[dict] = None) -> Iterator[Sequence]:
+    """То же построчно (см. stream_blocks)."""
+    for block in stream_blocks(query, parameters):
+        yield from block
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=CH_POOL_SIZE, thread_name_prefix="ch")
+    return _executor
+
+def _call_as(name: str, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    _local.fn = name
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _local.fn = "direct"
+
+async def run_db(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Выполняет синхронную функцию работы с БД в пуле из CH_POOL_SIZE потоков,
+    не блокируя event loop. Больше CH_POOL_SIZE запросов одновременно не идёт.
+    Длительность (вместе с ожиданием свободного потока) пишется в tg_db_call_seconds{fn},
+    серверное время её запросов — в tg_ch_server_seconds{fn}.
+    """
+    loop = asyncio.get_running_loop()
+    name = getattr(fn, "__name__", "unknown")
+    t0 = time.perf_counter()
+    try:
+        return await loop.run_in_executor(_get_executor(), partial(_call_as, name, fn, *args, **kwargs))
+    except Exception:
+        DB_CALL_ERRORS.inc(name)
+        raise
+    finally:
+        DB_CALL_SECONDS.observe(time.perf_counter() - t0, name)
+
+def shutdown_db() -> None:
+    """Дожидается текущих запросов и останавливает пул (вызывать при остановке бота)."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -0,0 +1,68 @@
+"""
+Awaitable-версии функций src/db: каждая выполняется в пуле потоков ClickHouse
+(см. run_db) и не блокирует event loop. Сигнатуры совпадают с синхронными.
+"""
+from __future__ import annotations
+
+from functools import wraps
+from typing import Any, Awaitable, Callable, TypeVar
+
+from . import run_db
+from . import messages, summaries, contexts, rollups, users, materials, watermarks, search, semantic, stats
+
+
+T = TypeVar("T")
+
+def _awaitable(fn: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+    @wraps(fn)
+    async def wrapper(*args: Any, **kwargs: Any) -> T:
+        return await run_db(fn, *args, **kwargs)
+    return wrapper
+
+
+insert_message = _awaitable(messages.insert_message)
+insert_messages = _awaitable(messages.insert_messages)
+get_last_msg_id = _awaitable(messages.get_last_msg_id)
+fetch_messages_after = _awaitable(messages.fetch_messages_after)
+fetch_last_messages = _awaitable(messages.fetch_last_messages)
+fetch_tail_preview = _awaitable(messages.fetch_tail_preview)
+tool_get_messages_window = _awaitable(messages.tool_get_messages_window)
+tool_search_messages = _awaitable(messages.tool_search_messages)
+tool_semantic_search = _awaitable(semantic.tool_semantic_search)
+
+get_last_summarized_msg_id = _awaitable(summaries.get_last_summarized_msg_id)
+get_next_batch = _awaitable(summaries.get_next_batch)
+get_next_batches = _awaitable(summaries.get_next_batches)
+get_summarized_spans = _awaitable(summaries.get_summarized_spans)
+get_summary_batch_ids = _awaitable(summaries.get_summary_batch_ids)
+count_messages_after = _awaitable(summaries.count_messages_after)
+insert_summary = _awaitable(summaries.insert_summary)
+fetch_summaries_after = _awaitable(summaries.fetch_summaries_after)
+fetch_last_summaries = _awaitable(summaries.fetch_last_summaries)
+tool_get_summaries = _awaitable(summaries.tool_get_summaries)
+
+get_last_context_batch_id = _awaitable(contexts.get_last_context_batch_id)
+insert_context = _awaitable(contexts.insert_context)
+fetch_last_contexts = _awaitable(contexts.fetch_last_contexts)
+tool_get_contexts = _awaitable(contexts.tool_get_contexts)
+
+get_rollup_marks = _awaitable(rollups.get_rollup_marks)
+fetch_nodes_after = _awaitable(rollups.fetch_nodes_after)
+insert_rollup = _awaitable(rollups.insert_rollup)
+
+upsert_user = _awaitable(users.upsert_user)
+load_display_names = _awaitable(users.load_display_names)
+
+get_range_of_last_n = _awaitable(materials.get_range_of_last_n)
+fetch_tree_meta = _awaitable(materials.fetch_tree_meta)
+fetch_materials = _awaitable(materials.fetch_materials)
+
+get_watermarks = _awaitable(watermarks.get_watermarks)
+
+search_backfill_bound = _awaitable(search.search_backfill_bound)
+backfill_search_index = _awaitable(search.backfill_search_index)
+pending_search_gaps = _awaitable(search.pending_search_gaps)
+repair_search_gap = _awaitable(search.repair_search_gap)
+
+get_stats = _awaitable(stats.get_stats)
+tool_get_stats = _awaitable(stats.tool_get_stats)
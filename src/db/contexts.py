@@ -4,15 +4,23 @@ from typing import List, Tuple
 import datetime as dt
 
 from . import get_ch
-from ..configs import N
+from ..configs import N, TOOL_RING_SIZE
+from .watermarks import note_context, get_watermarks
+from .tool_cache import RingCache
 
 
-def get_last_context_batch_id() -> int:
+context_ring = RingCache(TOOL_RING_SIZE)
+
+
+def get_last_context_batch_id(chat_id: int) -> int:
     ch = get_ch()
-    r = ch.query("SELECT max(to_batch_id) FROM tg_contexts").result_rows
+    r = ch.query(
+        "SELECT max(to_batch_id) FROM tg_contexts WHERE chat_id = %(c)s",
+        parameters={"c": chat_id}
+    ).result_rows
     return int(r[0][0] or 0)
 
-def insert_context(context_id: int, batches: List[Tuple[int, str, dt.datetime, dt.datetime]], text: str, ti: int, to: int) -> None:
+def insert_context(chat_id: int, context_id: int, batches: List[Tuple[int, str, dt.datetime, dt.datetime]], text: str, ti: int, to: int) -> None:
     ch = get_ch()
     from_id = batches[0][0]
     to_id = batches[-1][0]
@@ -20,7 +28,8 @@ def insert_context(context_id: int, batches: List[Tuple[int, str, dt.datetime, d
     to_ts = batches[-1][3]
     ch.insert(
         'tg_contexts',
-        [(context_id,
+        [(chat_id,
+          context_id,
           from_id,
           to_id,
           from_ts,
@@ -29,6 +38,7 @@ def insert_context(context_id: int, batches: List[Tuple[int, str, dt.datetime, d
           ti,
           to)],
         column_names=[
+            'chat_id',
             'context_id',
             'from_batch_id',
             'to_batch_id',
@@ -39,41 +49,61 @@ def insert_context(context_id: int, batches: List[Tuple[int, str, dt.datetime, d
             'tokens_out'
         ]
     )
+    context_ring.append(chat_id, context_id, _context_record(context_id, from_id, to_id, from_ts, to_ts, text))
+    note_context(chat_id, context_id)
+
+def fetch_contexts_after(chat_id: int, context_id: int, k: int) -> List[Tuple[int, str, dt.datetime, dt.datetime]]:
+    """До k контекстов чата с context_id > context_id: [(context_id, text, from_ts, to_ts)] по возрастанию."""
+    ch = get_ch()
+    rows = ch.query(
+        "SELECT context_id, text, from_ts, to_ts "
+        "FROM tg_contexts WHERE chat_id = %(c)s AND context_id > %(x)s ORDER BY context_id ASC LIMIT %(k)s",
+        parameters={'c': chat_id, 'x': context_id, 'k': k}
+    ).result_rows
+    return [tuple(r) for r in rows]
 
-def fetch_last_contexts(c: int) -> list[str]:
+def fetch_last_contexts(chat_id: int, c: int) -> list[str]:
     ch = get_ch()
     rows = ch.query(
         """
         SELECT text
         FROM tg_contexts
+        WHERE chat_id = %(chat)s
         ORDER BY context_id DESC
         LIMIT %(c)s
         """,
-        parameters={"c": c}
+        parameters={"chat": chat_id, "c": c}
     ).result_rows
     return [r[0] for r in rows[::-1]]
 
 
-def tool_get_contexts(limit: int = 5) -> list[dict]:
+def _context_record(ctx_id: int, from_b: int, to_b: int, from_ts: dt.datetime, to_ts: dt.datetime, text: str) -> dict:
+    return {
+        "context_id": ctx_id,
+        "from_ts": from_ts.isoformat() + "Z",
+        "to_ts": to_ts.isoformat() + "Z",
+        "approx_messages": max(1, (to_b - from_b + 1)) * N,
+        "text": text
+    }
+
+def tool_get_contexts(chat_id: int, limit: int = 5) -> list[dict]:
+    """Последние limit контекстов; повторные вызовы обслуживаются из кольца в памяти."""
+    cached = context_ring.get(chat_id, limit, get_watermarks(chat_id).last_context_id)
+    if cached is not None:
+        return cached
+    k = max(limit, TOOL_RING_SIZE)
     ch = get_ch()
     rows = ch.query(
         """
         SELECT context_id, from_batch_id, to_batch_id, from_ts, to_ts, text
         FROM tg_contexts
+        WHERE chat_id = %(c)s
         ORDER BY context_id DESC
         LIMIT %(lim)s
         """,
-        parameters={"lim": limit}
+        parameters={"c": chat_id, "lim": k}
     ).result_rows
     rows.reverse()
-    out = []
-    for ctx_id, from_b, to_b, from_ts, to_ts, text in rows:
-        approx = max(1, (to_b - from_b + 1)) * N
-        out.append({
-            "context_id": ctx_id,
-            "from_ts": from_ts.isoformat() + "Z",
-            "to_ts": to_ts.isoformat() + "Z",
-            "approx_messages": approx,
-            "text": text
-        })
-    return out
+    recs = [(r[0], _context_record(*r)) for r in rows]
+    context_ring.fill(chat_id, recs, complete=len(rows) < k)
+    return [rec for _, rec in recs[-limit:]] if limit > 0 else []
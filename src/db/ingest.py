@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import asyncio
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from . import run_db
+from ..schemas import Msg
+from ..configs import INGEST_BATCH_SIZE, INGEST_FLUSH_INTERVAL, INGEST_MAX_BUFFER, INGEST_RETRY_MAX_DELAY
+from .messages import insert_messages
+from .logger import log_exception
+from .watermarks import note_message
+
+
+_buffer: List[Msg] = []
+_oldest_at: Optional[float] = None
+# Неудавшаяся пачка повторяется как есть и с тем же insert_deduplication_token: если первая
+# попытка на самом деле записалась (таймаут после вставки), ClickHouse отбросит повтор.
+_retry: Optional[Tuple[List[Msg], str, Optional[float]]] = None
+_failures = 0
+_retry_at = 0.0
+_flush_lock = asyncio.Lock()
+_listeners: List[Callable[[List[Msg]], None]] = []
+
+_stats: Dict[str, Any] = {
+    "enqueued": 0,
+    "flushes": 0,
+    "flushed_rows": 0,
+    "failed_flushes": 0,
+    "dropped": 0,
+    "last_flush_ms": 0.0,
+    "max_flush_ms": 0.0,
+    "total_flush_ms": 0.0,
+}
+
+
+def add_flush_listener(fn: Callable[[List[Msg]], None]) -> None:
+    """fn(rows) вызывается после каждого успешного сброса — строки уже видны в tg_messages."""
+    _listeners.append(fn)
+
+def _depth() -> int:
+    return len(_buffer) + (len(_retry[0]) if _retry else 0)
+
+def enqueue_message(m: Msg) -> bool:
+    """
+    Кладёт сообщение в буфер вставки.
+    Возвращает True, если буфер достиг INGEST_BATCH_SIZE и его пора сбросить
+    (пока идёт пауза после неудачного сброса — False: повтор ведёт ingest_flush_loop).
+    Если в буфере уже INGEST_MAX_BUFFER строк (ClickHouse недоступен), сообщение
+    отбрасывается и учитывается в счётчике dropped.
+    """
+    global _oldest_at
+    if _depth() >= INGEST_MAX_BUFFER:
+        _stats["dropped"] += 1
+        return False
+    if not _buffer:
+        _oldest_at = time.monotonic()
+    _buffer.append(m)
+    _stats["enqueued"] += 1
+    note_message(m)
+    return len(_buffer) >= INGEST_BATCH_SIZE and not _failures
+
+def flush_due() -> bool:
+    """
+    Пора ли сбрасывать буфер: по размеру или по возрасту самого старого сообщения.
+    После неудачного сброса — не раньше, чем кончится пауза.
+    """
+    if _failures and time.monotonic() < _retry_at:
+        return False
+    if _retry:
+        return True
+    if not _buffer:
+        return False
+    if len(_buffer) >= INGEST_BATCH_SIZE:
+        return True
+    return _oldest_at is not None and time.monotonic() - _oldest_at >= INGEST_FLUSH_INTERVAL
+
+def _take_batch() -> Tuple[List[Msg], str, Optional[float]]:
+    """Сначала — неудавшаяся пачка с её токеном, иначе весь буфер с новым токеном."""
+    global _buffer, _oldest_at, _retry
+    if _retry is not None:
+        batch, _retry = _retry, None
+        return batch
+    rows, _buffer = _buffer, []
+    oldest_at, _oldest_at = _oldest_at, None
+    return rows, uuid.uuid4().hex, oldest_at
+
+def _requeue(rows: List[Msg], token: str, oldest_at: Optional[float]) -> None:
+    """Откладывает пачку до повтора с паузой INGEST_FLUSH_INTERVAL * 2^k, не больше INGEST_RETRY_MAX_DELAY."""
+    global _retry, _failures, _retry_at
+    _retry = (rows, token, oldest_at)
+    _failures += 1
+    _retry_at = time.monotonic() + min(INGEST_FLUSH_INTERVAL * 2 ** (_failures - 1), INGEST_RETRY_MAX_DELAY)
+    _stats["failed_flushes"] += 1
+    log_exception(ctx=f"flush_messages rows={len(rows)} failures={_failures}")
+
+def _record_flush(rows: List[Msg], t0: float) -> int:
+    global _failures
+    _failures = 0
+    dt_ms = (time.perf_counter() - t0) * 1000
+    _stats["flushes"] += 1
+    _stats["flushed_rows"] += len(rows)
+    _stats["last_flush_ms"] = dt_ms
+    _stats["max_flush_ms"] = max(_stats["max_flush_ms"], dt_ms)
+    _stats["total_flush_ms"] += dt_ms
+    for fn in _listeners:
+        try:
+            fn(rows)
+        except Exception:
+            log_exception(ctx="flush listener")
+    return len(rows)
+
+def flush_messages() -> int:
+    """
+    Синхронно сбрасывает накопленные сообщения (для остановки бота): сначала отложенную
+    неудавшуюся пачку, затем буфер — паузу после сбоев не ждёт. При ошибке пачка
+    откладывается до следующей попытки. Возвращает число записанных строк.
+    """
+    written = 0
+    while _retry or _buffer:
+        rows, token, oldest_at = _take_batch()
+        t0 = time.perf_counter()
+        try:
+            insert_messages(rows, token)
+        except Exception:
+            _requeue(rows, token, oldest_at)
+            break
+        written += _record_flush(rows, t0)
+    return written
+
+async def flush_messages_async() -> int:
+    """
+    Одна пачка (отложенная неудавшаяся или весь буфер), INSERT — в пуле потоков БД.
+    Сбросы не пересекаются.
+    """
+    async with _flush_lock:
+        if not _retry and not _buffer:
+            return 0
+        rows, token, oldest_at = _take_batch()
+        t0 = time.perf_counter()
+        try:
+            await run_db(insert_messages, rows, token)
+        except Exception:
+            _requeue(rows, token, oldest_at)
+            return 0
+        return _record_flush(rows, t0)
+
+def ingest_stats() -> Dict[str, Any]:
+    """Счётчики буфера: глубина очереди, возраст, число и латентность сбросов."""
+    flushes = _stats["flushes"]
+    return {
+        **_stats,
+        "queue_depth": _depth(),
+        "retry_in_s": max(0.0, _retry_at - time.monotonic()) if _failures else 0.0,
+        "oldest_age_s": (time.monotonic() - _oldest_at) if _buffer and _oldest_at is not None else 0.0,
+        "avg_flush_ms": (_stats["total_flush_ms"] / flushes) if flushes else 0.0,
+    }
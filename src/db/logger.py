@@ -1,21 +1,35 @@
 from __future__ import annotations
 
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
 import datetime as dt
 import json
+import random
+import time
 import traceback
-from typing import Any, Dict, List, Optional
 
 from . import get_ch
+from ..configs import (
+    LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL, LOG_PROMPT_SAMPLE_RATE, LOG_MAX_EVENT_CHARS
+)
 
 
 _TABLE = "logs"
 
+# События копятся в памяти уже сериализованными и обрезанными до LOG_MAX_EVENT_CHARS
+# (память очереди — не больше LOG_QUEUE_SIZE таких строк) и пишутся пачками фоновым
+# писателем (см. workers.log_writer_loop). deque.append/popleft потокобезопасны.
+_queue: Deque[Tuple[dt.datetime, str]] = deque()
+_stats = {"queued": 0, "written": 0, "dropped": 0, "failed_batches": 0, "last_flush_ms": 0.0}
+_last_flush = time.monotonic()
+_dropped_reported = 0
+
 def _clip(s: str | None, max_chars: int = 20_000) -> str:
     if not s:
         return ""
     return s if len(s) <= max_chars else s[:max_chars] + f"... [truncated {len(s)-max_chars} chars]"
 
-def _safe_json(obj: Any, max_chars: int = 200_000) -> str:
+def _safe_json(obj: Any, max_chars: int = LOG_MAX_EVENT_CHARS) -> str:
     try:
         raw = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
     except Exception:
@@ -23,18 +37,68 @@ def _safe_json(obj: Any, max_chars: int = 200_000) -> str:
     return _clip(raw, max_chars)
 
 def log_event(meta: Dict[str, Any]) -> None:
-    """Пишет произвольный JSON в logs.meta_raw (никогда не бросает исключений)."""
+    """
+    Ставит произвольный JSON в очередь на запись в logs.meta_raw (никогда не бросает исключений).
+    Если очередь заполнена — событие отбрасывается и учитывается в счётчике dropped.
+    """
     try:
-        ch = get_ch()
-        payload = _safe_json(meta)
-        ch.insert(
-            _TABLE,
-            [(dt.datetime.now(dt.timezone.utc), payload)],
-            column_names=["event_time", "meta_raw"]
-        )
+        if len(_queue) >= LOG_QUEUE_SIZE:
+            _stats["dropped"] += 1
+            return
+        _queue.append((dt.datetime.now(dt.timezone.utc), _safe_json(meta)))
+        _stats["queued"] += 1
     except Exception:
         pass
 
+def logs_flush_due() -> bool:
+    return len(_queue) >= LOG_BATCH_SIZE or (bool(_queue) and time.monotonic() - _last_flush >= LOG_FLUSH_INTERVAL)
+
+def _requeue(batch: List[Tuple[dt.datetime, str]]) -> None:
+    """Возвращает неудавшуюся пачку в голову очереди; что не влезает в LOG_QUEUE_SIZE — в dropped."""
+    keep = batch[:max(0, LOG_QUEUE_SIZE - len(_queue))]
+    _stats["dropped"] += len(batch) - len(keep)
+    _queue.extendleft(reversed(keep))
+
+def flush_logs() -> int:
+    """
+    Синхронно пишет до LOG_BATCH_SIZE событий одним INSERT. Вызывается фоновым писателем
+    из пула БД и при остановке. При сбое пачка возвращается в очередь, а отметка
+    о потерянных событиях (logs.dropped) уйдёт со следующей удачной пачкой.
+    """
+    global _last_flush, _dropped_reported
+    _last_flush = time.monotonic()
+    batch: List[Tuple[dt.datetime, str]] = []
+    while _queue and len(batch) < LOG_BATCH_SIZE:
+        batch.append(_queue.popleft())
+    rows = list(batch)
+    dropped = _stats["dropped"]
+    if dropped > _dropped_reported:
+        rows.append((dt.datetime.now(dt.timezone.utc), _safe_json({
+            "type": "logs.dropped", "dropped_total": dropped, "dropped_since_last": dropped - _dropped_reported,
+        })))
+    if not rows:
+        return 0
+
+    t0 = time.perf_counter()
+    try:
+        get_ch().insert(_TABLE, rows, column_names=["event_time", "meta_raw"])
+    except Exception:
+        _stats["failed_batches"] += 1
+        _requeue(batch)
+        return 0
+    _dropped_reported = dropped
+    _stats["written"] += len(rows)
+    _stats["last_flush_ms"] = (time.perf_counter() - t0) * 1000
+    return len(rows)
+
+def flush_all_logs() -> None:
+    """Дописывает всю очередь (при остановке бота)."""
+    while _queue and flush_logs():
+        pass
+
+def log_stats() -> Dict[str, Any]:
+    return {**_stats, "queue_depth": len(_queue)}
+
 
 def log_llm_chat_start(provider: str, model: str, messages: List[Dict[str, str]], temperature: float) -> Dict[str, Any]:
     meta = {
@@ -42,20 +106,30 @@ def log_llm_chat_start(provider: str, model: str, messages: List[Dict[str, str]]
         "provider": provider,
         "model": model,
         "temperature": temperature,
-        "request": {"messages": messages},
     }
+    # Полный промпт (до сотен КБ JSON) пишется только для доли LOG_PROMPT_SAMPLE_RATE запросов.
+    if random.random() < LOG_PROMPT_SAMPLE_RATE:
+        meta["request"] = {"messages": messages}
+    else:
+        meta["request"] = {
+            "sampled_out": True,
+            "n_messages": len(messages),
+            "chars": sum(len(m.get("content") or "") for m in messages),
+        }
     log_event(meta)
     return meta
 
 def log_llm_chat_end(provider: str, model: str, request_meta: Dict[str, Any],
                      response_text: str, usage: Optional[Dict[str, Any]],
-                     latency_ms: int, ok: bool = True, error: Optional[str] = None) -> None:
+                     latency_ms: int, ok: bool = True, error: Optional[str] = None,
+                     timings: Optional[Dict[str, Any]] = None) -> None:
     meta = {
         "type": "llm.chat_end",
         "provider": provider,
         "model": model,
         "ok": ok,
         "latency_ms": latency_ms,
+        "timings": timings or {},
         "response": {"text": _clip(response_text), "usage": usage or {}},
         "request_ref": {"temperature": request_meta.get("temperature")},
     }
@@ -63,25 +137,30 @@ def log_llm_chat_end(provider: str, model: str, request_meta: Dict[str, Any],
         meta["error"] = _clip(error, 8000)
     log_event(meta)
 
-def log_llm_tool_request(draft_text: str, tool_json: Dict[str, Any]) -> None:
+def log_llm_tool_request(draft_text: str, tool_json: Any) -> None:
     log_event({
         "type": "llm.tool_request",
         "llm_draft": _clip(draft_text),
         "tool": tool_json,
     })
 
-def log_llm_tool_result(name: str, args: Dict[str, Any], result: Any) -> None:
+def log_llm_tool_result(name: str, args: Dict[str, Any], result: Any,
+                        latency_ms: Optional[int] = None, error: Optional[str] = None) -> None:
     preview: Any = result
     try:
         if isinstance(result, list):
             preview = {"count": len(result), "sample": result[:3]}
     except Exception:
         preview = {"repr": repr(result)}
-    log_event({
+    meta = {
         "type": "llm.tool_result",
         "tool": {"name": name, "args": args},
+        "latency_ms": latency_ms,
         "result_preview": preview,
-    })
+    }
+    if error:
+        meta["error"] = _clip(error, 8000)
+    log_event(meta)
 
 def log_exception(ctx: str) -> None:
     log_event({
@@ -1,84 +1,119 @@
 from __future__ import annotations
 
-from typing import List, Tuple, Optional
+from typing import Dict, List, Tuple, Optional
 from datetime import datetime
 
 from . import get_ch
-from ..schemas import Msg
-from .users import load_display_names
+from ..schemas import MsgRow
+from .users import msg_rows
 
 
-def get_oldest_ts_of_last_n(n: int) -> Optional[datetime]:
-    ch = get_ch()
-    row = ch.query("SELECT max(tg_msg_id) FROM tg_messages").result_rows
-    last_id = int(row[0][0] or 0)
-    if last_id == 0 or n <= 0:
-        return
-
-    from_id = max(0, last_id - n)
-
-    rows = ch.query(
+def get_range_of_last_n(chat_id: int, n: int) -> Tuple[int, Optional[datetime]]:
+    """
+    (last_msg_id, oldest_ts) для окна последних n сообщений чата — одним агрегатом на сервере,
+    без выгрузки строк окна. Читаются только tg_msg_id и ts.
+    """
+    if n <= 0:
+        return 0, None
+    row = get_ch().query(
         """
-        SELECT tg_msg_id, user_id, text, ts
+        SELECT max(tg_msg_id), min(ts), count()
         FROM tg_messages
-        WHERE tg_msg_id > %(from_id)s
-          AND lengthUTF8(text) > 0
-        ORDER BY tg_msg_id ASC
+        WHERE chat_id = %(c)s
+          AND tg_msg_id > (SELECT max(tg_msg_id) FROM tg_messages WHERE chat_id = %(c)s) - %(n)s
         """,
-        parameters={"from_id": from_id},
-    ).result_rows
-    return rows[0][0] if rows and rows[0][0] is not None else None
+        parameters={"c": chat_id, "n": n},
+    ).result_rows[0]
+    if not row[2]:
+        return 0, None
+    return int(row[0]), row[1]
 
-def fetch_contexts_since(oldest_ts: datetime) -> List[Tuple[str, datetime]]:
-    """Возвращает [(text, to_ts)] контекстов, которые пересекают интервал [oldest_ts, now]."""
-    ch = get_ch()
-    rows = ch.query(
+def fetch_tree_meta(chat_id: int, oldest_ts: datetime) -> List[Tuple[int, int, int, int, datetime]]:
+    """
+    Метаданные всех узлов дерева сжатия, пересекающих [oldest_ts, now], без текстов:
+    [(level, id, from_child, to_child, from_ts)], от верхних уровней к нижним, внутри уровня — по id.
+    Уровень 0 — выжимки, 1 — контексты, 2+ — tg_rollups.
+    """
+    rows = get_ch().query(
         """
-        SELECT text, to_ts
-        FROM tg_contexts
-        WHERE to_ts >= %(from_ts)s   -- заканчиваются не раньше начала интервала
-        ORDER BY context_id ASC
+        SELECT level, id, from_child, to_child, from_ts
+        FROM
+        (
+            SELECT level, node_id AS id, from_child, to_child, from_ts
+            FROM tg_rollups
+            WHERE chat_id = %(c)s AND to_ts >= toDateTime(%(oldest)s)
+
+            UNION ALL
+
+            SELECT toUInt8(1), context_id, from_batch_id, to_batch_id, from_ts
+            FROM tg_contexts
+            WHERE chat_id = %(c)s AND to_ts >= toDateTime(%(oldest)s)
+
+            UNION ALL
+
+            SELECT toUInt8(0), batch_id, toInt64(0), toInt64(0), from_ts
+            FROM tg_summaries
+            WHERE chat_id = %(c)s AND to_ts >= toDateTime(%(oldest)s)
+        )
+        ORDER BY level DESC, id ASC
         """,
-        parameters={"from_ts": oldest_ts}
+        parameters={"c": chat_id, "oldest": oldest_ts},
     ).result_rows
-    return [(r[0], r[1]) for r in rows]
+    return [tuple(r) for r in rows]
 
-def fetch_summaries_since(from_ts: datetime) -> List[Tuple[str, datetime]]:
-    """[(text, to_ts)] выжимок, начинаем после from_ts (обычно конец контекста)."""
-    ch = get_ch()
-    rows = ch.query(
+def fetch_materials(chat_id: int, nodes: Dict[int, List[int]], raw_from_id: int) -> Tuple[List[str], List[str], List[MsgRow]]:
+    """
+    Одним запросом (UNION ALL) достаёт тексты выбранных узлов дерева
+    (nodes: уровень → id) и сырые сообщения с tg_msg_id > raw_from_id.
+    Возвращает (тексты узлов уровня 1 и выше по времени, тексты выжимок, сообщения).
+    """
+    rollup_keys = [(level, i) for level, ids in nodes.items() if level >= 2 for i in ids]
+    rows = get_ch().query(
         """
-        SELECT text, to_ts
-        FROM tg_summaries
-        WHERE from_ts > %(from_ts)s
-        ORDER BY batch_id ASC
-        """,
-        parameters={"from_ts": from_ts}
-    ).result_rows
-    return [(r[0], r[1]) for r in rows]
+        SELECT kind, id, text, ts, user_id
+        FROM
+        (
+            SELECT 0 AS kind, node_id AS id, text, from_ts AS ts, toInt64(0) AS user_id
+            FROM tg_rollups
+            WHERE chat_id = %(c)s AND has(CAST(%(r)s AS Array(Tuple(UInt8, Int64))), (level, node_id))
 
-def fetch_raw_since(from_ts: datetime, limit: int) -> List[Msg]:
-    """Хвост сырых сообщений после from_ts (лимитируем, чтобы не разбухать контекст)."""
-    ch = get_ch()
-    row = ch.query("SELECT max(tg_msg_id) FROM tg_messages").result_rows
-    last_id = int(row[0][0] or 0)
-    if last_id == 0 or limit <= 0:
-        return []
+            UNION ALL
 
-    from_id = max(0, last_id - limit)
+            SELECT 0, context_id, text, from_ts, toInt64(0)
+            FROM tg_contexts
+            WHERE chat_id = %(c)s AND has(CAST(%(x)s AS Array(Int64)), context_id)
 
-    rows = ch.query(
-        """
-        SELECT tg_msg_id, user_id, text, ts
-        FROM tg_messages
-        WHERE tg_msg_id > %(from_id)s
-          AND lengthUTF8(text) > 0
-        ORDER BY tg_msg_id ASC
+            UNION ALL
+
+            SELECT 1, batch_id, text, from_ts, toInt64(0)
+            FROM tg_summaries
+            WHERE chat_id = %(c)s AND has(CAST(%(s)s AS Array(Int64)), batch_id)
+
+            UNION ALL
+
+            SELECT 2, toInt64(tg_msg_id), text, ts, toInt64(user_id)
+            FROM tg_messages
+            WHERE chat_id = %(c)s AND tg_msg_id > %(raw_from)s AND lengthUTF8(text) > 0
+        )
+        ORDER BY kind ASC, ts ASC, id ASC
         """,
-        parameters={"from_id": from_id},
+        parameters={
+            "c": chat_id,
+            "r": rollup_keys,
+            "x": nodes.get(1, []),
+            "s": nodes.get(0, []),
+            "raw_from": raw_from_id,
+        },
     ).result_rows
-    msgs = [Msg(tg_msg_id=r[0], user_id=r[1], text=r[2], ts=r[3]) for r in rows]
-    names = load_display_names(m.user_id for m in msgs)
-    for m in msgs:
-        m.author = names.get(m.user_id, str(m.user_id))
-    return msgs
+
+    ctx_texts: List[str] = []
+    sum_texts: List[str] = []
+    raw_rows: List[tuple] = []
+    for kind, id_, text, ts, user_id in rows:
+        if kind == 0:
+            ctx_texts.append(text)
+        elif kind == 1:
+            sum_texts.append(text)
+        else:
+            raw_rows.append((id_, user_id, text, ts))
+    return ctx_texts, sum_texts, msg_rows(chat_id, raw_rows)
@@ -1,111 +1,158 @@
 from __future__ import annotations
 
-from typing import List
+from typing import Iterator, List, Optional, Tuple
 
-from . import get_ch
-from ..schemas import Msg
-from .users import load_display_names
+from . import get_ch, stream_blocks
+from ..schemas import AnyMsg, Msg, MsgRow
+from ..vectors import embed
+from .users import msg_rows
+from .search import index_messages, note_unindexed, search_messages
+from .logger import log_exception
+from .watermarks import get_watermarks
+from .tool_cache import WindowCache
+from ..configs import TOOL_WINDOW_CACHE_SIZE, TOOL_WINDOW_MAX_N
 
 
-def insert_message(m: Msg) -> None:
+window_cache = WindowCache(TOOL_WINDOW_CACHE_SIZE, TOOL_WINDOW_MAX_N)
+
+
+def insert_messages(msgs: List[Msg], dedup_token: Optional[str] = None) -> None:
+    """
+    Одна пачка — один INSERT (и один part на партицию в ClickHouse).
+    dedup_token — insert_deduplication_token: повтор той же пачки с тем же токеном
+    ClickHouse отбрасывает (tg_messages хранит окно токенов, см. миграции 2 и 5).
+    """
+    if not msgs:
+        return
     ch = get_ch()
     ch.insert(
         'tg_messages',
-        [(m.tg_msg_id, m.user_id, m.text, m.ts)],
-        column_names=['tg_msg_id','user_id','text','ts']
+        [(m.chat_id, m.tg_msg_id, m.user_id, m.text, m.ts, embed(m.text)) for m in msgs],
+        column_names=['chat_id','tg_msg_id','user_id','text','ts','embedding'],
+        settings={"insert_deduplication_token": dedup_token} if dedup_token else None,
     )
+    # Сообщения уже записаны: сбой индекса не должен приводить к повторной вставке пачки —
+    # диапазон запоминается и доиндексируется фоном (workers.search_repair_loop).
+    try:
+        index_messages(msgs)
+    except Exception:
+        log_exception(ctx=f"index_messages rows={len(msgs)}")
+        note_unindexed(msgs)
 
-def fetch_last_messages(n: int) -> List[Msg]:
+def insert_message(m: Msg) -> None:
+    insert_messages([m])
+
+def get_last_msg_id(chat_id: int) -> int:
     ch = get_ch()
-    row = ch.query("SELECT max(tg_msg_id) FROM tg_messages").result_rows
-    last_id = int(row[0][0] or 0)
-    if last_id == 0 or n <= 0:
-        return []
+    row = ch.query(
+        "SELECT max(tg_msg_id) FROM tg_messages WHERE chat_id = %(c)s",
+        parameters={"c": chat_id}
+    ).result_rows
+    return int(row[0][0] or 0)
+
+def existing_msg_ids(chat_id: int, lo: int, hi: int) -> set:
+    """tg_msg_id чата, уже записанные в [lo, hi] (tg_messages — обычный MergeTree, дубли сам не схлопнет)."""
+    rows = get_ch().query(
+        "SELECT DISTINCT tg_msg_id FROM tg_messages "
+        "WHERE chat_id = %(c)s AND tg_msg_id BETWEEN %(lo)s AND %(hi)s",
+        parameters={"c": chat_id, "lo": lo, "hi": hi},
+    ).result_rows
+    return {int(r[0]) for r in rows}
 
-    from_id = max(0, last_id - n)
+def get_max_msg_id_upto(chat_id: int, hi: int) -> int:
+    """Наибольший записанный tg_msg_id чата не больше hi (0 — таких нет)."""
+    row = get_ch().query(
+        "SELECT max(tg_msg_id) FROM tg_messages WHERE chat_id = %(c)s AND tg_msg_id <= %(hi)s",
+        parameters={"c": chat_id, "hi": hi},
+    ).result_rows
+    return int(row[0][0] or 0)
 
-    rows = ch.query(
+def _blocks_after(chat_id: int, from_id: int) -> Iterator[list]:
+    """Непустые сообщения чата с tg_msg_id > from_id блоками (tg_msg_id, user_id, text, ts)."""
+    return stream_blocks(
         """
         SELECT tg_msg_id, user_id, text, ts
         FROM tg_messages
-        WHERE tg_msg_id > %(from_id)s
-          AND lengthUTF8(text) > 0
+        WHERE chat_id = %(c)s AND tg_msg_id > %(from_id)s AND lengthUTF8(text) > 0
         ORDER BY tg_msg_id ASC
         """,
-        parameters={"from_id": from_id},
-    ).result_rows
-
-    msgs = [Msg(tg_msg_id=r[0], user_id=r[1], text=r[2], ts=r[3]) for r in rows]
-
-    names = load_display_names(m.user_id for m in msgs)
-    for m in msgs:
-        m.author = names.get(m.user_id, str(m.user_id))
-
-    return msgs
-
+        parameters={"c": chat_id, "from_id": from_id},
+    )
 
-def tool_get_messages_window(n: int = 200) -> list[dict]:
+def fetch_messages_after(chat_id: int, from_id: int) -> List[MsgRow]:
     """
-    Последние n сообщений по ОКНУ message_id: (max_id - n; max_id].
-    Возвращает в хронологическом порядке.
+    Все непустые сообщения чата с tg_msg_id > from_id (с авторами). Результат — целиком в памяти;
+    поблочное чтение лишь не держит одновременно сырые строки и MsgRow всего диапазона.
     """
-    ch = get_ch()
-    row = ch.query("SELECT max(tg_msg_id) FROM tg_messages").result_rows
-    last_id = int(row[0][0] or 0)
-    if last_id == 0 or n <= 0:
-        return []
-    from_id = max(0, last_id - n)
+    return [m for block in _blocks_after(chat_id, from_id) for m in msg_rows(chat_id, block)]
 
-    rows = ch.query(
+def fetch_tail_preview(chat_id: int, from_id: int, k: int) -> Tuple[int, List[MsgRow]]:
+    """
+    Сколько непустых сообщений после from_id и первые k из них — без выборки всего хвоста
+    (count() OVER () считается до LIMIT).
+    """
+    rows = get_ch().query(
         """
-        SELECT tg_msg_id, user_id, text, ts
+        SELECT tg_msg_id, user_id, text, ts, count() OVER () AS total
         FROM tg_messages
-        WHERE tg_msg_id > %(from_id)s AND lengthUTF8(text) > 0
+        WHERE chat_id = %(c)s AND tg_msg_id > %(from_id)s AND lengthUTF8(text) > 0
         ORDER BY tg_msg_id ASC
+        LIMIT %(k)s
         """,
-        parameters={"from_id": from_id}
+        parameters={"c": chat_id, "from_id": from_id, "k": k},
     ).result_rows
+    if not rows:
+        return 0, []
+    return int(rows[0][4]), msg_rows(chat_id, [r[:4] for r in rows])
 
-    msgs = [Msg(tg_msg_id=r[0], user_id=r[1], text=r[2], ts=r[3]) for r in rows]
-    names = load_display_names(m.user_id for m in msgs)
-    data = []
-    for m in msgs:
-        data.append({
-            "tg_msg_id": m.tg_msg_id,
-            "user_id": m.user_id,
-            "author": names.get(m.user_id, str(m.user_id)),
-            "text": m.text,
-            "ts": m.ts.isoformat() + "Z",
-        })
-    return data
-
-
-def tool_search_messages(query: str, window: int = 5000, limit: int = 50) -> list[dict]:
-    """
-    Поиск по тексту в ОКНЕ последних `window` сообщений по message_id.
-    Возвращаем самые релевантные недавние (по убыванию id).
-    """
-    ch = get_ch()
-    row = ch.query("SELECT max(tg_msg_id) FROM tg_messages").result_rows
-    last_id = int(row[0][0] or 0)
-    if last_id == 0:
+def fetch_last_messages(chat_id: int, n: int) -> List[MsgRow]:
+    last_id = get_last_msg_id(chat_id)
+    if last_id == 0 or n <= 0:
         return []
-    from_id = max(0, last_id - max(0, int(window)))
+    return fetch_messages_after(chat_id, max(0, last_id - n))
 
-    rows = ch.query(
-        """
-        SELECT tg_msg_id, user_id, text, ts
-        FROM tg_messages
-        WHERE tg_msg_id > %(from_id)s
-          AND lengthUTF8(text) > 0
-          AND positionCaseInsensitiveUTF8(text, %(q)s) > 0
-        ORDER BY tg_msg_id DESC
-        LIMIT %(lim)s
-        """,
-        parameters={"from_id": from_id, "q": query, "lim": limit}
-    ).result_rows
 
-    return [
-        {"tg_msg_id": r[0], "user_id": r[1], "text": r[2], "ts": r[3].isoformat()+"Z"}
-        for r in rows
-    ]
+def _window_record(m: AnyMsg) -> dict:
+    return {
+        "tg_msg_id": m.tg_msg_id,
+        "user_id": m.user_id,
+        "author": m.author,
+        "text": m.text,
+        "ts": m.ts.isoformat() + "Z",
+    }
+
+def tool_get_messages_window(chat_id: int, n: int = 200) -> list[dict]:
+    """
+    Последние n сообщений чата по ОКНУ message_id: (max_id - n; max_id].
+    Возвращает в хронологическом порядке. Окно кэшируется и при новых
+    сообщениях только дополняется хвостом (из памяти, если он там есть).
+    """
+    marks = get_watermarks(chat_id)
+
+    def load(n: int):
+        last_id = get_last_msg_id(chat_id)
+        if last_id == 0 or n <= 0:
+            return [], last_id
+        blocks = _blocks_after(chat_id, max(0, last_id - n))
+        return [_window_record(m) for block in blocks for m in msg_rows(chat_id, block)], last_id
+
+    def tail(after_id: int):
+        top = marks.last_msg_id
+        msgs = marks.tail_after(after_id)
+        if msgs is None:
+            items = [
+                _window_record(m) for block in _blocks_after(chat_id, after_id) for m in msg_rows(chat_id, block)
+            ]
+            return items, (items[-1]["tg_msg_id"] if items else after_id)
+        top = max([top] + [m.tg_msg_id for m in msgs])
+        return [_window_record(m) for m in msgs if m.text], top
+
+    return window_cache.get(chat_id, n, marks.last_msg_id, load, tail)
+
+
+def tool_search_messages(chat_id: int, query: str, window: int = 0, limit: int = 50) -> list[dict]:
+    """
+    Полнотекстовый поиск по индексу чата, по убыванию релевантности (BM25 + свежесть).
+    window > 0 — только последние window сообщений, 0 — вся история.
+    """
+    return search_messages(chat_id, query, limit=limit, window=max(0, int(window)))
@@ -0,0 +1,301 @@
+"""
+Версионированная схема БД: миграции применяются по порядку при старте,
+применённые записываются в schema_migrations и повторно не выполняются.
+Новая миграция — функция (ch) -> None в конце MIGRATIONS со следующим номером.
+Долгие миграции (перестройка таблиц) помечаются online: бот применяет их в фоне,
+уже принимая сообщения (см. workers.online_migrations), поэтому от них не должны
+зависеть остальные миграции и код, работающий до их завершения.
+"""
+from __future__ import annotations
+
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import datetime as dt
+import time
+
+from . import get_ch
+from .schema import create_baseline, _VIEWS
+from .logger import log_event
+from ..configs import LOG_TTL_DAYS
+
+
+def rebuild_table(ch, table: str, ddl: str, columns: List[str], key: str,
+                  chat_id_key: Optional[Tuple[str, str]] = None,
+                  after_swap: Optional[Callable] = None) -> None:
+    """
+    Перестраивает table по новой ddl (с плейсхолдером {table}), не останавливая ни чтение,
+    ни запись (бот в это время принимает сообщения):
+      1) создаёт {table}__new и копирует в неё данные INSERT ... SELECT;
+      2) запоминает, докуда скопировано;
+      3) меняет таблицы местами: EXCHANGE TABLES атомарен — читатели и писатели видят
+         либо старую, либо новую таблицу. В базе не Atomic EXCHANGE недоступен, и замена
+         идёт двумя RENAME: между ними таблицы нет, и вставки в этот миг падают — буферы
+         сообщений и логов возвращают такие пачки в очередь и повторяют;
+         затем вызывается after_swap(ch), если задан;
+      4) дописывает строки, попавшие в старую таблицу во время копирования.
+         chat_id_key = (chat_id, id): по каждому чату — с id больше скопированного максимума
+         (id в чате растут, время строки может быть и старше — его не учитываем); чаты,
+         которых при копировании не было, — целиком. Без него — все строки, чьих key нет
+         в новой таблице (для небольших таблиц и логов).
+    Старая таблица удаляется в конце.
+    """
+    tmp = f"{table}__new"
+    cols = ", ".join(columns)
+    ch.command(f"DROP TABLE IF EXISTS {tmp}")
+    ch.command(ddl.format(table=tmp))
+    ch.command(f"INSERT INTO {tmp} ({cols}) SELECT {cols} FROM {table}")
+    copied: Dict[int, int] = {}
+    if chat_id_key:
+        chat_col, id_col = chat_id_key
+        copied = {
+            int(c): int(m)
+            for c, m in ch.query(f"SELECT {chat_col}, max({id_col}) FROM {tmp} GROUP BY {chat_col}").result_rows
+        }
+    try:
+        ch.command(f"EXCHANGE TABLES {table} AND {tmp}")
+    except Exception:
+        ch.command(f"RENAME TABLE {table} TO {table}__old, {tmp} TO {table}")
+        ch.command(f"RENAME TABLE {table}__old TO {tmp}")
+    if after_swap:
+        after_swap(ch)
+
+    if chat_id_key:
+        chat_col, id_col = chat_id_key
+        chats = "CAST(%(chats)s AS Array(Int64))"
+        caught_up = (
+            f"(NOT has({chats}, {chat_col}) OR "
+            f"{id_col} > transform({chat_col}, {chats}, CAST(%(maxes)s AS Array(Int64)), toInt64(0)))"
+        )
+        ch.command(
+            f"""
+            INSERT INTO {table} ({cols})
+            SELECT {cols} FROM {tmp}
+            WHERE {caught_up}
+              AND ({key}) NOT IN (SELECT {key} FROM {table} WHERE {caught_up})
+            """,
+            parameters={"chats": list(copied) or [0], "maxes": list(copied.values()) or [0]},
+        )
+    else:
+        ch.command(
+            f"""
+            INSERT INTO {table} ({cols})
+            SELECT {cols} FROM {tmp}
+            WHERE ({key}) NOT IN (SELECT {key} FROM {table})
+            """
+        )
+    ch.command(f"DROP TABLE {tmp}")
+
+
+# Ключи сортировки — под реальные запросы: диапазоны и max() по (chat_id, id),
+# argMax по user_id, время для логов. Партиции чатовых таблиц — чат × месяц по времени
+# строки: запросы одного чата по-прежнему читают только его партиции, а старые месяцы
+# не переписываются слияниями. Логи — по месяцу: TTL сбрасывает их целиком.
+# Delta/DoubleDelta — для монотонных id и времени, ZSTD — для текстов.
+_V2_TABLES = [
+    (
+        "tg_messages",
+        """
+        CREATE TABLE {table} (
+            chat_id   Int64          CODEC(Delta, ZSTD(1)),
+            tg_msg_id Int64          CODEC(Delta, ZSTD(1)),
+            user_id   Int64          CODEC(ZSTD(1)),
+            text      String         CODEC(ZSTD(3)),
+            ts        DateTime       CODEC(DoubleDelta, ZSTD(1)),
+            embedding Array(Float32) CODEC(ZSTD(1))
+        )
+        ENGINE = MergeTree
+        PARTITION BY (chat_id, toYYYYMM(ts))
+        ORDER BY (chat_id, tg_msg_id)
+        SETTINGS non_replicated_deduplication_window = 1000
+        """,
+        ["chat_id", "tg_msg_id", "user_id", "text", "ts", "embedding"],
+        "chat_id, tg_msg_id", ("chat_id", "tg_msg_id"),
+    ),
+    (
+        "tg_summaries",
+        """
+        CREATE TABLE {table} (
+            chat_id     Int64          CODEC(Delta, ZSTD(1)),
+            batch_id    Int64          CODEC(Delta, ZSTD(1)),
+            from_msg_id Int64          CODEC(Delta, ZSTD(1)),
+            to_msg_id   Int64          CODEC(Delta, ZSTD(1)),
+            from_ts     DateTime       CODEC(DoubleDelta, ZSTD(1)),
+            to_ts       DateTime       CODEC(DoubleDelta, ZSTD(1)),
+            text        String         CODEC(ZSTD(3)),
+            tokens_in   UInt32         CODEC(T64, ZSTD(1)),
+            tokens_out  UInt32         CODEC(T64, ZSTD(1)),
+            embedding   Array(Float32) CODEC(ZSTD(1))
+        )
+        ENGINE = MergeTree
+        PARTITION BY (chat_id, toYYYYMM(to_ts))
+        ORDER BY (chat_id, batch_id)
+        """,
+        ["chat_id", "batch_id", "from_msg_id", "to_msg_id", "from_ts", "to_ts",
+         "text", "tokens_in", "tokens_out", "embedding"],
+        "chat_id, batch_id", ("chat_id", "batch_id"),
+    ),
+    (
+        "tg_contexts",
+        """
+        CREATE TABLE {table} (
+            chat_id       Int64    CODEC(Delta, ZSTD(1)),
+            context_id    Int64    CODEC(Delta, ZSTD(1)),
+            from_batch_id Int64    CODEC(Delta, ZSTD(1)),
+            to_batch_id   Int64    CODEC(Delta, ZSTD(1)),
+            from_ts       DateTime CODEC(DoubleDelta, ZSTD(1)),
+            to_ts         DateTime CODEC(DoubleDelta, ZSTD(1)),
+            text          String   CODEC(ZSTD(3)),
+            tokens_in     UInt32   CODEC(T64, ZSTD(1)),
+            tokens_out    UInt32   CODEC(T64, ZSTD(1))
+        )
+        ENGINE = MergeTree
+        PARTITION BY (chat_id, toYYYYMM(to_ts))
+        ORDER BY (chat_id, context_id)
+        """,
+        ["chat_id", "context_id", "from_batch_id", "to_batch_id", "from_ts", "to_ts",
+         "text", "tokens_in", "tokens_out"],
+        "chat_id, context_id", ("chat_id", "context_id"),
+    ),
+    (
+        # Одна строка на пользователя после слияний: побеждает самая свежая по last_seen.
+        # argMax в load_display_names остаётся корректным и до слияния.
+        "tg_users",
+        """
+        CREATE TABLE {table} (
+            user_id    Int64    CODEC(ZSTD(1)),
+            username   String   CODEC(ZSTD(1)),
+            first_name String   CODEC(ZSTD(1)),
+            last_name  String   CODEC(ZSTD(1)),
+            first_seen DateTime CODEC(ZSTD(1)),
+            last_seen  DateTime CODEC(ZSTD(1))
+        )
+        ENGINE = ReplacingMergeTree(last_seen)
+        ORDER BY user_id
+        """,
+        ["user_id", "username", "first_name", "last_name", "first_seen", "last_seen"],
+        "user_id, last_seen", None,
+    ),
+    (
+        "logs",
+        f"""
+        CREATE TABLE {{table}} (
+            event_time DateTime64(3) CODEC(DoubleDelta, ZSTD(1)),
+            meta_raw   String        CODEC(ZSTD(3))
+        )
+        ENGINE = MergeTree
+        PARTITION BY toYYYYMM(event_time)
+        ORDER BY event_time
+        TTL toDateTime(event_time) + INTERVAL {int(LOG_TTL_DAYS)} DAY
+        SETTINGS ttl_only_drop_parts = 1
+        """,
+        ["event_time", "meta_raw"],
+        "event_time, cityHash64(meta_raw)", None,
+    ),
+]
+
+
+def _create_views(ch) -> None:
+    for ddl in _VIEWS:
+        ch.command(ddl)
+
+def _tuned_tables(ch) -> None:
+    for table, ddl, columns, key, chat_id_key in _V2_TABLES:
+        after_swap = None
+        if table == "tg_messages":
+            # Представление снимается на время копирования и ставится на новую tg_messages
+            # сразу после замены: строки, записанные во время копирования, попадут в tg_activity
+            # один раз — вместе с дозаписью. Сообщения из мгновений между DDL могут не попасть.
+            ch.command("DROP VIEW IF EXISTS tg_activity_mv")
+            after_swap = _create_views
+        rebuild_table(ch, table, ddl, columns, key, chat_id_key, after_swap)
+    _create_views(ch)
+
+
+def _search_backfill_marks(ch) -> None:
+    # Отметка доиндексации истории по чату: до какого id нужно (upto) и до какого дошли (done).
+    ch.command(
+        """
+        CREATE TABLE IF NOT EXISTS tg_search_backfill (
+            chat_id     Int64,
+            upto_msg_id Int64,
+            done_msg_id Int64,
+            legacy      UInt8,
+            updated_at  DateTime64(3)
+        )
+        ENGINE = ReplacingMergeTree(updated_at)
+        ORDER BY chat_id
+        """
+    )
+
+def _search_gaps(ch) -> None:
+    # Диапазоны сообщений, записанных без индекса (сбой index_messages): done = 1 — доиндексирован.
+    ch.command(
+        """
+        CREATE TABLE IF NOT EXISTS tg_search_gaps (
+            chat_id     Int64,
+            from_msg_id Int64,
+            to_msg_id   Int64,
+            done        UInt8,
+            updated_at  DateTime64(3)
+        )
+        ENGINE = ReplacingMergeTree(updated_at)
+        ORDER BY (chat_id, from_msg_id, to_msg_id)
+        """
+    )
+
+
+def _messages_dedup_window(ch) -> None:
+    # Повтор пачки буфера вставки после неясного сбоя идёт с тем же insert_deduplication_token;
+    # у нереплицированного MergeTree дедупликация работает, только если окно токенов не нулевое.
+    # Новая tg_messages из миграции 2 создаётся уже с этой настройкой.
+    ch.command("ALTER TABLE tg_messages MODIFY SETTING non_replicated_deduplication_window = 1000")
+
+
+# (версия, имя, функция, online)
+MIGRATIONS: List[Tuple[int, str, Callable, bool]] = [
+    (1, "baseline", create_baseline, False),
+    (2, "tuned_tables", _tuned_tables, True),
+    (3, "search_backfill_marks", _search_backfill_marks, False),
+    (4, "search_gaps", _search_gaps, False),
+    (5, "messages_dedup_window", _messages_dedup_window, False),
+]
+
+
+def _applied(ch) -> Set[int]:
+    ch.command(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version    UInt32,
+            name       String,
+            applied_at DateTime,
+            elapsed_ms UInt64
+        )
+        ENGINE = MergeTree
+        ORDER BY version
+        """
+    )
+    return {int(r[0]) for r in ch.query("SELECT version FROM schema_migrations").result_rows}
+
+def apply_migrations(skip_online: bool = False) -> List[int]:
+    """
+    Применяет недостающие миграции по возрастанию версии; возвращает применённые сейчас.
+    skip_online — только быстрые, online оставить фону (старт бота).
+    Упавшая миграция не записывается и будет повторена при следующем старте,
+    поэтому каждая должна быть идемпотентной.
+    """
+    ch = get_ch()
+    done = _applied(ch)
+    applied: List[int] = []
+    for version, name, fn, online in MIGRATIONS:
+        if version in done or (online and skip_online):
+            continue
+        t0 = time.perf_counter()
+        fn(ch)
+        elapsed_ms = int((time.perf_counter() - t0) * 1000)
+        ch.insert(
+            "schema_migrations",
+            [(version, name, dt.datetime.now(dt.timezone.utc), elapsed_ms)],
+            column_names=["version", "name", "applied_at", "elapsed_ms"],
+        )
+        log_event({"type": "db.migration", "version": version, "name": name, "elapsed_ms": elapsed_ms})
+        applied.append(version)
+    return applied
@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+from typing import Dict, List, Tuple
+import datetime as dt
+
+from . import get_ch
+from .summaries import fetch_summaries_after
+from .contexts import fetch_contexts_after, get_last_context_batch_id
+
+Node = Tuple[int, str, dt.datetime, dt.datetime]
+
+
+def get_rollup_marks(chat_id: int) -> Dict[int, int]:
+    """
+    Докуда свёрнут каждый уровень: {L: последний id узла уровня L-1, вошедший в узел уровня L}.
+    Уровень 1 — контексты, 2 и выше — tg_rollups. Одним запросом по tg_rollups.
+    """
+    rows = get_ch().query(
+        "SELECT level, max(to_child) FROM tg_rollups WHERE chat_id = %(c)s GROUP BY level",
+        parameters={"c": chat_id}
+    ).result_rows
+    marks = {int(level): int(to or 0) for level, to in rows}
+    marks[1] = get_last_context_batch_id(chat_id)
+    return marks
+
+def fetch_rollups_after(chat_id: int, level: int, node_id: int, k: int) -> List[Node]:
+    """До k узлов уровня level (>= 2) с node_id > node_id: [(node_id, text, from_ts, to_ts)] по возрастанию."""
+    rows = get_ch().query(
+        """
+        SELECT node_id, text, from_ts, to_ts
+        FROM tg_rollups
+        WHERE chat_id = %(c)s AND level = %(l)s AND node_id > %(x)s
+        ORDER BY node_id ASC
+        LIMIT %(k)s
+        """,
+        parameters={"c": chat_id, "l": level, "x": node_id, "k": k}
+    ).result_rows
+    return [tuple(r) for r in rows]
+
+def fetch_nodes_after(chat_id: int, level: int, node_id: int, k: int) -> List[Node]:
+    """Узлы любого уровня дерева: 0 — выжимки, 1 — контексты, 2+ — tg_rollups."""
+    if level == 0:
+        return fetch_summaries_after(chat_id, node_id, k)
+    if level == 1:
+        return fetch_contexts_after(chat_id, node_id, k)
+    return fetch_rollups_after(chat_id, level, node_id, k)
+
+def insert_rollup(chat_id: int, level: int, children: List[Node], text: str, ti: int, to: int) -> int:
+    """
+    Узел уровня level (>= 2) над children (узлы уровня level-1 по возрастанию).
+    node_id — id последнего ребёнка: уникален в пределах уровня и растёт вместе с ним.
+    """
+    node_id = children[-1][0]
+    get_ch().insert(
+        'tg_rollups',
+        [(chat_id,
+          level,
+          node_id,
+          children[0][0],
+          children[-1][0],
+          children[0][2],
+          children[-1][3],
+          text,
+          ti,
+          to)],
+        column_names=[
+            'chat_id',
+            'level',
+            'node_id',
+            'from_child',
+            'to_child',
+            'from_ts',
+            'to_ts',
+            'text',
+            'tokens_in',
+            'tokens_out'
+        ]
+    )
+    return node_id
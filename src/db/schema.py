@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+from ..configs import ALLOWED_CHAT_IDS, LEGACY_CHAT_ID
+
+
+# Исходная схема (миграция 1). Дальнейшие изменения таблиц — только новыми миграциями
+# в migrations.py; там же актуальные движки, партиции и кодеки.
+# chat_id — первый столбец ключа и ключ партиционирования: запросы одного чата
+# читают только его партиции и диапазон первичного ключа. Здесь партиция — чат целиком;
+# миграция 2 делит партиции чатовых таблиц ещё и по месяцам, (chat_id, toYYYYMM(...)).
+# Дерево сжатия: уровень 0 — tg_summaries (N сообщений), 1 — tg_contexts (K выжимок),
+# 2 и выше — tg_rollups, где узел уровня L сворачивает K узлов уровня L-1
+# (from_child/to_child — id узлов уровня ниже).
+_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS tg_messages (
+        chat_id   Int64,
+        tg_msg_id Int64,
+        user_id   Int64,
+        text      String,
+        ts        DateTime,
+        embedding Array(Float32)
+    )
+    ENGINE = MergeTree
+    PARTITION BY chat_id
+    ORDER BY (chat_id, tg_msg_id)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tg_summaries (
+        chat_id     Int64,
+        batch_id    Int64,
+        from_msg_id Int64,
+        to_msg_id   Int64,
+        from_ts     DateTime,
+        to_ts       DateTime,
+        text        String,
+        tokens_in   UInt32,
+        tokens_out  UInt32,
+        embedding   Array(Float32)
+    )
+    ENGINE = MergeTree
+    PARTITION BY chat_id
+    ORDER BY (chat_id, batch_id)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tg_contexts (
+        chat_id       Int64,
+        context_id    Int64,
+        from_batch_id Int64,
+        to_batch_id   Int64,
+        from_ts       DateTime,
+        to_ts         DateTime,
+        text          String,
+        tokens_in     UInt32,
+        tokens_out    UInt32
+    )
+    ENGINE = MergeTree
+    PARTITION BY chat_id
+    ORDER BY (chat_id, context_id)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tg_rollups (
+        chat_id    Int64,
+        level      UInt8,
+        node_id    Int64,
+        from_child Int64,
+        to_child   Int64,
+        from_ts    DateTime,
+        to_ts      DateTime,
+        text       String,
+        tokens_in  UInt32,
+        tokens_out UInt32
+    )
+    ENGINE = MergeTree
+    PARTITION BY chat_id
+    ORDER BY (chat_id, level, node_id)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tg_users (
+        user_id    Int64,
+        username   String,
+        first_name String,
+        last_name  String,
+        first_seen DateTime,
+        last_seen  DateTime
+    )
+    ENGINE = MergeTree
+    ORDER BY (user_id, last_seen)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tg_search_postings (
+        chat_id   Int64,
+        term      String,
+        tg_msg_id Int64,
+        tf        UInt16,
+        doc_len   UInt16
+    )
+    ENGINE = MergeTree
+    PARTITION BY chat_id
+    ORDER BY (chat_id, term, tg_msg_id)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tg_search_stats (
+        chat_id   Int64,
+        docs      UInt64,
+        total_len UInt64
+    )
+    ENGINE = SummingMergeTree
+    ORDER BY chat_id
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tg_activity (
+        chat_id  Int64,
+        day      Date,
+        hour     UInt8,
+        user_id  Int64,
+        messages SimpleAggregateFunction(sum, UInt64),
+        chars    SimpleAggregateFunction(sum, UInt64)
+    )
+    ENGINE = AggregatingMergeTree
+    PARTITION BY chat_id
+    ORDER BY (chat_id, day, hour, user_id)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS logs (
+        event_time DateTime64(3),
+        meta_raw   String
+    )
+    ENGINE = MergeTree
+    ORDER BY event_time
+    """,
+]
+
+# Агрегаты активности (UTC) считаются при вставке в tg_messages — читать их дёшево при любой истории.
+_ACTIVITY_SELECT = """
+    SELECT chat_id, toDate(ts) AS day, toHour(ts) AS hour, user_id,
+           toUInt64(count()) AS messages, toUInt64(sum(lengthUTF8(text))) AS chars
+    FROM tg_messages
+    GROUP BY chat_id, day, hour, user_id
+"""
+_VIEWS = [
+    "CREATE MATERIALIZED VIEW IF NOT EXISTS tg_activity_mv TO tg_activity AS" + _ACTIVITY_SELECT,
+]
+
+_CHAT_SCOPED = ("tg_messages", "tg_summaries", "tg_contexts")
+_EMBEDDED = ("tg_messages", "tg_summaries")
+
+
+def _legacy_chat_id() -> int:
+    if LEGACY_CHAT_ID:
+        return LEGACY_CHAT_ID
+    if len(ALLOWED_CHAT_IDS) == 1:
+        return next(iter(ALLOWED_CHAT_IDS))
+    return 0
+
+def create_baseline(ch) -> None:
+    """
+    Миграция 1 (см. migrations.py): создаёт недостающие таблицы. В таблицах, созданных до появления чатов,
+    добавляет столбец chat_id со значением по умолчанию LEGACY_CHAT_ID
+    (или единственного чата из ALLOWED_CHAT_IDS) — старые строки сразу видны этому чату.
+    Ключ сортировки таких таблиц при этом не меняется.
+    Материализованные представления создаются после таблиц, история в них переносится один раз.
+    """
+    for ddl in _TABLES:
+        ch.command(ddl)
+    legacy = _legacy_chat_id()
+    for table in _CHAT_SCOPED:
+        ch.command(
+            f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS chat_id Int64 DEFAULT {int(legacy)} FIRST"
+        )
+    for table in _EMBEDDED:
+        ch.command(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS embedding Array(Float32)")
+    for ddl in _VIEWS:
+        ch.command(ddl)
+    _backfill_activity(ch)
+
+def _backfill_activity(ch) -> None:
+    """
+    Представление видит только новые вставки: историю, накопленную до его появления,
+    переносим один раз, пока tg_activity пуста (до старта приёма сообщений).
+    """
+    if ch.query("SELECT count() FROM tg_activity").result_rows[0][0]:
+        return
+    ch.command("INSERT INTO tg_activity" + _ACTIVITY_SELECT)
@@ -0,0 +1,282 @@
+from __future__ import annotations
+
+from collections import Counter
+from typing import Dict, Iterable, List, Sequence, Set, Tuple
+import datetime as dt
+import re
+import threading
+
+from . import get_ch, stream_blocks
+from ..schemas import AnyMsg, MsgRow
+from ..configs import (
+    SEARCH_STEM_LEN, SEARCH_RECENCY_WEIGHT, SEARCH_RECENCY_HALFLIFE, SEARCH_BACKFILL_CHUNK
+)
+from .users import load_display_names
+from .watermarks import get_watermarks
+
+
+# Инвертированный индекс в ClickHouse: tg_search_postings (chat_id, term, tg_msg_id) → tf, doc_len
+# и tg_search_stats (SummingMergeTree) с числом документов и суммарной длиной по чату.
+# Пополняется в insert_messages той же пачкой, что и tg_messages.
+
+_TOKEN = re.compile(r"\w{2,}", re.UNICODE)
+_BM25_K1 = 1.2
+_BM25_B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Нижний регистр, ё→е, слова от 2 символов, усечение до SEARCH_STEM_LEN символов —
+    грубый стемминг, чтобы «проекта» и «проект» давали один терм.
+    """
+    text = text.lower().replace("ё", "е")
+    return [t[:SEARCH_STEM_LEN] for t in _TOKEN.findall(text)]
+
+def _index_rows(msgs: Iterable[AnyMsg]) -> Tuple[list, list]:
+    postings = []
+    stats: Dict[int, List[int]] = {}
+    for m in msgs:
+        terms = tokenize(m.text)
+        if not terms:
+            continue
+        doc_len = min(len(terms), 65535)
+        for term, tf in Counter(terms).items():
+            postings.append((m.chat_id, term, m.tg_msg_id, min(tf, 65535), doc_len))
+        s = stats.setdefault(m.chat_id, [0, 0])
+        s[0] += 1
+        s[1] += doc_len
+    return postings, [(c, d, l) for c, (d, l) in stats.items()]
+
+def index_messages(msgs: Sequence[AnyMsg]) -> None:
+    postings, stats = _index_rows(msgs)
+    if not postings:
+        return
+    ch = get_ch()
+    ch.insert(
+        'tg_search_postings', postings,
+        column_names=['chat_id', 'term', 'tg_msg_id', 'tf', 'doc_len']
+    )
+    ch.insert('tg_search_stats', stats, column_names=['chat_id', 'docs', 'total_len'])
+
+
+def search_messages(chat_id: int, query: str, limit: int = 50, window: int = 0) -> List[dict]:
+    """
+    BM25 по индексу с бустом свежести: score * (1 + w * 2^(-(last_id - id) / halflife)).
+    window > 0 ограничивает поиск последними window сообщениями, 0 — вся история чата.
+    Пустой список терминов (запрос из одних коротких слов) — подстрочный поиск по окну.
+    """
+    terms = sorted(set(tokenize(query)))
+    if not terms:
+        return _substring_search(chat_id, query, window or 5000, limit)
+
+    last_id = get_watermarks(chat_id).last_msg_id
+    from_id = max(0, last_id - window) if window > 0 else 0
+    ch = get_ch()
+    scored = ch.query(
+        """
+        SELECT
+          p.tg_msg_id AS id,
+          sum(
+            d.idf * p.tf * (%(k1)s + 1)
+            / (p.tf + %(k1)s * (1 - %(b)s + %(b)s * p.doc_len / (
+                (SELECT sum(total_len) FROM tg_search_stats WHERE chat_id = %(c)s)
+                / greatest((SELECT sum(docs) FROM tg_search_stats WHERE chat_id = %(c)s), 1)
+              )))
+          ) AS bm25,
+          bm25 * (1 + %(rw)s * exp2(-greatest(%(last)s - id, 0) / %(half)s)) AS score
+        FROM tg_search_postings AS p
+        INNER JOIN
+        (
+            SELECT term,
+                   log(1 + ((SELECT sum(docs) FROM tg_search_stats WHERE chat_id = %(c)s) - count() + 0.5)
+                           / (count() + 0.5)) AS idf
+            FROM tg_search_postings
+            WHERE chat_id = %(c)s AND term IN %(terms)s
+            GROUP BY term
+        ) AS d ON p.term = d.term
+        WHERE p.chat_id = %(c)s AND p.term IN %(terms)s AND p.tg_msg_id > %(from_id)s
+        GROUP BY id
+        ORDER BY score DESC
+        LIMIT %(lim)s
+        """,
+        parameters={
+            "c": chat_id, "terms": terms, "from_id": from_id, "lim": limit,
+            "k1": _BM25_K1, "b": _BM25_B,
+            "rw": SEARCH_RECENCY_WEIGHT, "half": SEARCH_RECENCY_HALFLIFE, "last": last_id,
+        },
+    ).result_rows
+    if not scored:
+        return []
+
+    scores = {int(r[0]): float(r[2]) for r in scored}
+    rows = ch.query(
+        """
+        SELECT tg_msg_id, user_id, text, ts
+        FROM tg_messages
+        WHERE chat_id = %(c)s AND tg_msg_id IN %(ids)s
+        """,
+        parameters={"c": chat_id, "ids": list(scores)},
+    ).result_rows
+    rows.sort(key=lambda r: scores[int(r[0])], reverse=True)
+    names = load_display_names(r[1] for r in rows)
+    return [
+        {
+            "tg_msg_id": r[0],
+            "user_id": r[1],
+            "author": names.get(r[1], str(r[1])),
+            "text": r[2],
+            "ts": r[3].isoformat() + "Z",
+            "score": round(scores[int(r[0])], 3),
+        }
+        for r in rows
+    ]
+
+def _substring_search(chat_id: int, query: str, window: int, limit: int) -> List[dict]:
+    ch = get_ch()
+    last_id = get_watermarks(chat_id).last_msg_id
+    if last_id == 0:
+        return []
+    rows = ch.query(
+        """
+        SELECT tg_msg_id, user_id, text, ts
+        FROM tg_messages
+        WHERE chat_id = %(c)s
+          AND tg_msg_id > %(from_id)s
+          AND lengthUTF8(text) > 0
+          AND positionCaseInsensitiveUTF8(text, %(q)s) > 0
+        ORDER BY tg_msg_id DESC
+        LIMIT %(lim)s
+        """,
+        parameters={"c": chat_id, "from_id": max(0, last_id - max(0, int(window))), "q": query, "lim": limit}
+    ).result_rows
+    return [
+        {"tg_msg_id": r[0], "user_id": r[1], "text": r[2], "ts": r[3].isoformat()+"Z"}
+        for r in rows
+    ]
+
+
+def _save_backfill_mark(chat_id: int, upto_id: int, done_id: int, legacy: bool) -> None:
+    get_ch().insert(
+        "tg_search_backfill", [(chat_id, upto_id, done_id, int(legacy), dt.datetime.now(dt.timezone.utc))],
+        column_names=["chat_id", "upto_msg_id", "done_msg_id", "legacy", "updated_at"],
+    )
+
+def search_backfill_bound(chat_id: int) -> Tuple[int, int, bool]:
+    """
+    Что осталось доиндексировать из истории, записанной до появления индекса:
+    (after_id, upto_id, legacy). Отметка чата (tg_search_backfill) ставится при первом вызове:
+    upto — max(tg_msg_id) на этот момент, дальше сообщения индексирует путь вставки;
+    после каждой порции отметка сдвигается, и перезапуск продолжает с неё.
+    legacy — индекс чата уже был непустым, когда ставилась отметка: проиндексированные
+    сообщения могут быть где угодно до upto, и каждую порцию надо сверять с индексом.
+    upto_id == 0 — доиндексировать нечего. Вызывать до начала приёма сообщений.
+    """
+    ch = get_ch()
+    mark = ch.query(
+        "SELECT upto_msg_id, done_msg_id, legacy FROM tg_search_backfill FINAL WHERE chat_id = %(c)s",
+        parameters={"c": chat_id}
+    ).result_rows
+    if mark:
+        upto, done, legacy = int(mark[0][0]), int(mark[0][1]), bool(mark[0][2])
+        return (done, upto, legacy) if done < upto else (0, 0, False)
+    row = ch.query(
+        """
+        SELECT
+          (SELECT count() FROM tg_search_stats WHERE chat_id = %(c)s),
+          (SELECT max(tg_msg_id) FROM tg_messages WHERE chat_id = %(c)s)
+        """,
+        parameters={"c": chat_id}
+    ).result_rows[0]
+    upto, legacy = int(row[1] or 0), bool(row[0])
+    _save_backfill_mark(chat_id, upto, 0, legacy)
+    return (0, upto, legacy) if upto else (0, 0, False)
+
+def _indexed_ids(chat_id: int, lo: int, hi: int) -> set:
+    rows = get_ch().query(
+        "SELECT DISTINCT tg_msg_id FROM tg_search_postings "
+        "WHERE chat_id = %(c)s AND tg_msg_id BETWEEN %(lo)s AND %(hi)s",
+        parameters={"c": chat_id, "lo": lo, "hi": hi},
+    ).result_rows
+    return {int(r[0]) for r in rows}
+
+def _index_range(chat_id: int, after_id: int, upto_id: int, limit: int, dedupe: bool) -> Tuple[int, int]:
+    """
+    Индексирует до limit сообщений чата с id в (after_id, upto_id] поблочно: в памяти один блок
+    и его постинги. dedupe — пропустить уже проиндексированные. Возвращает (прочитано, последний id).
+    """
+    seen, last = 0, after_id
+    for block in stream_blocks(
+        """
+        SELECT tg_msg_id, user_id, text, ts
+        FROM tg_messages
+        WHERE chat_id = %(c)s AND tg_msg_id > %(a)s AND tg_msg_id <= %(u)s AND lengthUTF8(text) > 0
+        ORDER BY tg_msg_id ASC
+        LIMIT %(lim)s
+        """,
+        parameters={"c": chat_id, "a": after_id, "u": upto_id, "lim": limit},
+    ):
+        known = _indexed_ids(chat_id, block[0][0], block[-1][0]) if dedupe else ()
+        index_messages([MsgRow(chat_id, r[0], r[1], r[2], r[3]) for r in block if r[0] not in known])
+        seen += len(block)
+        last = int(block[-1][0])
+    return seen, last
+
+def backfill_search_index(chat_id: int, upto_id: int, after_id: int = 0,
+                          dedupe: bool = False, legacy: bool = False) -> int:
+    """
+    Индексирует одну порцию (SEARCH_BACKFILL_CHUNK сообщений) истории чата с id в (after_id, upto_id]
+    и сдвигает отметку доиндексации. dedupe — пропустить уже проиндексированные сообщения
+    (legacy-чат или первая порция после перезапуска или сбоя: она могла проиндексироваться до него).
+    Возвращает id последнего проиндексированного сообщения или upto_id, если история кончилась.
+    """
+    seen, last = _index_range(chat_id, after_id, upto_id, SEARCH_BACKFILL_CHUNK, dedupe)
+    done = last if seen == SEARCH_BACKFILL_CHUNK else upto_id
+    _save_backfill_mark(chat_id, upto_id, done, legacy)
+    return done
+
+
+# Пачки, записанные в tg_messages без индекса: (chat_id, from_id, to_id). В памяти — до доиндексации,
+# в tg_search_gaps — чтобы пережить перезапуск (если в момент сбоя запись туда тоже удалась).
+_gaps: Set[Tuple[int, int, int]] = set()
+_gaps_lock = threading.Lock()
+
+def _save_gaps(gaps: Iterable[Tuple[int, int, int]], done: bool) -> None:
+    now = dt.datetime.now(dt.timezone.utc)
+    get_ch().insert(
+        "tg_search_gaps", [(c, lo, hi, int(done), now) for c, lo, hi in gaps],
+        column_names=["chat_id", "from_msg_id", "to_msg_id", "done", "updated_at"],
+    )
+
+def note_unindexed(msgs: Sequence[AnyMsg]) -> None:
+    """Запоминает диапазоны id пачки, которую не удалось проиндексировать (никогда не бросает)."""
+    spans: Dict[int, List[int]] = {}
+    for m in msgs:
+        s = spans.setdefault(m.chat_id, [m.tg_msg_id, m.tg_msg_id])
+        s[0] = min(s[0], m.tg_msg_id)
+        s[1] = max(s[1], m.tg_msg_id)
+    gaps = [(c, lo, hi) for c, (lo, hi) in spans.items()]
+    with _gaps_lock:
+        _gaps.update(gaps)
+    try:
+        _save_gaps(gaps, done=False)
+    except Exception:
+        pass  # останется только в памяти
+
+def pending_search_gaps() -> List[Tuple[int, int, int]]:
+    """Недоиндексированные диапазоны: из tg_search_gaps и ещё не сохранённые туда."""
+    rows = get_ch().query(
+        "SELECT chat_id, from_msg_id, to_msg_id FROM tg_search_gaps FINAL WHERE done = 0"
+    ).result_rows
+    with _gaps_lock:
+        _gaps.update((int(r[0]), int(r[1]), int(r[2])) for r in rows)
+        return sorted(_gaps)
+
+def repair_search_gap(chat_id: int, from_id: int, to_id: int) -> None:
+    """
+    Доиндексирует диапазон [from_id, to_id] со сверкой по индексу (часть пачки могла попасть
+    в него до сбоя) и отмечает его сделанным.
+    """
+    _index_range(chat_id, from_id - 1, to_id, to_id - from_id + 1, dedupe=True)
+    _save_gaps([(chat_id, from_id, to_id)], done=True)
+    with _gaps_lock:
+        _gaps.discard((chat_id, from_id, to_id))
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+from typing import List
+
+from . import get_ch
+from ..vectors import embed
+from .users import load_display_names
+
+
+def tool_semantic_search(chat_id: int, query: str, limit: int = 20) -> List[dict]:
+    """
+    Поиск по смыслу: косинусная близость локальных векторов (см. vectors.embed)
+    среди сообщений и выжимок чата. Строки без вектора (записанные до появления столбца) пропускаются.
+    """
+    vec = embed(query)
+    if not vec:
+        return []
+    rows = get_ch().query(
+        """
+        SELECT kind, id, user_id, text, from_ts, to_ts, dist
+        FROM
+        (
+            SELECT * FROM (
+                SELECT 'message' AS kind, toInt64(tg_msg_id) AS id, toInt64(user_id) AS user_id, text,
+                       ts AS from_ts, ts AS to_ts,
+                       cosineDistance(embedding, CAST(%(v)s AS Array(Float32))) AS dist
+                FROM tg_messages
+                WHERE chat_id = %(c)s AND notEmpty(embedding)
+                ORDER BY dist ASC
+                LIMIT %(lim)s
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT 'summary' AS kind, toInt64(batch_id) AS id, toInt64(0) AS user_id, text,
+                       from_ts, to_ts,
+                       cosineDistance(embedding, CAST(%(v)s AS Array(Float32))) AS dist
+                FROM tg_summaries
+                WHERE chat_id = %(c)s AND notEmpty(embedding)
+                ORDER BY dist ASC
+                LIMIT %(lim)s
+            )
+        )
+        ORDER BY dist ASC
+        LIMIT %(lim)s
+        """,
+        parameters={"c": chat_id, "v": vec, "lim": limit},
+    ).result_rows
+
+    names = load_display_names(r[2] for r in rows if r[0] == "message")
+    out = []
+    for kind, id_, user_id, text, from_ts, to_ts, dist in rows:
+        item = {"kind": kind, "similarity": round(1.0 - float(dist), 3), "text": text}
+        if kind == "message":
+            item.update({
+                "tg_msg_id": id_,
+                "author": names.get(user_id, str(user_id)),
+                "ts": from_ts.isoformat() + "Z",
+            })
+        else:
+            item.update({
+                "batch_id": id_,
+                "from_ts": from_ts.isoformat() + "Z",
+                "to_ts": to_ts.isoformat() + "Z",
+            })
+        out.append(item)
+    return out
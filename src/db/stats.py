@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+from typing import Any, Dict, List
+import datetime as dt
+
+from . import get_ch
+from .users import load_display_names
+from ..configs import STATS_DEFAULT_DAYS, STATS_TOP_USERS
+
+
+def get_stats(chat_id: int, days: int = STATS_DEFAULT_DAYS, top: int = STATS_TOP_USERS) -> Dict[str, Any]:
+    """
+    Активность чата за последние days суток (UTC, включая сегодня) из агрегатов tg_activity:
+    итоги, топ-top авторов, сообщения по дням и по часам суток.
+    Один запрос (UNION ALL трёх срезов), сырые сообщения не читаются.
+    """
+    days = max(1, int(days))
+    since = dt.datetime.now(dt.timezone.utc).date() - dt.timedelta(days=days - 1)
+    rows = get_ch().query(
+        """
+        SELECT kind, key, messages, chars
+        FROM
+        (
+            SELECT 0 AS kind, user_id AS key, sum(messages) AS messages, sum(chars) AS chars
+            FROM tg_activity
+            WHERE chat_id = %(c)s AND day >= %(since)s
+            GROUP BY user_id
+
+            UNION ALL
+
+            SELECT 1, toInt64(toYYYYMMDD(day)), sum(messages), sum(chars)
+            FROM tg_activity
+            WHERE chat_id = %(c)s AND day >= %(since)s
+            GROUP BY day
+
+            UNION ALL
+
+            SELECT 2, toInt64(hour), sum(messages), sum(chars)
+            FROM tg_activity
+            WHERE chat_id = %(c)s AND day >= %(since)s
+            GROUP BY hour
+        )
+        ORDER BY kind ASC, key ASC
+        """,
+        parameters={"c": chat_id, "since": since},
+    ).result_rows
+
+    users: List[tuple] = []
+    by_day: List[Dict[str, Any]] = []
+    by_hour = [0] * 24
+    for kind, key, messages, chars in rows:
+        if kind == 0:
+            users.append((int(key), int(messages), int(chars)))
+        elif kind == 1:
+            day = dt.date(key // 10000, key // 100 % 100, key % 100)
+            by_day.append({"day": day.isoformat(), "messages": int(messages), "chars": int(chars)})
+        else:
+            by_hour[int(key)] = int(messages)
+
+    users.sort(key=lambda u: (-u[1], u[0]))
+    names = load_display_names(u[0] for u in users[:top])
+    return {
+        "since": since.isoformat(),
+        "days": days,
+        "messages": sum(u[1] for u in users),
+        "chars": sum(u[2] for u in users),
+        "active_users": len(users),
+        "top_users": [
+            {"user_id": uid, "author": names.get(uid, str(uid)), "messages": msgs, "chars": chars}
+            for uid, msgs, chars in users[:top]
+        ],
+        "by_day": by_day,
+        "by_hour_utc": by_hour,
+    }
+
+def tool_get_stats(chat_id: int, days: int = STATS_DEFAULT_DAYS, top: int = STATS_TOP_USERS) -> list[dict]:
+    """get_stats для /b — одной записью, как и остальные инструменты, списком."""
+    return [get_stats(chat_id, days=days, top=top)]
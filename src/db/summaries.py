@@ -1,49 +1,130 @@
 from __future__ import annotations
 
-from typing import List
+from typing import List, Sequence, Tuple
+import datetime as dt
 
-from . import get_ch
-from ..schemas import Msg
-from .users import load_display_names
-from ..configs import N
+from . import get_ch, stream_rows
+from ..schemas import AnyMsg, MsgRow
+from ..vectors import embed
+from .users import msg_rows
+from .watermarks import note_summary, get_watermarks
+from .tool_cache import RingCache
+from ..configs import N, TOOL_RING_SIZE
 
 
-def get_last_summarized_msg_id() -> int:
+summary_ring = RingCache(TOOL_RING_SIZE)
+
+
+def get_last_summarized_msg_id(chat_id: int) -> int:
     ch = get_ch()
-    r = ch.query("SELECT max(to_msg_id) FROM tg_summaries").result_rows
+    r = ch.query(
+        "SELECT max(to_msg_id) FROM tg_summaries WHERE chat_id = %(c)s",
+        parameters={'c': chat_id}
+    ).result_rows
+    return int(r[0][0] or 0)
+
+def count_messages_after(chat_id: int, last_to: int) -> int:
+    ch = get_ch()
+    r = ch.query(
+        "SELECT count() FROM tg_messages "
+        "WHERE chat_id = %(c)s AND tg_msg_id > %(x)s AND lengthUTF8(text) > 0",
+        parameters={'c': chat_id, 'x': last_to}
+    ).result_rows
     return int(r[0][0] or 0)
 
-def get_next_batch(last_to: int, limit: int) -> List[Msg]:
+def get_next_batch(chat_id: int, last_to: int, limit: int) -> List[MsgRow]:
     ch = get_ch()
     rows = ch.query(
         """
         SELECT tg_msg_id, user_id, text, ts
         FROM tg_messages
-        WHERE tg_msg_id > %(x)s AND lengthUTF8(text) > 0
+        WHERE chat_id = %(c)s AND tg_msg_id > %(x)s AND lengthUTF8(text) > 0
+        ORDER BY tg_msg_id ASC
+        LIMIT %(lim)s
+        """,
+        parameters={'c': chat_id, 'x': last_to, 'lim': limit}
+    ).result_rows
+    return msg_rows(chat_id, rows)
+
+def get_next_batches(chat_id: int, last_to: int, size: int, count: int, upto_id: int = 0) -> List[List[MsgRow]]:
+    """
+    До count полных батчей по size сообщений после last_to — одним потоковым запросом
+    вместо count запросов get_next_batch. Строки режутся на батчи по мере чтения,
+    неполный хвост отбрасывается. upto_id > 0 — только сообщения с id <= upto_id (диапазон
+    закрыт, ждать нечего): хвост короче size дописывается к последнему батчу (до 2*size - 1
+    сообщений), а если весь остаток короче size — отдаётся одним неполным батчем.
+    Чтобы хвост не остался без батча, читается на один батч больше и, пока диапазон
+    не кончился, лишний батч не отдаётся (его перечитает следующий вызов).
+    """
+    batches: List[List[MsgRow]] = []
+    chunk: list = []
+    limit = size * (count + 1) if upto_id else size * count
+    seen = 0
+    for row in stream_rows(
+        """
+        SELECT tg_msg_id, user_id, text, ts
+        FROM tg_messages
+        WHERE chat_id = %(c)s AND tg_msg_id > %(x)s AND lengthUTF8(text) > 0
+          AND (%(u)s = 0 OR tg_msg_id <= %(u)s)
         ORDER BY tg_msg_id ASC
         LIMIT %(lim)s
         """,
-        parameters={'x': last_to, 'lim': limit}
+        parameters={'c': chat_id, 'x': last_to, 'u': upto_id, 'lim': limit},
+    ):
+        seen += 1
+        chunk.append(row)
+        if len(chunk) == size:
+            batches.append(msg_rows(chat_id, chunk))
+            chunk = []
+    if not upto_id:
+        return batches
+    if seen == limit:
+        return batches[:count]
+    if chunk:
+        if batches:
+            batches[-1].extend(msg_rows(chat_id, chunk))
+        else:
+            batches.append(msg_rows(chat_id, chunk))
+    return batches
+
+def get_summarized_spans(chat_id: int, lo: int, hi: int) -> List[Tuple[int, int]]:
+    """(from_msg_id, to_msg_id) выжимок чата, пересекающих [lo, hi], по возрастанию."""
+    rows = get_ch().query(
+        """
+        SELECT from_msg_id, to_msg_id
+        FROM tg_summaries
+        WHERE chat_id = %(c)s AND to_msg_id >= %(lo)s AND from_msg_id <= %(hi)s
+        ORDER BY from_msg_id
+        """,
+        parameters={'c': chat_id, 'lo': lo, 'hi': hi},
     ).result_rows
-    msgs = [Msg(tg_msg_id=r[0], user_id=r[1], text=r[2], ts=r[3]) for r in rows]
-    names = load_display_names(m.user_id for m in msgs)
-    for m in msgs:
-        m.author = names.get(m.user_id, str(m.user_id))
-    return msgs
+    return [(int(a), int(b)) for a, b in rows]
 
-def insert_summary(batch_id: int, msgs: List[Msg], text: str, tokens_in: int, tokens_out: int) -> None:
+def get_summary_batch_ids(chat_id: int, lo: int, hi: int) -> set:
+    """batch_id выжимок чата в [lo, hi]."""
+    rows = get_ch().query(
+        "SELECT DISTINCT batch_id FROM tg_summaries "
+        "WHERE chat_id = %(c)s AND batch_id BETWEEN %(lo)s AND %(hi)s",
+        parameters={'c': chat_id, 'lo': lo, 'hi': hi},
+    ).result_rows
+    return {int(r[0]) for r in rows}
+
+def insert_summary(chat_id: int, batch_id: int, msgs: Sequence[AnyMsg], text: str, tokens_in: int, tokens_out: int) -> None:
     ch = get_ch()
     ch.insert(
         'tg_summaries',
-        [(batch_id,
+        [(chat_id,
+          batch_id,
           msgs[0].tg_msg_id,
           msgs[-1].tg_msg_id,
           msgs[0].ts,
           msgs[-1].ts,
           text,
           tokens_in,
-          tokens_out)],
+          tokens_out,
+          embed(text))],
         column_names=[
+            'chat_id',
             'batch_id',
             'from_msg_id',
             'to_msg_id',
@@ -51,42 +132,64 @@ def insert_summary(batch_id: int, msgs: List[Msg], text: str, tokens_in: int, to
             'to_ts',
             'text',
             'tokens_in',
-            'tokens_out'
+            'tokens_out',
+            'embedding'
         ]
     )
+    summary_ring.append(chat_id, batch_id, _summary_record(batch_id, msgs[0].ts, msgs[-1].ts, text))
+    note_summary(chat_id, batch_id)
+
+def fetch_summaries_after(chat_id: int, batch_id: int, k: int) -> List[Tuple[int, str, dt.datetime, dt.datetime]]:
+    """До k выжимок чата с batch_id > batch_id: [(batch_id, text, from_ts, to_ts)] по возрастанию."""
+    ch = get_ch()
+    rows = ch.query(
+        "SELECT batch_id, text, from_ts, to_ts "
+        "FROM tg_summaries WHERE chat_id = %(c)s AND batch_id > %(b)s ORDER BY batch_id ASC LIMIT %(k)s",
+        parameters={'c': chat_id, 'b': batch_id, 'k': k}
+    ).result_rows
+    return [tuple(r) for r in rows]
 
-def fetch_last_summaries(k: int) -> list[str]:
+def fetch_last_summaries(chat_id: int, k: int) -> list[str]:
     ch = get_ch()
     rows = ch.query(
         """
         SELECT text
         FROM tg_summaries
+        WHERE chat_id = %(c)s
         ORDER BY batch_id DESC
         LIMIT %(k)s
         """,
-        parameters={"k": k}
+        parameters={"c": chat_id, "k": k}
     ).result_rows
     return [r[0] for r in rows[::-1]]
 
-def tool_get_summaries(limit: int = 10) -> list[dict]:
+def _summary_record(batch_id: int, from_ts: dt.datetime, to_ts: dt.datetime, text: str) -> dict:
+    return {
+        "batch_id": batch_id,
+        "from_ts": from_ts.isoformat() + "Z",
+        "to_ts": to_ts.isoformat() + "Z",
+        "approx_messages": N,
+        "text": text,
+    }
+
+def tool_get_summaries(chat_id: int, limit: int = 10) -> list[dict]:
+    """Последние limit выжимок; повторные вызовы обслуживаются из кольца в памяти."""
+    cached = summary_ring.get(chat_id, limit, get_watermarks(chat_id).last_batch_id)
+    if cached is not None:
+        return cached
+    k = max(limit, TOOL_RING_SIZE)
     ch = get_ch()
     rows = ch.query(
         """
         SELECT batch_id, from_ts, to_ts, text
         FROM tg_summaries
+        WHERE chat_id = %(c)s
         ORDER BY batch_id DESC
         LIMIT %(lim)s
         """,
-        parameters={"lim": limit}
+        parameters={"c": chat_id, "lim": k}
     ).result_rows
     rows.reverse()
-    return [
-        {
-            "batch_id": r[0],
-            "from_ts": r[1].isoformat() + "Z",
-            "to_ts": r[2].isoformat() + "Z",
-            "approx_messages": N,
-            "text": r[3],
-        }
-        for r in rows
-    ]
+    recs = [(r[0], _summary_record(*r)) for r in rows]
+    summary_ring.fill(chat_id, recs, complete=len(rows) < k)
+    return [rec for _, rec in recs[-limit:]] if limit > 0 else []
@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+import threading
+
+Record = Dict[str, Any]
+
+
+class _Ring:
+    __slots__ = ("items", "mark", "complete")
+
+    def __init__(self, size: int) -> None:
+        self.items: Deque[Tuple[int, Record]] = deque(maxlen=size)
+        self.mark = 0         # последний id, который есть в кольце
+        self.complete = False  # в кольце вся история чата, а не только её хвост
+
+
+class RingCache:
+    """
+    Последние size записей неизменяемой таблицы (выжимки, контексты) по чатам.
+    Кольцо заполняется из БД один раз и дальше только дописывается при вставке;
+    ключ валидности — водяной знак таблицы: если он ушёл вперёд мимо кольца,
+    кольцо перечитывается.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._rings: Dict[int, _Ring] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id: int, limit: int, mark: int) -> Optional[List[Record]]:
+        with self._lock:
+            ring = self._rings.get(chat_id)
+            if (
+                ring is None
+                or ring.mark < mark
+                or (limit > len(ring.items) and not ring.complete)
+            ):
+                self.misses += 1
+                return None
+            self.hits += 1
+            items = list(ring.items)
+        return [r for _, r in items[-limit:]] if limit > 0 else []
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def fill(self, chat_id: int, rows: List[Tuple[int, Record]], complete: bool) -> None:
+        """rows — по возрастанию id; complete — в rows вся история чата."""
+        ring = _Ring(self.size)
+        ring.items.extend(rows)
+        ring.mark = rows[-1][0] if rows else 0
+        ring.complete = complete and len(rows) <= self.size
+        with self._lock:
+            old = self._rings.get(chat_id)
+            if old is None or old.mark <= ring.mark:
+                self._rings[chat_id] = ring
+
+    def append(self, chat_id: int, row_id: int, rec: Record) -> None:
+        """
+        Дописать свежевставленную запись; до первого чтения кольца — ничего не делать.
+        Запись позади водяного знака (выжимки прошлой истории при импорте) в середину
+        кольца не встанет — кольцо сбрасывается и при следующем чтении перечитывается.
+        """
+        with self._lock:
+            ring = self._rings.get(chat_id)
+            if ring is None:
+                return
+            if row_id <= ring.mark:
+                del self._rings[chat_id]
+                return
+            if len(ring.items) == ring.items.maxlen:
+                ring.complete = False
+            ring.items.append((row_id, rec))
+            ring.mark = row_id
+
+
+class _Window:
+    __slots__ = ("n", "mark", "items")
+
+    def __init__(self, n: int, mark: int, items: List[Record]) -> None:
+        self.n = n
+        self.mark = mark
+        self.items = items
+
+
+class WindowCache:
+    """
+    Окна последних n сообщений по (chat_id, n). При сдвиге водяного знака
+    окно не перечитывается: к нему дописывается только новый хвост,
+    а вышедшее за (max_id - n; max_id] отрезается.
+    """
+
+    def __init__(self, size: int, max_n: int) -> None:
+        self.size = size
+        self.max_n = max_n
+        self._entries: "OrderedDict[Tuple[int, int], _Window]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.partial = 0
+        self.misses = 0
+
+    def get(self, chat_id: int, n: int, mark: int,
+            load: Callable[[int], Tuple[List[Record], int]],
+            tail: Callable[[int], Tuple[List[Record], int]]) -> List[Record]:
+        """
+        load(n) → (окно целиком, max_id), tail(after_id) → (сообщения с id > after_id, max_id);
+        записи по возрастанию tg_msg_id, max_id — докуда источник покрывает чат.
+        """
+        key = (chat_id, n)
+        with self._lock:
+            w = self._entries.get(key)
+            if w is not None:
+                self._entries.move_to_end(key)
+        if w is None or n > self.max_n:
+            self.misses += 1
+            items, top = load(n)
+        elif w.mark >= mark:
+            self.hits += 1
+            return list(w.items)
+        else:
+            self.partial += 1
+            new, top = tail(w.mark)
+            top = max(top, w.mark)
+            items = [r for r in w.items + new if r["tg_msg_id"] > top - n]
+        if n <= self.max_n:
+            with self._lock:
+                self._entries[key] = _Window(n, top, items)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return list(items)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "partial": self.partial, "misses": self.misses}
@@ -1,38 +1,88 @@
 from __future__ import annotations
 
-from typing import Iterable, Dict
+from collections import OrderedDict
+from typing import Iterable, Dict, List, Optional, Sequence, Tuple
 import datetime as dt
+import threading
+import time
 
 from . import get_ch
+from ..schemas import MsgRow
+from ..configs import USER_CACHE_SIZE, USER_LAST_SEEN_REFRESH
 
 
-def upsert_user(user_id: int, username: str, first_name: str, last_name: str) -> None:
-    ch = get_ch()
-    row = ch.query(
-        "SELECT first_seen FROM tg_users WHERE user_id = %(uid)s ORDER BY last_seen DESC LIMIT 1",
-        parameters={"uid": user_id}
-    ).result_rows
-    now = dt.datetime.now(dt.timezone.utc)
-    first_seen = row[0][0] if row else now
+class _Profile:
+    __slots__ = ("username", "first_name", "last_name", "first_seen", "written_at")
 
-    ch.insert(
-        'tg_users',
-        [(user_id, username or '', first_name or '', last_name or '', first_seen, now)],
-        column_names=['user_id', 'username', 'first_name', 'last_name', 'first_seen', 'last_seen']
-    )
+    def __init__(self, username: str, first_name: str, last_name: str,
+                 first_seen: Optional[dt.datetime], written_at: float):
+        self.username = username
+        self.first_name = first_name
+        self.last_name = last_name
+        self.first_seen = first_seen
+        self.written_at = written_at  # epoch-секунды последнего last_seen в tg_users
 
-def load_display_names(user_ids: Iterable[int]) -> Dict[int, str]:
+    @property
+    def display(self) -> str:
+        return _display_name(self.username, self.first_name, self.last_name)
+
+
+# LRU user_id -> профиль. Обращения идут из потоков пула БД, поэтому под локом (и счётчики тоже).
+_cache: "OrderedDict[int, _Profile]" = OrderedDict()
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "writes": 0, "skipped_writes": 0}
+
+
+def _display_name(uname: str, fn: str, ln: str) -> str:
+    fn = (fn or "").strip()
+    ln = (ln or "").strip()
+    if fn or ln:
+        return (fn + " " + ln).strip()
+    return uname or ""
+
+def _epoch(ts: dt.datetime) -> float:
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=dt.timezone.utc)
+    return ts.timestamp()
+
+def _cache_get(user_id: int) -> Optional[_Profile]:
+    with _lock:
+        p = _cache.get(user_id)
+        if p is not None:
+            _cache.move_to_end(user_id)
+        return p
+
+def _count(key: str, n: int = 1) -> None:
+    with _lock:
+        _stats[key] += n
+
+def _cache_put(user_id: int, p: _Profile, loaded: bool = False) -> None:
+    """loaded — профиль прочитан из БД: запись, сделанная тем временем upsert_user, новее — её не трогаем."""
+    with _lock:
+        old = _cache.get(user_id)
+        if loaded and old is not None and old.written_at > p.written_at:
+            return
+        _cache[user_id] = p
+        _cache.move_to_end(user_id)
+        while len(_cache) > USER_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def _load_profiles(ids: List[int]) -> Dict[int, _Profile]:
+    """
+    Один агрегирующий запрос за профилями ids; в кэш кладутся только найденные.
+    Ненайденные возвращаются пустыми, но не кэшируются: профиль может записать
+    upsert_user или импорт в другом процессе, и пустое имя не должно жить до вытеснения.
+    """
     ch = get_ch()
-    ids = list({int(x) for x in user_ids})
-    if not ids:
-        return {}
     rows = ch.query(
         """
         SELECT
           user_id,
           argMax(username, last_seen)   AS username,
           argMax(first_name, last_seen) AS first_name,
-          argMax(last_name,  last_seen) AS last_name
+          argMax(last_name,  last_seen) AS last_name,
+          min(first_seen)               AS first_seen,
+          max(last_seen)                AS last_seen
         FROM tg_users
         WHERE user_id IN %(ids)s
         GROUP BY user_id
@@ -40,18 +90,99 @@ def load_display_names(user_ids: Iterable[int]) -> Dict[int, str]:
         parameters={"ids": ids}
     ).result_rows
 
+    out: Dict[int, _Profile] = {}
+    for uid, uname, fn, ln, first_seen, last_seen in rows:
+        out[int(uid)] = _Profile(uname or "", fn or "", ln or "", first_seen, _epoch(last_seen))
+    for uid, p in out.items():
+        _cache_put(uid, p, loaded=True)
+    for uid in ids:
+        out.setdefault(uid, _Profile("", "", "", None, 0.0))
+    return out
+
+
+def upsert_user(user_id: int, username: str, first_name: str, last_name: str) -> None:
+    """
+    Пишет строку в tg_users только если изменились username/имя
+    или с последней записи last_seen прошло больше USER_LAST_SEEN_REFRESH секунд.
+    """
+    username, first_name, last_name = username or '', first_name or '', last_name or ''
+    p = _cache_get(user_id)
+    if p is None:
+        p = _load_profiles([user_id])[user_id]
+
+    now = dt.datetime.now(dt.timezone.utc)
+    unchanged = (p.username, p.first_name, p.last_name) == (username, first_name, last_name)
+    if unchanged and time.time() - p.written_at < USER_LAST_SEEN_REFRESH:
+        _count("skipped_writes")
+        return
+
+    first_seen = p.first_seen or now
+    ch = get_ch()
+    ch.insert(
+        'tg_users',
+        [(user_id, username, first_name, last_name, first_seen, now)],
+        column_names=['user_id', 'username', 'first_name', 'last_name', 'first_seen', 'last_seen']
+    )
+    _count("writes")
+    _cache_put(user_id, _Profile(username, first_name, last_name, first_seen, now.timestamp()))
+
+def import_users(seen: Dict[int, Tuple[str, dt.datetime, dt.datetime]]) -> int:
+    """
+    Пользователи из импортированной истории: user_id -> (имя, первое и последнее сообщение).
+    Пишутся только неизвестные tg_users — живой профиль (с username) не перетирается
+    устаревшим именем из экспорта. Один запрос на проверку, одна вставка.
+    """
+    if not seen:
+        return 0
+    known = load_display_names(seen.keys())
+    fresh = [uid for uid in seen if known.get(uid, str(uid)) == str(uid)]
+    if not fresh:
+        return 0
+    get_ch().insert(
+        'tg_users',
+        [(uid, '', seen[uid][0], '', seen[uid][1], seen[uid][2]) for uid in fresh],
+        column_names=['user_id', 'username', 'first_name', 'last_name', 'first_seen', 'last_seen']
+    )
+    for uid in fresh:
+        name, first_seen, last_seen = seen[uid]
+        _cache_put(uid, _Profile('', name, '', first_seen, _epoch(last_seen)))
+    _count("writes", len(fresh))
+    return len(fresh)
+
+def load_display_names(user_ids: Iterable[int]) -> Dict[int, str]:
+    """Имена из LRU-кэша; за промахами — один пакетный запрос."""
+    ids = list({int(x) for x in user_ids})
+    if not ids:
+        return {}
+
     out: Dict[int, str] = {}
-    for uid, uname, fn, ln in rows:
-        fn = (fn or "").strip()
-        ln = (ln or "").strip()
-        if fn or ln:
-            disp = (fn + " " + ln).strip()
-        elif uname:
-            disp = uname
+    misses: List[int] = []
+    for uid in ids:
+        p = _cache_get(uid)
+        if p is None:
+            misses.append(uid)
         else:
-            disp = str(uid)
-        out[int(uid)] = disp
+            out[uid] = p.display or str(uid)
+    with _lock:
+        _stats["hits"] += len(ids) - len(misses)
+        _stats["misses"] += len(misses)
 
-    for uid in ids:
-        out.setdefault(uid, str(uid))
+    if misses:
+        for uid, p in _load_profiles(misses).items():
+            out[uid] = p.display or str(uid)
     return out
+
+def msg_rows(chat_id: int, rows: Sequence[Sequence]) -> List[MsgRow]:
+    """
+    Строки (tg_msg_id, user_id, text, ts) из БД → MsgRow с авторами:
+    один запрос имён на всю выборку и один проход построения, без валидации и дозаполнения.
+    """
+    names = load_display_names(r[1] for r in rows)
+    return [
+        MsgRow(chat_id, msg_id, user_id, text, ts, names.get(user_id) or str(user_id))
+        for msg_id, user_id, text, ts in rows
+    ]
+
+def user_cache_stats() -> Dict[str, int]:
+    with _lock:
+        return {**_stats, "size": len(_cache)}
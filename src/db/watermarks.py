@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+from collections import deque
+from typing import Deque, Dict, List
+import threading
+
+from . import get_ch
+from ..schemas import Msg
+from ..configs import RECENT_TAIL_SIZE
+
+
+class ChatMarks:
+    """
+    Водяные знаки чата в памяти: последний message_id (с учётом ещё не сброшенного буфера),
+    последняя выжимка и контекст, плюс короткий хвост последних сообщений.
+    Двигаются путём вставки, из БД читаются один раз на чат.
+    """
+    __slots__ = ("last_msg_id", "last_batch_id", "last_context_id", "recent", "floor", "loaded")
+
+    def __init__(self) -> None:
+        self.last_msg_id = 0
+        self.last_batch_id = 0
+        self.last_context_id = 0
+        self.recent: Deque[Msg] = deque(maxlen=RECENT_TAIL_SIZE)
+        self.floor: int | None = None  # все сообщения с id > floor лежат в recent
+        self.loaded = False
+
+    def tail_after(self, msg_id: int) -> List[Msg] | None:
+        """Сообщения с tg_msg_id > msg_id из памяти; None — если хвост их уже не покрывает."""
+        with _lock:
+            recent = list(self.recent)
+            floor = self.floor
+        if msg_id >= self.last_msg_id:
+            return []
+        if floor is None or msg_id < floor:
+            return None
+        return [m for m in recent if m.tg_msg_id > msg_id]
+
+
+_marks: Dict[int, ChatMarks] = {}
+_lock = threading.Lock()
+
+
+def _get(chat_id: int) -> ChatMarks:
+    with _lock:
+        marks = _marks.get(chat_id)
+        if marks is None:
+            marks = _marks[chat_id] = ChatMarks()
+        return marks
+
+def note_message(m: Msg) -> None:
+    marks = _get(m.chat_id)
+    with _lock:
+        if m.tg_msg_id > marks.last_msg_id:
+            marks.last_msg_id = m.tg_msg_id
+        if len(marks.recent) == marks.recent.maxlen:
+            marks.floor = marks.recent[0].tg_msg_id
+        elif marks.floor is None:
+            marks.floor = m.tg_msg_id - 1
+        marks.recent.append(m)
+
+def note_summary(chat_id: int, batch_id: int) -> None:
+    marks = _get(chat_id)
+    with _lock:
+        marks.last_batch_id = max(marks.last_batch_id, batch_id)
+
+def note_context(chat_id: int, context_id: int) -> None:
+    marks = _get(chat_id)
+    with _lock:
+        marks.last_context_id = max(marks.last_context_id, context_id)
+
+def get_watermarks(chat_id: int) -> ChatMarks:
+    """Водяные знаки чата; при первом обращении — один запрос к БД за всеми тремя."""
+    marks = _get(chat_id)
+    if marks.loaded:
+        return marks
+    row = get_ch().query(
+        """
+        SELECT
+          (SELECT max(tg_msg_id) FROM tg_messages  WHERE chat_id = %(c)s),
+          (SELECT max(batch_id)  FROM tg_summaries WHERE chat_id = %(c)s),
+          (SELECT max(context_id) FROM tg_contexts WHERE chat_id = %(c)s)
+        """,
+        parameters={"c": chat_id}
+    ).result_rows[0]
+    with _lock:
+        marks.last_msg_id = max(marks.last_msg_id, int(row[0] or 0))
+        marks.last_batch_id = max(marks.last_batch_id, int(row[1] or 0))
+        marks.last_context_id = max(marks.last_context_id, int(row[2] or 0))
+        if marks.floor is None:
+            marks.floor = int(row[0] or 0)
+        marks.loaded = True
+    return marks
@@ -2,8 +2,9 @@
 from telegram.ext import Application, MessageHandler, CommandHandler, filters
 
 from .messages import on_msg
-from .commands import cmd_t, cmd_b, get_chat_id
+from .commands import cmd_t, cmd_b, cmd_stats, get_chat_id
 from .security import blocked
+from src.metrics import timed_handler
 
 
 def register_handlers(app: Application, chat_whitelist: filters.BaseFilter) -> None:
@@ -11,10 +12,11 @@ def register_handlers(app: Application, chat_whitelist: filters.BaseFilter) -> N
     Регистрирует все хэндлеры приложения.
     chat_whitelist — filters.Chat(chat_id=...) для белого списка.
     """
-    app.add_handler(MessageHandler(chat_whitelist & filters.TEXT & (~filters.COMMAND), on_msg))
+    app.add_handler(MessageHandler(chat_whitelist & filters.TEXT & (~filters.COMMAND), timed_handler("msg", on_msg)))
 
     app.add_handler(CommandHandler("get_id", get_chat_id))
-    app.add_handler(CommandHandler("t", cmd_t, filters=chat_whitelist))
-    app.add_handler(CommandHandler("b", cmd_b, filters=chat_whitelist))
+    app.add_handler(CommandHandler("t", timed_handler("t", cmd_t), filters=chat_whitelist))
+    app.add_handler(CommandHandler("b", timed_handler("b", cmd_b), filters=chat_whitelist))
+    app.add_handler(CommandHandler("stats", timed_handler("stats", cmd_stats), filters=chat_whitelist))
 
     app.add_handler(MessageHandler(~chat_whitelist, blocked), group=99)
@@ -1,20 +1,21 @@
 import json
+import time
+from contextlib import aclosing
 
 from telegram import Update
 from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
 
-from src.schemas import Msg
-from src.db import get_ch
-from src.db.logger import log_event, log_llm_tool_request
-from src.db.messages import tool_get_messages_window, tool_search_messages
-from src.db.summaries import tool_get_summaries
-from src.db.contexts import tool_get_contexts
-from src.db.users import load_display_names
+from src.db import run_db
+from src.db.logger import log_event, log_exception, log_llm_tool_request, log_llm_tool_result
+from src.db.aio import get_watermarks, fetch_tail_preview, get_stats
+from src.configs import STATS_DEFAULT_DAYS
 from src.t_materials import build_materials_for_last_n
-from src.llm import RAG_SYSTEM, _chat_complete, parse_tool_call
-
-_last_t_cache = {"n": 0, "upto_msg_id": 0, "text": ""}
+from src.t_cache import t_cache
+from src.prompt_packer import estimate_tokens, pack_materials, pack_records, prompt_budget
+from src.llm import RAG_SYSTEM, chat_stream, parse_tool_calls
+from src.tools import run_tools, tool_cache_stats
+from src.handlers.streaming import stream_reply
 
 
 async def cmd_t(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -31,30 +32,18 @@ async def cmd_t(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await update.effective_chat.send_message("n должно быть > 0")
         return
 
-    row = get_ch().query("SELECT max(tg_msg_id) FROM tg_messages").result_rows
-    last_msg_id = int(row[0][0] or 0)
-
-    DELTA_MAX = 20
-    if (
-        _last_t_cache["text"]
-        and _last_t_cache["n"] >= n
-        and (last_msg_id - _last_t_cache["upto_msg_id"]) <= DELTA_MAX
-    ):
-        rows = get_ch().query(
-            """
-            SELECT tg_msg_id, user_id, text, ts
-            FROM tg_messages
-            WHERE tg_msg_id > %(from_id)s AND lengthUTF8(text) > 0
-            ORDER BY tg_msg_id ASC
-            """,
-            parameters={"from_id": _last_t_cache["upto_msg_id"]},
-        ).result_rows
-
-        tail = [Msg(tg_msg_id=r[0], user_id=r[1], text=r[2], ts=r[3]) for r in rows]
-
-        names = load_display_names(m.user_id for m in tail)
-        for m in tail:
-            m.author = names.get(m.user_id, str(m.user_id))
+    started = time.perf_counter()
+    chat_id = update.effective_chat.id
+    marks = await get_watermarks(chat_id)
+    built_from = (marks.last_msg_id, marks.last_batch_id, marks.last_context_id)
+
+    cached = t_cache.get(chat_id, n, marks)
+    if cached:
+        tail = marks.tail_after(cached.msg_mark)
+        if tail is None:
+            total, tail = await fetch_tail_preview(chat_id, cached.msg_mark, 10)
+        else:
+            total = len(tail)
 
         if tail:
             tail_lines = "\n".join(
@@ -62,32 +51,27 @@ async def cmd_t(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
                 for m in tail[:10]
             )
             resp = (
-                f"{_last_t_cache['text']}\n\nДополнение (новые {len(tail)} сообщений):\n"
+                f"{cached.text}\n\nДополнение (новые {total} сообщений):\n"
                 f"{tail_lines}\n\n(Основной обзор не пересчитывался — добавлено только новое)."
             )
         else:
-            resp = _last_t_cache["text"] + "\n\n(Новых сообщений почти не было.)"
+            resp = cached.text + "\n\n(Новых сообщений почти не было.)"
         await update.effective_chat.send_message(resp[:4000])
         return
 
-    ctx_texts, sum_texts, raw_msgs = build_materials_for_last_n(n)
+    placeholder = await update.effective_chat.send_message("⏳ Собираю материалы…")
+    try:
+        ctx_texts, sum_texts, raw_msgs = await run_db(build_materials_for_last_n, chat_id, n)
+    except Exception:
+        log_exception(ctx=f"/t materials chat_id={chat_id} n={n}")
+        await placeholder.edit_text("Не удалось собрать материалы, попробуйте позже.")
+        return
     if not (ctx_texts or sum_texts or raw_msgs):
-        await update.effective_chat.send_message("Недостаточно данных.")
+        await placeholder.edit_text("Недостаточно данных.")
         return
 
-    blocks = []
-    if ctx_texts:
-        blocks.append("Контексты:\n" + "\n\n".join(ctx_texts))
-    if sum_texts:
-        blocks.append("Выжимки:\n" + "\n\n".join(sum_texts))
-    if raw_msgs:
-        tail_lines = "\n".join(
-            f"{m.ts.isoformat()}Z | {getattr(m, 'author', m.user_id)}: {m.text}"
-            for m in raw_msgs
-        )
-        blocks.append("Последние сообщения (хвост):\n" + tail_lines)
-
-    content = (
+    system = "Ты опытный аналитик, который делает сжатые хронологические выжимки диалогов."
+    instructions = (
         "Составь ЕДИНУЮ хронологию ключевых событий и фактов из всех материалов ниже.\n"
         "Используй только важную информацию, без лишних деталей и повторов.\n"
         "Объедини данные из контекстов, выжимок и хвоста, сортируя их строго по времени.\n"
@@ -95,17 +79,42 @@ async def cmd_t(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         "Игнорируй факты, которые уже упоминались ранее.\n"
         "Вывод — в формате 8–15 буллетов, без лишнего оформления и лишних заголовков.\n"
         "Не используй спецсимволов или markdown разметку.\n\n"
-        "Материалы:\n" + "\n\n---\n\n".join(blocks)
+        "Материалы:\n"
+    )
+    raw_lines = [
+        f"{m.ts.isoformat()}Z | {getattr(m, 'author', m.user_id)}: {m.text}"
+        for m in raw_msgs
+    ]
+    packed = pack_materials(
+        ctx_texts, sum_texts, raw_lines,
+        budget=prompt_budget() - estimate_tokens(system + instructions),
     )
 
+    blocks = []
+    if packed.contexts:
+        blocks.append("Контексты:\n" + "\n\n".join(packed.contexts))
+    if packed.summaries:
+        blocks.append("Выжимки:\n" + "\n\n".join(packed.summaries))
+    if packed.raw:
+        blocks.append("Последние сообщения (хвост):\n" + "\n".join(packed.raw))
+
+    content = instructions + "\n\n---\n\n".join(blocks)
+
     messages = [
         {
             "role": "system",
-            "content": "Ты опытный аналитик, который делает сжатые хронологические выжимки диалогов."
+            "content": system
         },
         {"role": "user", "content": content}
     ]
-    text, _, _ = await _chat_complete(messages, temperature=0.2)
+    try:
+        text = await stream_reply(
+            update.effective_chat, chat_stream(messages, temperature=0.2, purpose="t"),
+            command="t", started=started, message=placeholder,
+        )
+    except Exception:
+        return  # stream_reply уже записал ошибку и заменил заглушку
+    text = text.strip()
 
     log_event(
         {
@@ -117,67 +126,163 @@ async def cmd_t(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
                 "raw": len(raw_msgs),
             },
             "n_requested": n,
+            "chat_id": chat_id,
+            "pack": packed.report(),
+            "t_cache": t_cache.stats(),
         }
     )
 
-    _last_t_cache.update({"n": n, "upto_msg_id": last_msg_id, "text": text})
-    await update.effective_chat.send_message(text[:4000])
+    if text:
+        t_cache.put(chat_id, n, text, built_from)
 
 
 async def cmd_b(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """
     /b {text} — прямой промпт с возможностью запросить данные из БД
-    через протокол TOOL: {...}
+    через протокол TOOL: [...] (несколько инструментов за один шаг, выполняются параллельно)
     """
     q = " ".join(ctx.args or []).strip()
     if not q:
         await update.effective_chat.send_message("Формат: /b {запрос}")
         return
+    started = time.perf_counter()
+    chat_id = update.effective_chat.id
+    placeholder = await update.effective_chat.send_message("⏳ Думаю…")
 
     first = [
         {"role": "system", "content": RAG_SYSTEM},
         {"role": "user", "content": q},
     ]
-    draft, _, _ = await _chat_complete(first, temperature=0.2)
+    draft_parts: list[str] = []
 
-    tool = parse_tool_call(draft)
-    if not tool:
-        await update.effective_chat.send_message(draft[:4000])
-        return
+    async def visible_draft():
+        """Черновик первого шага показываем, только если это не вызов инструмента."""
+        head = ""
+        answering = None
+        async with aclosing(chat_stream(first, temperature=0.2, purpose="b.draft")) as stream:
+            async for d in stream:
+                draft_parts.append(d)
+                if answering is None:
+                    head += d
+                    lead = head.lstrip()
+                    if "TOOL:".startswith(lead):
+                        continue
+                    answering = not lead.startswith("TOOL:")
+                    if answering:
+                        yield head
+                elif answering:
+                    yield d
+        if answering is None and head.strip():
+            yield head
 
-    log_llm_tool_request(draft, tool)
-
-    name = tool.get("name")
-    args = tool.get("args", {}) or {}
-
-    if name == "get_contexts":
-        data = tool_get_contexts(limit=int(args.get("limit", 5)))
-    elif name == "get_summaries":
-        data = tool_get_summaries(limit=int(args.get("limit", 10)))
-    elif name == "get_messages_window":
-        data = tool_get_messages_window(n=int(args.get("n", 200)))
-    elif name == "search_messages":
-        data = tool_search_messages(
-            query=args.get("query", ""),
-            window=int(args.get("window", 5000)),
-            limit=int(args.get("limit", 50)),
+    try:
+        # Пустой видимый черновик — обычно вызов инструмента: сообщение правится ниже.
+        await stream_reply(
+            update.effective_chat, visible_draft(),
+            command="b.draft", started=started, message=placeholder, empty_text=None,
         )
-    else:
-        await update.effective_chat.send_message("Нейросеть попыталась использовать неизвестный инструмент.")
+    except Exception:
+        return  # stream_reply уже записал ошибку и заменил заглушку
+    draft = "".join(draft_parts).strip()
+
+    calls = parse_tool_calls(draft)
+    if not calls:
+        if not draft:
+            await placeholder.edit_text("Нейросеть вернула пустой ответ.")
         return
+    await placeholder.edit_text("🔎 Ищу в базе…")
+
+    log_llm_tool_request(draft, calls)
+
+    results = await run_tools(chat_id, calls)
+    for r in results:
+        log_llm_tool_result(r["name"], r["args"], r["data"], r["latency_ms"], r["error"])
+    if all(r["error"] == "unknown tool" for r in results):
+        await placeholder.edit_text("Нейросеть попыталась использовать неизвестный инструмент.")
+        return
+
+    system = (
+        "Отвечай кратко и конкретно. "
+        "Если пришли и контексты/выжимки и сырые сообщения, доверяй контекстам и выжимкам, "
+        "а сырые используй только для уточнения/цитаты."
+    )
+    # Бюджет делится поровну между ещё не упакованными результатами;
+    # недобранное одним инструментом переходит к следующим.
+    remaining = prompt_budget() - estimate_tokens(system + q + draft)
+    sections: list[str] = []
+    reports: list[dict] = []
+    for i, r in enumerate(results):
+        header = f"### {r['name']} {json.dumps(r['args'], ensure_ascii=False)}"
+        if r["error"]:
+            body = f"ошибка: {r['error']}"
+            report = {}
+        else:
+            share = remaining // (len(results) - i) - estimate_tokens(header)
+            body, report = pack_records(r["data"], budget=share, keep=r["keep"])
+        remaining -= estimate_tokens(header + body)
+        sections.append(header + "\n" + body)
+        reports.append({"tool": r["name"], "latency_ms": r["latency_ms"], "error": r["error"], **report})
+    log_event({
+        "type": "llm.b_pack", "chat_id": chat_id, "tools": reports,
+        "tool_cache": tool_cache_stats(),
+    })
 
     second = [
-        {"role": "system", "content": (
-            "Отвечай кратко и конкретно. "
-            "Если пришли и контексты/выжимки и сырые сообщения, доверяй контекстам и выжимкам, "
-            "а сырые используй только для уточнения/цитаты."
-        )},
+        {"role": "system", "content": system},
         {"role": "user", "content": q},
         {"role": "assistant", "content": draft},
-        {"role": "user", "content": "Данные из БД:\n" + json.dumps(data, ensure_ascii=False)[:12000]},
+        {"role": "user", "content": "Данные из БД:\n\n" + "\n\n".join(sections)},
     ]
-    final, _, _ = await _chat_complete(second, temperature=0.2)
-    await update.effective_chat.send_message(final[:4000])
+    try:
+        await stream_reply(
+            update.effective_chat, chat_stream(second, temperature=0.2, purpose="b"),
+            command="b", started=started, message=placeholder,
+        )
+    except Exception:
+        pass  # stream_reply уже записал ошибку и заменил заглушку
+
+
+async def cmd_stats(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """
+    /stats [days] — активность чата за последние days суток из предагрегатов, без LLM.
+    """
+    try:
+        days = int((ctx.args or [str(STATS_DEFAULT_DAYS)])[0])
+    except Exception:
+        await update.effective_chat.send_message("Формат: /stats [дней]")
+        return
+    if days <= 0:
+        await update.effective_chat.send_message("Число дней должно быть > 0")
+        return
+
+    started = time.perf_counter()
+    chat_id = update.effective_chat.id
+    st = await get_stats(chat_id, days=days)
+    if not st["messages"]:
+        await update.effective_chat.send_message(f"С {st['since']} сообщений не было.")
+        return
+
+    lines = [
+        f"С {st['since']} ({st['days']} дн.): {st['messages']} сообщений, "
+        f"{st['chars']} символов, {st['active_users']} участников.",
+        "",
+        "Больше всех писали:",
+    ]
+    for i, u in enumerate(st["top_users"], 1):
+        lines.append(f"{i}. {u['author']} — {u['messages']} ({u['chars']} симв.)")
+    lines += ["", "По дням:"]
+    lines += [f"{d['day']}: {d['messages']}" for d in st["by_day"][-14:]]
+    hours = st["by_hour_utc"]
+    peak = max(range(24), key=lambda h: hours[h])
+    lines += ["", f"Самый активный час (UTC): {peak:02d}:00–{peak:02d}:59, {hours[peak]} сообщений."]
+
+    await update.effective_chat.send_message("\n".join(lines)[:4000])
+    log_event({
+        "type": "tg.stats",
+        "chat_id": chat_id,
+        "days": days,
+        "total_ms": int((time.perf_counter() - started) * 1000),
+    })
 
 
 async def get_chat_id(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -4,8 +4,8 @@ from telegram import Update
 from telegram.ext import ContextTypes
 
 from src.schemas import Msg
-from src.db.users import upsert_user
-from src.db.messages import insert_message
+from src.db.aio import upsert_user
+from src.db.ingest import enqueue_message, flush_messages_async
 
 
 async def on_msg(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -17,18 +17,22 @@ async def on_msg(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
 
     u = m.from_user
-    upsert_user(
+    await upsert_user(
         user_id=u.id,
         username=u.username or "",
         first_name=u.first_name or "",
         last_name=u.last_name or "",
     )
 
-    insert_message(
+    full = enqueue_message(
         Msg(
+            chat_id=m.chat_id,
             tg_msg_id=m.message_id,
             user_id=u.id,
             text=m.text,
             ts=m.date.astimezone(dt.timezone.utc).replace(tzinfo=None),
+            author=u.full_name or u.username or str(u.id),
         )
     )
+    if full:
+        await flush_messages_async()
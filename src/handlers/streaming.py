@@ -0,0 +1,119 @@
+import asyncio
+import datetime as dt
+import time
+from contextlib import aclosing
+from typing import AsyncIterator, Optional
+
+from telegram import Chat, Message
+from telegram.error import BadRequest, RetryAfter
+
+from src.configs import STREAM_EDIT_INTERVAL
+from src.db.logger import log_event, log_exception
+
+TG_LIMIT = 4000
+CURSOR = " ▌"
+
+
+FINAL_EDIT_ATTEMPTS = 3
+EMPTY_TEXT = "Нейросеть вернула пустой ответ."
+ERROR_TEXT = "Не удалось получить ответ нейросети, попробуйте позже."
+
+
+def _retry_seconds(e: RetryAfter) -> float:
+    d = e.retry_after
+    return d.total_seconds() if isinstance(d, dt.timedelta) else float(d)
+
+async def _edit(msg: Message, text: str, final: bool = False) -> float:
+    """
+    Правит сообщение. Возвращает 0, если правка прошла, иначе паузу flood control в секундах:
+    промежуточную правку вызывающий просто откладывает на это время, а финальную
+    (final=True) _edit сам повторяет после паузы — иначе в чате останется обрезанный черновик с курсором.
+    """
+    for attempt in range(FINAL_EDIT_ATTEMPTS if final else 1):
+        try:
+            await msg.edit_text(text)
+            return 0.0
+        except RetryAfter as e:
+            delay = _retry_seconds(e)
+            if not final:
+                return delay
+            if attempt == FINAL_EDIT_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(delay)
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return 0.0
+            raise
+    return 0.0
+
+
+async def stream_reply(chat: Chat, deltas: AsyncIterator[str], *, command: str,
+                       started: float, message: Optional[Message] = None,
+                       placeholder: str = "⏳", empty_text: Optional[str] = EMPTY_TEXT) -> str:
+    """
+    Показывает поток фрагментов в одном сообщении: заглушка сразу, затем правки
+    не чаще STREAM_EDIT_INTERVAL секунд и финальная правка без курсора.
+    started — time.perf_counter() начала команды: от него считаются placeholder_ms
+    и ttfv_ms (время до первого видимого текста ответа) — главная метрика отзывчивости.
+    Заглушка в чате не остаётся: пустой ответ заменяется на empty_text (None — сообщение
+    не трогать, решает вызывающий), а если поток упал — на ERROR_TEXT (после уже
+    показанной части ответа); исключение записывается в логи и пробрасывается дальше.
+    Возвращает весь полученный текст.
+    """
+    if message is None:
+        message = await chat.send_message(placeholder)
+    placeholder_ms = int((time.perf_counter() - started) * 1000)
+
+    text = ""
+    shown = ""
+    next_edit = 0.0
+    edits = 0
+    ttfv_ms = None
+    try:
+        # aclosing: при выходе по исключению генератор закрывается сразу и отпускает
+        # слот LLM и HTTP-соединение, а не ждёт сборщика мусора.
+        async with aclosing(deltas):
+            async for d in deltas:
+                text += d
+                now = time.monotonic()
+                if now < next_edit or not text.strip():
+                    continue
+                draft = text[:TG_LIMIT - len(CURSOR)] + CURSOR
+                delay = await _edit(message, draft)
+                if delay:
+                    # Flood control: следующая промежуточная правка — не раньше, чем разрешил Telegram.
+                    next_edit = now + max(delay, STREAM_EDIT_INTERVAL)
+                    continue
+                edits += 1
+                shown = draft
+                if ttfv_ms is None:
+                    ttfv_ms = int((time.perf_counter() - started) * 1000)
+                next_edit = now + STREAM_EDIT_INTERVAL
+    except Exception:
+        log_exception(ctx=f"stream_reply command={command} chars={len(text)}")
+        partial = text.strip()
+        note = f"{partial[:TG_LIMIT - len(ERROR_TEXT) - 6]}\n\n⚠️ {ERROR_TEXT}" if partial else ERROR_TEXT
+        try:
+            await _edit(message, note, final=True)
+        except Exception:
+            log_exception(ctx=f"stream_reply error edit command={command}")
+        raise
+
+    final = text.strip()[:TG_LIMIT] or (empty_text or "")
+    if final and final != shown:
+        await _edit(message, final, final=True)
+        edits += 1
+        if ttfv_ms is None:
+            ttfv_ms = int((time.perf_counter() - started) * 1000)
+
+    log_event({
+        "type": "tg.stream_reply",
+        "command": command,
+        "chat_id": chat.id,
+        "placeholder_ms": placeholder_ms,
+        "ttfv_ms": ttfv_ms,
+        "total_ms": int((time.perf_counter() - started) * 1000),
+        "edits": edits,
+        "chars": len(text),
+    })
+    return text
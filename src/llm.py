@@ -1,44 +1,147 @@
-from typing import List, Tuple
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from email.utils import parsedate_to_datetime
+import asyncio
+import datetime as dt
 import json
+import random
 import time
 
 import httpx
 
-from .schemas import Msg
+from .schemas import AnyMsg
 from .configs import (
     LLM_PROVIDER, PROXY,
     GROQ_API_KEY, GROQ_BASEURL, GROQ_MODEL,
     OPENAI_API_KEY, OPENAI_BASEURL, OPENAI_MODEL,
+    LLM_HTTP2, LLM_MAX_CONCURRENCY, LLM_MAX_RETRIES, LLM_RETRY_BASE_DELAY, LLM_RETRY_MAX_DELAY,
+    B_MAX_TOOL_CALLS,
     N, K
 )
 from .db.logger import (
     log_llm_chat_start, log_llm_chat_end, log_exception
 )
+from .metrics import observe_llm
 
 
-async def _chat_complete(messages: list, temperature: float = 0.2) -> Tuple[str, int, int]:
+_client: Optional[httpx.AsyncClient] = None
+_in_flight: Dict[str, asyncio.Semaphore] = {}
+
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+async def start_llm_client() -> None:
+    """Создаёт долгоживущий HTTP-клиент (keep-alive, HTTP/2). Вызывать при старте бота."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(300, connect=20),
+            proxy=PROXY or None,
+            http2=LLM_HTTP2,
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONCURRENCY * 2,
+                max_keepalive_connections=LLM_MAX_CONCURRENCY,
+                keepalive_expiry=120,
+            ),
+        )
+
+async def close_llm_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+async def _get_client() -> httpx.AsyncClient:
+    if _client is None:
+        await start_llm_client()
+    return _client
+
+def _provider_conf() -> Tuple[str, str, Dict[str, str], str]:
     if LLM_PROVIDER == "groq":
         url = f"{GROQ_BASEURL}/chat/completions"
         headers = {"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"}
-        model = GROQ_MODEL
-        provider = "groq"
-    elif LLM_PROVIDER == "openai":
+        return "groq", url, headers, GROQ_MODEL
+    if LLM_PROVIDER == "openai":
         url = f"{OPENAI_BASEURL}/chat/completions"
         headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
-        model = OPENAI_MODEL
-        provider = "openai"
-    else:
-        raise RuntimeError(f"Неизвестный LLM_PROVIDER: {LLM_PROVIDER}")
+        return "openai", url, headers, OPENAI_MODEL
+    raise RuntimeError(f"Неизвестный LLM_PROVIDER: {LLM_PROVIDER}")
+
+def _semaphore(provider: str) -> asyncio.Semaphore:
+    sem = _in_flight.get(provider)
+    if sem is None:
+        sem = _in_flight[provider] = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+    return sem
+
+def _retry_delay(attempt: int, response: Optional[httpx.Response]) -> float:
+    """Экспоненциальная пауза с jitter; Retry-After от провайдера имеет приоритет."""
+    backoff = min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * (2 ** attempt))
+    jitter = random.uniform(0, backoff)
+    header = response.headers.get("retry-after") if response is not None else None
+    if header:
+        try:
+            wait = float(header)
+        except ValueError:
+            try:
+                wait = (parsedate_to_datetime(header) - dt.datetime.now(dt.timezone.utc)).total_seconds()
+            except Exception:
+                wait = 0.0
+        if wait > 0:
+            return min(LLM_RETRY_MAX_DELAY, wait) + random.uniform(0, LLM_RETRY_BASE_DELAY)
+    return jitter
 
+def _tracer(timings: Dict[str, Any], t_start: float):
+    """trace-колбэк httpcore: время TCP-коннекта, TLS и до первого байта ответа."""
+    started: Dict[str, float] = {}
+
+    async def trace(event: str, info: dict) -> None:
+        now = time.perf_counter()
+        name, _, phase = event.rpartition(".")
+        if phase == "started":
+            started[name] = now
+        elif phase == "complete":
+            t0 = started.get(name, now)
+            if name.endswith("connect_tcp"):
+                timings["connect_ms"] = timings.get("connect_ms", 0) + int((now - t0) * 1000)
+            elif name.endswith("start_tls"):
+                timings["tls_ms"] = timings.get("tls_ms", 0) + int((now - t0) * 1000)
+            elif name.endswith("receive_response_headers"):
+                timings["first_byte_ms"] = int((now - t_start) * 1000)
+    return trace
+
+
+async def _chat_complete(messages: list, temperature: float = 0.2, purpose: str = "chat") -> Tuple[str, int, int]:
+    """purpose — назначение вызова для метрик (summary, rollup, …)."""
+    provider, url, headers, model = _provider_conf()
     payload = {"model": model, "messages": messages, "temperature": temperature}
 
     req_meta = log_llm_chat_start(provider, model, messages, temperature)
+    client = await _get_client()
+    timings: Dict[str, Any] = {}
     t0 = time.perf_counter()
     try:
-        async with httpx.AsyncClient(timeout=300, proxy=PROXY or None) as client:
-            r = await client.post(url, headers=headers, json=payload)
-            r.raise_for_status()
-            data = r.json()
+        attempt = 0
+        while True:
+            timings = {"attempts": attempt + 1}
+            response: Optional[httpx.Response] = None
+            try:
+                async with _semaphore(provider):
+                    t_req = time.perf_counter()
+                    response = await client.post(
+                        url, headers=headers, json=payload,
+                        extensions={"trace": _tracer(timings, t_req)},
+                    )
+                timings["connect_ms"] = timings.get("connect_ms", 0)
+                timings["tls_ms"] = timings.get("tls_ms", 0)
+                timings["http_version"] = response.http_version
+                if response.status_code not in _RETRY_STATUSES or attempt >= LLM_MAX_RETRIES:
+                    response.raise_for_status()
+                    data = response.json()
+                    break
+            except httpx.TransportError:
+                if attempt >= LLM_MAX_RETRIES:
+                    raise
+            await asyncio.sleep(_retry_delay(attempt, response))
+            attempt += 1
 
         text = (data["choices"][0]["message"]["content"] or "").strip()
         usage = data.get("usage") or {}
@@ -46,17 +149,101 @@ async def _chat_complete(messages: list, temperature: float = 0.2) -> Tuple[str,
         tout = int(usage.get("completion_tokens") or 0)
         dt_ms = int((time.perf_counter() - t0) * 1000)
 
-        log_llm_chat_end(provider, model, req_meta, text, usage, latency_ms=dt_ms, ok=True)
+        log_llm_chat_end(provider, model, req_meta, text, usage, latency_ms=dt_ms, ok=True, timings=timings)
+        observe_llm(provider, model, purpose, False, time.perf_counter() - t0, usage, ok=True)
         return text, tin, tout
 
     except Exception:
         dt_ms = int((time.perf_counter() - t0) * 1000)
-        log_llm_chat_end(provider, model, req_meta, response_text="", usage=None, latency_ms=dt_ms, ok=False, error="HTTP/Parse error")
+        log_llm_chat_end(provider, model, req_meta, response_text="", usage=None, latency_ms=dt_ms, ok=False, error="HTTP/Parse error", timings=timings)
+        observe_llm(provider, model, purpose, False, time.perf_counter() - t0, None, ok=False)
         log_exception(ctx=f"_chat_complete provider={provider} model={model}")
         raise
 
 
-async def summarize_messages(msgs: List[Msg]) -> tuple[str,int,int]:
+async def _iter_sse(response: httpx.Response) -> AsyncIterator[dict]:
+    """События OpenAI-совместимого SSE-потока: строки «data: {...}», конец — «data: [DONE]»."""
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return
+        try:
+            yield json.loads(data)
+        except ValueError:
+            continue
+
+
+async def chat_stream(messages: list, temperature: float = 0.2, purpose: str = "chat") -> AsyncIterator[str]:
+    """
+    Потоковый вариант _chat_complete (stream: true): отдаёт фрагменты текста по мере генерации.
+    Повтор при 429/5xx/обрыве возможен только до первого фрагмента.
+    В конце, как и _chat_complete, пишет llm.chat_end с usage, латентностью и ttft_ms.
+    """
+    provider, url, headers, model = _provider_conf()
+    payload = {
+        "model": model, "messages": messages, "temperature": temperature,
+        "stream": True, "stream_options": {"include_usage": True},
+    }
+
+    req_meta = log_llm_chat_start(provider, model, messages, temperature)
+    client = await _get_client()
+    timings: Dict[str, Any] = {}
+    usage: Dict[str, Any] = {}
+    parts: List[str] = []
+    t0 = time.perf_counter()
+    try:
+        attempt = 0
+        while True:
+            timings = {"attempts": attempt + 1}
+            retry_response: Optional[httpx.Response] = None
+            try:
+                async with _semaphore(provider):
+                    t_req = time.perf_counter()
+                    async with client.stream(
+                        "POST", url, headers=headers, json=payload,
+                        extensions={"trace": _tracer(timings, t_req)},
+                    ) as response:
+                        if response.status_code in _RETRY_STATUSES and attempt < LLM_MAX_RETRIES:
+                            retry_response = response
+                        else:
+                            response.raise_for_status()
+                            timings["http_version"] = response.http_version
+                            async for event in _iter_sse(response):
+                                # Groq отдаёт usage в x_groq, OpenAI — в последнем чанке.
+                                usage = event.get("usage") or (event.get("x_groq") or {}).get("usage") or usage
+                                for choice in event.get("choices") or []:
+                                    delta = (choice.get("delta") or {}).get("content")
+                                    if delta:
+                                        timings.setdefault("ttft_ms", int((time.perf_counter() - t0) * 1000))
+                                        parts.append(delta)
+                                        yield delta
+                            break
+            except httpx.TransportError:
+                if parts or attempt >= LLM_MAX_RETRIES:
+                    raise
+            await asyncio.sleep(_retry_delay(attempt, retry_response))
+            attempt += 1
+
+        dt_ms = int((time.perf_counter() - t0) * 1000)
+        timings["connect_ms"] = timings.get("connect_ms", 0)
+        timings["tls_ms"] = timings.get("tls_ms", 0)
+        log_llm_chat_end(provider, model, req_meta, "".join(parts).strip(), usage,
+                         latency_ms=dt_ms, ok=True, timings=timings)
+        ttft_ms = timings.get("ttft_ms")
+        observe_llm(provider, model, purpose, True, time.perf_counter() - t0, usage, ok=True,
+                    ttft_s=ttft_ms / 1000 if ttft_ms is not None else None)
+
+    except Exception:
+        dt_ms = int((time.perf_counter() - t0) * 1000)
+        log_llm_chat_end(provider, model, req_meta, response_text="".join(parts), usage=None, latency_ms=dt_ms, ok=False, error="HTTP/Stream error", timings=timings)
+        observe_llm(provider, model, purpose, True, time.perf_counter() - t0, None, ok=False)
+        log_exception(ctx=f"chat_stream provider={provider} model={model}")
+        raise
+
+
+async def summarize_messages(msgs: List[AnyMsg]) -> tuple[str,int,int]:
     lines = [f"{m.ts.isoformat()}Z | {m.author}: {m.text}" for m in msgs]
     content = (
         "Ты — ассистент, который делает краткие выжимки переписок Telegram.\n"
@@ -68,7 +255,7 @@ async def summarize_messages(msgs: List[Msg]) -> tuple[str,int,int]:
         {"role": "system", "content": "Ты делаешь точные и лаконичные саммари чатов."},
         {"role": "user", "content": content},
     ]
-    return await _chat_complete(messages, temperature=0.2)
+    return await _chat_complete(messages, temperature=0.2, purpose="summary")
 
 
 async def summarize_summaries(sums: List[str]) -> Tuple[str, int, int]:
@@ -84,12 +271,15 @@ async def summarize_summaries(sums: List[str]) -> Tuple[str, int, int]:
         {"role": "system", "content": "Ты агрегируешь выжимки в компактную хронику."},
         {"role": "user", "content": content},
     ]
-    return await _chat_complete(messages, temperature=0.2)
+    return await _chat_complete(messages, temperature=0.2, purpose="rollup")
 
 
 RAG_SYSTEM = (
-    "Ты — помощник с доступом к базе чата. У тебя есть РОВНО ОДИН вызов инструмента (или ни одного).\n"
-    "Верни ЕДИНСТВЕННЫЙ блок: TOOL: {\"name\":\"<tool>\",\"args\":{...}} — либо финальный ответ без TOOL.\n\n"
+    f"Ты — помощник с доступом к базе чата. У тебя один шаг вызова инструментов: до {B_MAX_TOOL_CALLS} вызовов сразу (или ни одного).\n"
+    "Верни ЕДИНСТВЕННЫЙ блок со списком вызовов:\n"
+    "TOOL: [{\"name\":\"<tool>\",\"args\":{...}}, {\"name\":\"<tool>\",\"args\":{...}}]\n"
+    "— либо финальный ответ без TOOL. Вызовы выполняются параллельно, результаты придут вместе.\n"
+    "Комбинируй, если вопросу нужно несколько источников (например, контексты + поиск).\n\n"
     f"Размеры сжатия (важно для выбора инструмента):\n"
     f"• ОДИН контекст покрывает примерно {N*K} сообщений (≈ K выжимок по {N} сообщений каждая).\n"
     f"• ОДНА выжимка покрывает примерно {N} сообщений.\n"
@@ -103,18 +293,37 @@ RAG_SYSTEM = (
     "   • Баланс: компактно, но детальнее, чем контексты.\n"
     "3) get_messages_window {\"n\":200}\n"
     "   • Нужны свежие детали/цитаты из последних сообщений. Бери n 100–300.\n"
-    "4) search_messages {\"query\":\"...\",\"window\":5000,\"limit\":50}\n"
-    "   • Поиск конкретной темы/имени в недавних сообщениях (окно по msg_id).\n"
-    "   • При вопросах про конкретного человека/объект сначала пробуй это.\n\n"
+    "4) search_messages {\"query\":\"...\",\"limit\":50}\n"
+    "   • Полнотекстовый поиск темы/имени по ВСЕЙ истории чата, результаты по релевантности.\n"
+    "   • Можно сузить до последних сообщений: \"window\":5000.\n"
+    "   • При вопросах про конкретного человека/объект сначала пробуй это.\n"
+    "5) semantic_search {\"query\":\"...\",\"limit\":20}\n"
+    "   • Поиск по смыслу среди сообщений и выжимок, когда точных слов вопроса в чате может не быть\n"
+    "     (перефразировки, «обсуждали ли мы…»). Дешевле, чем большое окно сообщений.\n"
+    "6) get_stats {\"days\":7,\"top\":10}\n"
+    "   • Статистика активности за последние days суток: кто сколько писал, сообщения по дням и часам (UTC).\n"
+    "   • Для вопросов «кто больше всех писал», «сколько сообщений в день» — точные числа, не читай сообщения.\n\n"
     "Если вопрос можно ответить без данных — отвечай сразу, без TOOL."
 )
-def parse_tool_call(text: str) -> dict | None:
+
+
+def parse_tool_calls(text: str) -> List[Dict[str, Any]]:
+    """
+    Все вызовы инструментов из ответа: после каждого маркера TOOL: — JSON-объект
+    или список объектов. Не больше B_MAX_TOOL_CALLS, без повторов.
+    """
     marker = "TOOL:"
+    decoder = json.JSONDecoder()
+    calls: List[Dict[str, Any]] = []
     idx = text.find(marker)
-    if idx == -1:
-        return None
-    js = text[idx+len(marker):].strip()
-    try:
-        return json.loads(js)
-    except Exception:
-        return None
+    while idx != -1:
+        js = text[idx+len(marker):].lstrip()
+        try:
+            obj, _ = decoder.raw_decode(js)
+        except ValueError:
+            obj = None
+        for call in (obj if isinstance(obj, list) else [obj]):
+            if isinstance(call, dict) and call.get("name") and call not in calls:
+                calls.append(call)
+        idx = text.find(marker, idx + len(marker))
+    return calls[:B_MAX_TOOL_CALLS]
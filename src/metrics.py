@@ -0,0 +1,288 @@
+"""
+Метрики процесса в формате Prometheus: счётчики, гистограммы и gauge'и,
+значения которых снимаются колбэком в момент scrape. HTTP-эндпоинт /metrics
+поднимается в event loop бота (METRICS_PORT, 0 — выключен).
+"""
+from __future__ import annotations
+
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import asyncio
+import functools
+import threading
+import time
+
+from .configs import METRICS_HOST, METRICS_PORT
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _fmt_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _num(x: float) -> str:
+    return repr(float(x)) if x != int(x) else str(int(x))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, values: Sequence[object]) -> LabelValues:
+        if len(values) != len(self.labels):
+            raise ValueError(f"{self.name}: ожидались метки {self.labels}")
+        return tuple(str(v) for v in values)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        super().__init__(name, doc, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: object, value: float = 1) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {_num(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+        # метки -> [счётчики по корзинам (+Inf последней), сумма]
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, seconds: float, *labels: object) -> None:
+        key = self._key(labels)
+        i = bisect_left(self.buckets, seconds)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[i] += 1
+            total[0] += seconds
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = [(k, list(c), t[0]) for k, (c, t) in self._values.items()]
+        out: List[str] = []
+        for key, counts, total in items:
+            acc = 0
+            for le, c in zip(self.buckets + (float("inf"),), counts):
+                acc += c
+                le_label = 'le="%s"' % ("+Inf" if le == float("inf") else _num(le))
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, key, le_label)} {acc}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, key)} {_num(total)}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, key)} {acc}")
+        return out
+
+
+class CallbackGauge(_Metric):
+    """Gauge, значения которого считаются при scrape: fn() -> {значения меток: число}."""
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str], fn: Callable[[], Dict[LabelValues, float]]):
+        super().__init__(name, doc, labels)
+        self.fn = fn
+
+    def _samples(self) -> List[str]:
+        try:
+            values = self.fn()
+        except Exception:
+            return []
+        return [
+            f"{self.name}{_fmt_labels(self.labels, tuple(str(x) for x in k))} {_num(v)}"
+            for k, v in values.items() if v is not None
+        ]
+
+
+class CallbackCounter(CallbackGauge):
+    """То же для монотонных счётчиков, которые ведутся в другом месте (статистика кэшей): rate() работает."""
+    kind = "counter"
+
+
+_registry: List[_Metric] = []
+
+def _register(m: _Metric) -> _Metric:
+    _registry.append(m)
+    return m
+
+def counter(name: str, doc: str, labels: Sequence[str] = ()) -> Counter:
+    return _register(Counter(name, doc, labels))
+
+def histogram(name: str, doc: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram(name, doc, labels, buckets))
+
+def gauge(name: str, doc: str, labels: Sequence[str], fn: Callable[[], Dict[LabelValues, float]]) -> CallbackGauge:
+    return _register(CallbackGauge(name, doc, labels, fn))
+
+def callback_counter(name: str, doc: str, labels: Sequence[str],
+                     fn: Callable[[], Dict[LabelValues, float]]) -> CallbackCounter:
+    return _register(CallbackCounter(name, doc, labels, fn))
+
+def render() -> str:
+    lines: List[str] = []
+    for m in _registry:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+DB_CALL_SECONDS = histogram("tg_db_call_seconds", "Длительность функций src/db через run_db (с ожиданием пула)", ["fn"])
+DB_CALL_ERRORS = counter("tg_db_call_errors_total", "Исключения функций src/db", ["fn"])
+CH_SERVER_SECONDS = histogram(
+    "tg_ch_server_seconds", "Время выполнения запроса на сервере ClickHouse (X-ClickHouse-Summary)", ["fn"])
+CH_READ_ROWS = counter("tg_ch_read_rows_total", "Строки, прочитанные ClickHouse", ["fn"])
+CH_READ_BYTES = counter("tg_ch_read_bytes_total", "Байты, прочитанные ClickHouse", ["fn"])
+LLM_REQUEST_SECONDS = histogram(
+    "tg_llm_request_seconds", "Длительность запросов к LLM", ["provider", "model", "purpose", "stream"])
+LLM_TTFT_SECONDS = histogram(
+    "tg_llm_ttft_seconds", "Время до первого токена потокового ответа", ["provider", "model", "purpose"])
+LLM_TOKENS = counter("tg_llm_tokens_total", "Токены LLM", ["provider", "model", "purpose", "direction"])
+LLM_ERRORS = counter("tg_llm_errors_total", "Неуспешные запросы к LLM", ["provider", "model", "purpose"])
+HANDLER_SECONDS = histogram("tg_handler_seconds", "Длительность обработки команд и сообщений", ["command"])
+HANDLER_ERRORS = counter("tg_handler_errors_total", "Исключения в хэндлерах", ["command"])
+
+
+def observe_ch_summary(fn: str, summary: Optional[dict]) -> None:
+    """Серверная сторона запроса из заголовка X-ClickHouse-Summary (elapsed_ns — в свежих версиях сервера)."""
+    if not summary:
+        return
+    elapsed_ns = summary.get("elapsed_ns")
+    if elapsed_ns is not None:
+        CH_SERVER_SECONDS.observe(int(elapsed_ns) / 1e9, fn)
+    CH_READ_ROWS.inc(fn, value=int(summary.get("read_rows") or 0))
+    CH_READ_BYTES.inc(fn, value=int(summary.get("read_bytes") or 0))
+
+
+def observe_llm(provider: str, model: str, purpose: str, stream: bool, seconds: float,
+                usage: Optional[dict], ok: bool, ttft_s: Optional[float] = None) -> None:
+    LLM_REQUEST_SECONDS.observe(seconds, provider, model, purpose, "1" if stream else "0")
+    if ttft_s is not None:
+        LLM_TTFT_SECONDS.observe(ttft_s, provider, model, purpose)
+    if not ok:
+        LLM_ERRORS.inc(provider, model, purpose)
+        return
+    usage = usage or {}
+    LLM_TOKENS.inc(provider, model, purpose, "in", value=int(usage.get("prompt_tokens") or 0))
+    LLM_TOKENS.inc(provider, model, purpose, "out", value=int(usage.get("completion_tokens") or 0))
+
+
+def timed_handler(command: str, fn: Callable):
+    """Обёртка хэндлера PTB: длительность и исключения по команде."""
+    @functools.wraps(fn)
+    async def wrapper(update, ctx):
+        t0 = time.perf_counter()
+        try:
+            return await fn(update, ctx)
+        except Exception:
+            HANDLER_ERRORS.inc(command)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - t0, command)
+    return wrapper
+
+
+_server: Optional[asyncio.base_events.Server] = None
+
+async def _serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, ctype, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", render().encode("utf-8")
+        else:
+            status, ctype, body = "404 Not Found", "text/plain", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def start_metrics_server() -> None:
+    global _server
+    if METRICS_PORT and _server is None:
+        _server = await asyncio.start_server(_serve, METRICS_HOST, METRICS_PORT)
+
+async def close_metrics_server() -> None:
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
+
+
+
+# Состояние очередей и кэшей снимается при scrape; модули импортируются лениво —
+# metrics импортируется из src/db и не должен тянуть их при загрузке.
+def _summarizer_backlog() -> Dict[LabelValues, float]:
+    from .workers import _pipelines
+    return {(chat_id,): p.pending for chat_id, p in list(_pipelines.items())}
+
+def _queues() -> Dict[LabelValues, float]:
+    from .db.ingest import ingest_stats
+    from .db.logger import log_stats
+    return {("ingest",): ingest_stats()["queue_depth"], ("logs",): log_stats()["queue_depth"]}
+
+def _queue_dropped() -> Dict[LabelValues, float]:
+    from .db.ingest import ingest_stats
+    from .db.logger import log_stats
+    return {("ingest",): ingest_stats()["dropped"], ("logs",): log_stats()["dropped"]}
+
+def _cache_counts() -> Dict[LabelValues, float]:
+    from .t_cache import t_cache
+    from .db.users import user_cache_stats
+    from .tools import tool_cache_stats
+    out: Dict[LabelValues, float] = {}
+    caches = {"t": t_cache.stats(), "users": user_cache_stats(), **tool_cache_stats()}
+    for cache, st in caches.items():
+        for result in ("hits", "partial", "misses"):
+            if result in st:
+                out[(cache, result)] = st[result]
+    return out
+
+def _cache_hit_rate() -> Dict[LabelValues, float]:
+    out: Dict[LabelValues, float] = {}
+    by_cache: Dict[str, Dict[str, float]] = {}
+    for (cache, result), v in _cache_counts().items():
+        by_cache.setdefault(cache, {})[result] = v
+    for cache, st in by_cache.items():
+        total = sum(st.values())
+        out[(cache,)] = (total - st.get("misses", 0)) / total if total else 0.0
+    return out
+
+
+gauge("tg_summarizer_backlog_messages", "Сообщения, ещё не вошедшие в выжимки", ["chat_id"], _summarizer_backlog)
+gauge("tg_queue_depth", "Глубина очередей записи в БД", ["queue"], _queues)
+callback_counter("tg_queue_dropped_total", "Строки, отброшенные переполненными очередями записи", ["queue"], _queue_dropped)
+callback_counter("tg_cache_requests_total", "Обращения к кэшам по результату", ["cache", "result"], _cache_counts)
+gauge("tg_cache_hit_ratio", "Доля попаданий (включая частичные) по кэшам", ["cache"], _cache_hit_rate)
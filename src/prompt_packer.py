@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+from typing import Any, Dict, List, Sequence
+import json
+
+from .configs import LLM_PROVIDER, GROQ_PROMPT_BUDGET, OPENAI_PROMPT_BUDGET
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Локальная оценка числа токенов без токенизатора: ~4 байта UTF-8 на токен.
+    Для кириллицы (2 байта на символ) оценка завышена — бюджет выходит с запасом.
+    """
+    return len(text.encode("utf-8")) // 4 + 1
+
+def prompt_budget() -> int:
+    """Бюджет токенов на весь промпт для текущего LLM_PROVIDER."""
+    return OPENAI_PROMPT_BUDGET if LLM_PROVIDER == "openai" else GROQ_PROMPT_BUDGET
+
+
+class Packed:
+    __slots__ = ("contexts", "summaries", "raw", "tokens", "dropped_tokens", "dropped_items")
+
+    def __init__(self) -> None:
+        self.contexts: List[str] = []
+        self.summaries: List[str] = []
+        self.raw: List[str] = []
+        self.tokens = 0
+        self.dropped_tokens = 0
+        self.dropped_items = 0
+
+    def report(self) -> Dict[str, int]:
+        return {
+            "packed_tokens": self.tokens,
+            "dropped_tokens": self.dropped_tokens,
+            "dropped_items": self.dropped_items,
+            "contexts": len(self.contexts),
+            "summaries": len(self.summaries),
+            "raw": len(self.raw),
+        }
+
+
+def _take_newest(items: Sequence[str], budget: int, packed: Packed) -> List[str]:
+    """
+    Берёт элементы с конца (самые свежие), пока они целиком помещаются в budget.
+    Первый не поместившийся и всё, что старше, отбрасываются — без разрывов в хронологии.
+    """
+    kept: List[str] = []
+    costs = [estimate_tokens(t) for t in items]
+    i = len(items) - 1
+    while i >= 0 and packed.tokens + costs[i] <= budget:
+        kept.append(items[i])
+        packed.tokens += costs[i]
+        i -= 1
+    packed.dropped_items += i + 1
+    packed.dropped_tokens += sum(costs[:i + 1])
+    kept.reverse()
+    return kept
+
+def pack_materials(ctx_texts: Sequence[str], sum_texts: Sequence[str], raw_lines: Sequence[str],
+                   budget: int) -> Packed:
+    """
+    Укладывает материалы /t в budget токенов по приоритету контексты > выжимки > хвост.
+    Элементы не режутся: не влез — отбрасывается целиком.
+    """
+    packed = Packed()
+    packed.contexts = _take_newest(ctx_texts, budget, packed)
+    packed.summaries = _take_newest(sum_texts, budget, packed)
+    packed.raw = _take_newest(raw_lines, budget, packed)
+    return packed
+
+def pack_records(records: Sequence[Any], budget: int, keep: str = "tail") -> tuple[str, Dict[str, int]]:
+    """
+    Сериализует записи инструмента в JSON-массив не длиннее budget токенов, не разрезая записи.
+    keep="tail" — сохраняются последние (хронологические списки),
+    keep="head" — первые (списки, отсортированные по релевантности).
+    """
+    parts = [json.dumps(r, ensure_ascii=False) for r in records]
+    costs = [estimate_tokens(p) for p in parts]
+    order = range(len(parts)) if keep == "head" else range(len(parts) - 1, -1, -1)
+
+    used = 1
+    taken: List[int] = []
+    for i in order:
+        if used + costs[i] > budget:
+            break
+        taken.append(i)
+        used += costs[i]
+    taken.sort()
+
+    kept = set(taken)
+    dropped = [i for i in range(len(parts)) if i not in kept]
+    report = {
+        "packed_tokens": used,
+        "dropped_tokens": sum(costs[i] for i in dropped),
+        "packed_items": len(taken),
+        "dropped_items": len(dropped),
+    }
+    return "[" + ",".join(parts[i] for i in taken) + "]", report
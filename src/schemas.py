@@ -1,10 +1,29 @@
+from typing import NamedTuple, Optional, Union
 from pydantic import BaseModel
 import datetime as dt
 
 
 class Msg(BaseModel):
+    chat_id: int
     tg_msg_id: int
     user_id: int
     text: str
     ts: dt.datetime
     author: str | None = None
+
+
+class MsgRow(NamedTuple):
+    """
+    Сообщение во внутренних пакетных путях (выборки из БД, выжимки, окна):
+    кортеж без валидации и __dict__, автор заполняется сразу при создании.
+    Поля и их имена — как у Msg, поэтому потребители принимают оба.
+    """
+    chat_id: int
+    tg_msg_id: int
+    user_id: int
+    text: str
+    ts: dt.datetime
+    author: Optional[str] = None
+
+
+AnyMsg = Union[Msg, MsgRow]
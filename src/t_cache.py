@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+import time
+
+from .db.watermarks import ChatMarks
+from .configs import T_CACHE_SIZE, T_CACHE_TTL, T_CACHE_DELTA_MAX
+
+
+class TEntry:
+    __slots__ = ("n", "text", "msg_mark", "batch_mark", "ctx_mark", "created")
+
+    def __init__(self, n: int, text: str, marks: Tuple[int, int, int]):
+        self.n = n
+        self.text = text
+        self.msg_mark, self.batch_mark, self.ctx_mark = marks
+        self.created = time.monotonic()
+
+
+class TCache:
+    """
+    Кэш ответов /t: ключ — (chat_id, корзина n), значение помечено водяными знаками
+    (сообщения/выжимки/контексты), из которых оно собрано. Проверка идёт только по
+    водяным знакам в памяти, без запросов к БД. Вытеснение — LRU и по возрасту.
+    """
+
+    def __init__(self, size: int, ttl: float, delta_max: int):
+        self.size = size
+        self.ttl = ttl
+        self.delta_max = delta_max
+        self._entries: "OrderedDict[Tuple[int, int], TEntry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def bucket(n: int) -> int:
+        return 1 << max(0, n - 1).bit_length()
+
+    def get(self, chat_id: int, n: int, marks: ChatMarks) -> Optional[TEntry]:
+        key = (chat_id, self.bucket(n))
+        e = self._entries.get(key)
+        fresh = (
+            e is not None
+            and e.n >= n
+            and time.monotonic() - e.created <= self.ttl
+            and e.batch_mark == marks.last_batch_id
+            and e.ctx_mark == marks.last_context_id
+            and marks.last_msg_id - e.msg_mark <= self.delta_max
+        )
+        if not fresh:
+            if e is not None and time.monotonic() - e.created > self.ttl:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return e
+
+    def put(self, chat_id: int, n: int, text: str, marks: Tuple[int, int, int]) -> None:
+        key = (chat_id, self.bucket(n))
+        self._entries[key] = TEntry(n, text, marks)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+            "size": len(self._entries),
+        }
+
+
+t_cache = TCache(T_CACHE_SIZE, T_CACHE_TTL, T_CACHE_DELTA_MAX)
@@ -1,30 +1,45 @@
 from __future__ import annotations
 
-from .db.materials import (
-    get_oldest_ts_of_last_n, fetch_contexts_since, fetch_summaries_since, fetch_raw_since
-)
+from datetime import datetime
+from typing import Dict, List, Sequence, Tuple
 
+from .db.materials import get_range_of_last_n, fetch_tree_meta, fetch_materials
 
-def build_materials_for_last_n(n: int, raw_tail_limit: int = 200) -> tuple[list[str], list[str], list]:
+
+def pick_cover(meta: Sequence[Tuple[int, int, int, int, datetime]], oldest: datetime) -> Dict[int, List[int]]:
+    """
+    Наименьший набор самых крупных узлов, покрывающих интервал [oldest, now].
+    Сверху вниз: узел берётся, если целиком лежит в интервале и не покрыт выбранным предком;
+    покрытие (выбранного или уже покрытого узла) спускается на его детей.
+    На нижнем уровне (выжимки) берутся и узлы, лишь пересекающие начало интервала.
+    meta — как из fetch_tree_meta: уровни по убыванию.
+    """
+    picked: Dict[int, List[int]] = {}
+    covered: Dict[int, List[Tuple[int, int]]] = {}
+    for level, id_, from_child, to_child, from_ts in meta:
+        is_covered = any(lo <= id_ <= hi for lo, hi in covered.get(level, ()))
+        if not is_covered and (level == 0 or from_ts >= oldest):
+            picked.setdefault(level, []).append(id_)
+            is_covered = True
+        if is_covered and level > 0:
+            covered.setdefault(level - 1, []).append((from_child, to_child))
+    return picked
+
+
+def build_materials_for_last_n(chat_id: int, n: int, raw_tail_limit: int = 200) -> tuple[list[str], list[str], list]:
     """
     Возвращает (contexts_texts, summaries_texts, raw_msgs)
-    Логика: покрыть интервал последних n сообщений по времени:
-      1) контексты, что пересекают этот интервал,
-      2) затем выжимки после последнего контекста,
-      3) затем хвост сырых (лимитируем).
+    Логика: покрыть интервал последних n сообщений чата по времени:
+      1) самые крупные узлы дерева сжатия (свёртки, контексты), целиком лежащие в интервале,
+         — число узлов растёт примерно логарифмически с n,
+      2) остаток покрывают выжимки,
+      3) затем хвост сырых (не больше min(n, raw_tail_limit)).
+    Три запроса независимо от n: границы окна агрегатом, метаданные узлов, тексты одним UNION ALL.
     """
-    oldest = get_oldest_ts_of_last_n(n)
+    last_id, oldest = get_range_of_last_n(chat_id, n)
     if not oldest:
         return [], [], []
 
-    contexts = fetch_contexts_since(oldest)
-    ctx_texts = [t for (t, _) in contexts]
-    ctx_end = max((t for (_, t) in contexts), default=oldest)
-
-    sums = fetch_summaries_since(ctx_end)
-    sum_texts = [t for (t, _) in sums]
-    sum_end = max((t for (_, t) in sums), default=ctx_end)
-
-    raw_msgs = fetch_raw_since(sum_end, limit=raw_tail_limit)
-
-    return ctx_texts, sum_texts, raw_msgs
+    nodes = pick_cover(fetch_tree_meta(chat_id, oldest), oldest)
+    raw_from = max(0, last_id - min(n, raw_tail_limit))
+    return fetch_materials(chat_id, nodes, raw_from)
@@ -0,0 +1,104 @@
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+import asyncio
+import time
+
+from .db.aio import (
+    tool_get_messages_window, tool_search_messages, tool_semantic_search,
+    tool_get_summaries, tool_get_contexts, tool_get_stats,
+)
+from .db.messages import window_cache
+from .db.summaries import summary_ring
+from .db.contexts import context_ring
+from .configs import STATS_DEFAULT_DAYS, STATS_TOP_USERS
+
+
+ToolFn = Callable[[int, Dict[str, Any]], Awaitable[List[Dict[str, Any]]]]
+
+
+async def _get_contexts(chat_id: int, args: Dict[str, Any]):
+    return await tool_get_contexts(chat_id, limit=int(args.get("limit", 5)))
+
+
+async def _get_summaries(chat_id: int, args: Dict[str, Any]):
+    return await tool_get_summaries(chat_id, limit=int(args.get("limit", 10)))
+
+
+async def _get_messages_window(chat_id: int, args: Dict[str, Any]):
+    return await tool_get_messages_window(chat_id, n=int(args.get("n", 200)))
+
+
+async def _search_messages(chat_id: int, args: Dict[str, Any]):
+    return await tool_search_messages(
+        chat_id,
+        query=args.get("query", ""),
+        window=int(args.get("window", 0)),
+        limit=int(args.get("limit", 50)),
+    )
+
+
+async def _semantic_search(chat_id: int, args: Dict[str, Any]):
+    return await tool_semantic_search(
+        chat_id,
+        query=args.get("query", ""),
+        limit=int(args.get("limit", 20)),
+    )
+
+
+async def _get_stats(chat_id: int, args: Dict[str, Any]):
+    return await tool_get_stats(
+        chat_id,
+        days=int(args.get("days", STATS_DEFAULT_DAYS)),
+        top=int(args.get("top", STATS_TOP_USERS)),
+    )
+
+
+# имя → (функция, какой край списка сохранять при упаковке в бюджет):
+# у поиска результаты отсортированы по релевантности — держим голову,
+# у хронологических инструментов — самое свежее, хвост.
+TOOLS: Dict[str, Tuple[ToolFn, str]] = {
+    "get_contexts": (_get_contexts, "tail"),
+    "get_summaries": (_get_summaries, "tail"),
+    "get_messages_window": (_get_messages_window, "tail"),
+    "search_messages": (_search_messages, "head"),
+    "semantic_search": (_semantic_search, "head"),
+    "get_stats": (_get_stats, "head"),
+}
+
+
+async def run_tool(chat_id: int, call: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Выполнить один вызов {"name":..., "args":{...}}.
+    Ошибки не пробрасываются — попадают в поле error, чтобы соседние вызовы
+    из того же gather'а не терялись.
+    """
+    name = call.get("name")
+    args = call.get("args") or {}
+    if not isinstance(args, dict):
+        args = {}
+    out: Dict[str, Any] = {"name": name, "args": args, "data": [], "error": None,
+                           "keep": "tail", "latency_ms": 0}
+    entry = TOOLS.get(name)
+    if entry is None:
+        out["error"] = "unknown tool"
+        return out
+    fn, out["keep"] = entry
+    t0 = time.perf_counter()
+    try:
+        out["data"] = await fn(chat_id, args)
+    except Exception as e:
+        out["error"] = f"{type(e).__name__}: {e}"
+    out["latency_ms"] = int((time.perf_counter() - t0) * 1000)
+    return out
+
+
+async def run_tools(chat_id: int, calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Все вызовы одного шага — параллельно; порядок результатов = порядку вызовов."""
+    return list(await asyncio.gather(*(run_tool(chat_id, c) for c in calls)))
+
+
+def tool_cache_stats() -> Dict[str, Dict[str, int]]:
+    return {
+        "summaries": summary_ring.stats(),
+        "contexts": context_ring.stats(),
+        "messages_window": window_cache.stats(),
+    }
@@ -0,0 +1,50 @@
+"""
+Сборка Application и приём апдейтов в режиме UPDATES_MODE: long polling или webhook.
+Хэндлеры одни и те же (register_handlers) — режим меняет только транспорт.
+"""
+from __future__ import annotations
+
+import secrets
+
+from telegram.ext import Application
+
+from .configs import (
+    BOT_TOKEN, TELEGRAM_API_URL, UPDATES_MODE,
+    WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS,
+)
+
+MODES = ("polling", "webhook")
+
+
+def build_application(token: str = BOT_TOKEN) -> Application:
+    builder = Application.builder().token(token)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    return builder.build()
+
+
+async def start_updates(app: Application, mode: str = UPDATES_MODE) -> None:
+    """
+    Запускает приём апдейтов (после app.start()). Webhook: локальный HTTP-сервер
+    на WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_PATH и setWebhook с секретом; polling
+    при старте сам снимает webhook, так что режимы можно переключать перезапуском.
+    """
+    if mode not in MODES:
+        raise ValueError(f"UPDATES_MODE: ожидалось одно из {MODES}, получено {mode!r}")
+    if mode == "polling":
+        await app.updater.start_polling()
+        return
+    await app.updater.start_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=WEBHOOK_URL or None,
+        secret_token=WEBHOOK_SECRET or secrets.token_urlsafe(32),
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+
+
+async def stop_updates(app: Application) -> None:
+    """Останавливает polling или webhook-сервер; апдейты, уже принятые в очередь, дообрабатывает app.stop()."""
+    if app.updater is not None and app.updater.running:
+        await app.updater.stop()
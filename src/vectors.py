@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+from collections import Counter
+from typing import List
+import math
+import re
+import zlib
+
+from .configs import VECTOR_DIM
+
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def _features(text: str) -> Counter:
+    """Слова целиком и символьные 3-граммы слов с границами: « проект » → « пр», «про», ..."""
+    feats: Counter = Counter()
+    for w in _WORD.findall(text.lower().replace("ё", "е")):
+        feats["w:" + w] += 1
+        padded = f" {w} "
+        for i in range(len(padded) - 2):
+            feats[padded[i:i + 3]] += 1
+    return feats
+
+def embed(text: str) -> List[float]:
+    """
+    Локальный вектор текста без внешних сервисов: hashing trick по словам и 3-граммам,
+    сублинейный tf (1 + log tf), знак из хэша против коллизий, L2-нормировка.
+    Хэш — crc32 (стабилен между процессами, в отличие от hash()).
+    Пустой текст — пустой список (такие строки в поиске пропускаются).
+    """
+    vec = [0.0] * VECTOR_DIM
+    for feat, tf in _features(text).items():
+        h = zlib.crc32(feat.encode("utf-8"))
+        sign = 1.0 if h & 0x80000000 else -1.0
+        vec[h % VECTOR_DIM] += sign * (1.0 + math.log(tf))
+    norm = math.sqrt(sum(x * x for x in vec))
+    if norm == 0.0:
+        return []
+    return [x / norm for x in vec]
@@ -1,35 +1,363 @@
 import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, List, Tuple
 
-from .db import get_ch
-from .db.summaries import get_last_summarized_msg_id, insert_summary, get_next_batch
-from .db.contexts import get_last_context_batch_id, insert_context
+from .schemas import AnyMsg, Msg
+from .db.aio import (
+    get_last_summarized_msg_id, insert_summary, get_next_batch, get_next_batches, count_messages_after,
+    insert_context, get_rollup_marks, fetch_nodes_after, insert_rollup, get_summarized_spans,
+    get_summary_batch_ids, backfill_search_index, pending_search_gaps, repair_search_gap,
+)
+from .db.ingest import flush_due, flush_messages_async, add_flush_listener
+from .db import run_db
+from .db.migrations import apply_migrations
+from .db.logger import log_event, log_exception, flush_logs, logs_flush_due
 from .llm import summarize_messages, summarize_summaries
-from .configs import N, K
+from .configs import (
+    N, K, ALLOWED_CHAT_IDS, ROLLUP_MAX_LEVEL, SEARCH_REPAIR_INTERVAL,
+    WORKER_RETRY_BASE_DELAY, WORKER_RETRY_MAX_DELAY,
+    SUMMARIZER_CATCHUP_MIN_BATCHES, SUMMARIZER_CATCHUP_CONCURRENCY, SUMMARIZER_CATCHUP_REPORT_EVERY,
+)
+
+
+class ChatSummarizer:
+    """
+    Независимый конвейер выжимок и дерева свёрток одного чата
+    (уровень 1 — контексты из K выжимок, уровень L+1 — свёртка K узлов уровня L).
+    Водяные знаки живут в памяти: из БД читаются только при старте,
+    дальше их двигает сам конвейер, а счётчик pending — путь вставки (on_flush).
+    """
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.last_to = 0
+        self.rolled: Dict[int, int] = {}  # уровень -> последний свёрнутый id уровня ниже
+        self.pending = 0
+        self.committed = 0  # выжимок за этот запуск: по нему супервизор сбрасывает паузу перезапуска
+        self.batch_ready = asyncio.Event()
+
+    def on_flush(self, rows: List[Msg]) -> None:
+        self.pending += sum(1 for m in rows if m.tg_msg_id > self.last_to and m.text)
+        if self.pending >= N:
+            self.batch_ready.set()
+
+    async def _load(self) -> None:
+        self.last_to = await get_last_summarized_msg_id(self.chat_id)
+        self.rolled = await get_rollup_marks(self.chat_id)
+        self.pending += await count_messages_after(self.chat_id, self.last_to)
+        # Дерево могло отстать (например, уровни выше контекстов появились позже истории).
+        await self.maybe_roll_up(full=True)
+
+    async def backfill(self) -> None:
+        """Разовая догонка без ожидания новых сообщений (для импорта истории): все полные батчи и свёртки."""
+        await self._load()
+        while self.pending >= N:
+            before = self.last_to
+            await self.catch_up()
+            if self.last_to == before:
+                break
+
+    async def backfill_range(self, first_id: int, last_id: int) -> int:
+        """
+        Выжимки для уже записанного диапазона [first_id, last_id] (импорт прошлой истории):
+        только промежутки, не покрытые существующими выжимками. Хвост промежутка короче N
+        дописывается к последнему батчу (см. get_next_batches), поэтому batch_id = last // N
+        не совпадает с соседними полными выжимками; промежуток короче N целиком — один неполный
+        батч, и если его batch_id уже занят, он пропускается (tg_summaries — не Replacing,
+        две выжимки с одним batch_id задвоились бы в /t и в кольце).
+        Водяные знаки конвейера не двигает; в дерево свёрток эти выжимки не попадают
+        (оно растёт вперёд от своих отметок), /t берёт их с уровня выжимок.
+        Возвращает число новых выжимок.
+        """
+        gaps: List[Tuple[int, int]] = []
+        cursor = first_id - 1
+        for lo, hi in await get_summarized_spans(self.chat_id, first_id, last_id):
+            if lo - 1 > cursor:
+                gaps.append((cursor, lo - 1))
+            cursor = max(cursor, hi)
+        if cursor < last_id:
+            gaps.append((cursor, last_id))
+
+        taken = await get_summary_batch_ids(self.chat_id, first_id // N, last_id // N)
+        made = skipped = 0
+        for after, upto in gaps:
+            while True:
+                batches = await get_next_batches(self.chat_id, after, N, SUMMARIZER_CATCHUP_CONCURRENCY, upto)
+                if not batches:
+                    break
+                after = batches[-1][-1].tg_msg_id
+                fresh = [msgs for msgs in batches if msgs[-1].tg_msg_id // N not in taken]
+                skipped += len(batches) - len(fresh)
+                done = await asyncio.gather(*(summarize_messages(msgs) for msgs in fresh))
+                for msgs, (text, ti, to) in zip(fresh, done):
+                    batch_id = msgs[-1].tg_msg_id // N
+                    await insert_summary(self.chat_id, batch_id, msgs, text, ti, to)
+                    taken.add(batch_id)
+                made += len(fresh)
+                log_event({"type": "summarizer.range_progress", "chat_id": self.chat_id,
+                           "upto_msg_id": upto, "done_msg_id": after, "summaries": made,
+                           "skipped_taken_ids": skipped})
+        return made
+
+    async def run(self) -> None:
+        await self._load()
+
+        while True:
+            if self.pending < N:
+                self.batch_ready.clear()
+                await self.batch_ready.wait()
+                continue
+            if self.pending >= SUMMARIZER_CATCHUP_MIN_BATCHES * N:
+                await self.catch_up()
+                continue
+            msgs = await get_next_batch(self.chat_id, self.last_to, N)
+            if len(msgs) < N:
+                self.pending = len(msgs)
+                continue
+            text, ti, to = await summarize_messages(msgs)
+            await self._commit_batch(msgs, text, ti, to)
+
+    async def _commit_batch(self, msgs: List[AnyMsg], text: str, ti: int, to: int) -> None:
+        batch_id = (msgs[-1].tg_msg_id // N)
+        await insert_summary(self.chat_id, batch_id, msgs, text, ti, to)
+        self.last_to = msgs[-1].tg_msg_id
+        self.pending = max(0, self.pending - len(msgs))
+        self.committed += 1
+        await self.maybe_roll_up()
+
+    async def catch_up(self) -> None:
+        """
+        Догоняет накопившийся бэклог: до SUMMARIZER_CATCHUP_CONCURRENCY батчей
+        саммаризируются параллельно, но в tg_summaries коммитятся строго по порядку,
+        и свёртки собираются, как только готовы очередные K узлов уровня ниже.
+        """
+        total = self.pending // N
+        sem = asyncio.Semaphore(SUMMARIZER_CATCHUP_CONCURRENCY)
+        window: Deque[Tuple[List[AnyMsg], asyncio.Task]] = deque()
+        cursor = self.last_to
+        done = 0
+        t0 = time.perf_counter()
+
+        async def summarize(msgs: List[AnyMsg]):
+            async with sem:
+                return await summarize_messages(msgs)
+
+        def report(final: bool = False) -> None:
+            elapsed = max(time.perf_counter() - t0, 1e-6)
+            rate = done / elapsed
+            left = max(0, self.pending // N)
+            log_event({
+                "type": "summarizer.catchup_done" if final else "summarizer.catchup_progress",
+                "chat_id": self.chat_id,
+                "batches_done": done,
+                "batches_total": max(total, done + left),
+                "batches_left": left,
+                "in_flight": len(window),
+                "elapsed_s": round(elapsed, 1),
+                "batches_per_min": round(rate * 60, 2),
+                "messages_per_s": round(rate * N, 1),
+                "eta_s": round(left / rate, 1) if rate > 0 else None,
+            })
+
+        log_event({"type": "summarizer.catchup_start", "chat_id": self.chat_id,
+                   "batches_total": total, "concurrency": SUMMARIZER_CATCHUP_CONCURRENCY})
+        try:
+            while True:
+                # Держим окно вдвое больше лимита, чтобы слоты LLM не простаивали,
+                # пока коммитится голова очереди; недостающие батчи — одним запросом.
+                free = SUMMARIZER_CATCHUP_CONCURRENCY * 2 - len(window)
+                if free > 0:
+                    for msgs in await get_next_batches(self.chat_id, cursor, N, free):
+                        cursor = msgs[-1].tg_msg_id
+                        window.append((msgs, asyncio.create_task(summarize(msgs))))
+                if not window:
+                    break
+
+                msgs, task = window.popleft()
+                text, ti, to = await task
+                await self._commit_batch(msgs, text, ti, to)
+                done += 1
+                if done % SUMMARIZER_CATCHUP_REPORT_EVERY == 0:
+                    report()
+        finally:
+            for _, task in window:
+                task.cancel()
+
+        # Хвост меньше N дальше ждёт обычным порядком; счётчик сверяем с БД один раз.
+        self.pending = await count_messages_after(self.chat_id, self.last_to)
+        report(final=True)
+
+    async def maybe_roll_up(self, full: bool = False) -> None:
+        """
+        Поднимается по уровням, пока на уровне ниже набирается K ещё не свёрнутых узлов.
+        Выше уровня, где ничего не добавилось, новых узлов быть не может — там и остановка
+        (full=True — пройти все уровни до ROLLUP_MAX_LEVEL, для догонки при старте).
+        """
+        for level in range(1, ROLLUP_MAX_LEVEL + 1):
+            made = False
+            while True:
+                rows = await fetch_nodes_after(self.chat_id, level - 1, self.rolled.get(level, 0), K)
+                if len(rows) < K:
+                    break
+                text, ti, to = await summarize_summaries([r[1] for r in rows])
+                if level == 1:
+                    await insert_context(self.chat_id, rows[-1][0] // K, rows, text, ti, to)
+                else:
+                    await insert_rollup(self.chat_id, level, rows, text, ti, to)
+                self.rolled[level] = rows[-1][0]
+                made = True
+            if not made and not full:
+                break
+
+
+_pipelines: Dict[int, ChatSummarizer] = {}
+_tasks: Dict[int, asyncio.Task] = {}
+_failures: Dict[int, int] = {}       # падений подряд без единой выжимки
+_restart_at: Dict[int, float] = {}   # упавший конвейер ждёт перезапуска до этого времени (monotonic)
+
+
+def _start_pipeline(chat_id: int) -> ChatSummarizer:
+    p = _pipelines.get(chat_id)
+    if p is None:
+        p = _pipelines[chat_id] = ChatSummarizer(chat_id)
+        _tasks[chat_id] = asyncio.create_task(p.run(), name=f"summarizer:{chat_id}")
+    return p
+
+def _on_flush(rows: List[Msg]) -> None:
+    by_chat: Dict[int, List[Msg]] = {}
+    for m in rows:
+        by_chat.setdefault(m.chat_id, []).append(m)
+    for chat_id, chat_rows in by_chat.items():
+        _start_pipeline(chat_id).on_flush(chat_rows)
 
 
 async def summarizer_loop():
+    """
+    По конвейеру на каждый чат: загруженный чат не задерживает выжимки тихих.
+    Чаты вне ALLOWED_CHAT_IDS (если сообщения всё же пришли) подхватываются при первом сбросе.
+    """
+    # Слушатель — до подсчёта бэклога: двойной учёт безопасен (get_next_batch поправит pending),
+    # а пропуск сброса задержал бы батч.
+    add_flush_listener(_on_flush)
+    for chat_id in ALLOWED_CHAT_IDS:
+        _start_pipeline(chat_id)
+
+    try:
+        while True:
+            await asyncio.sleep(5)
+            for chat_id, task in list(_tasks.items()):
+                if not task.done():
+                    continue
+                if chat_id not in _restart_at:
+                    if not task.cancelled() and task.exception() is not None:
+                        try:
+                            raise task.exception()
+                        except Exception:
+                            log_exception(ctx=f"summarizer chat_id={chat_id}")
+                    # Каждый перезапуск заново читает водяные знаки и считает бэклог — при падениях
+                    # подряд пауза растёт; сделал конвейер хоть одну выжимку — отсчёт сначала.
+                    failures = 1 if _pipelines[chat_id].committed else _failures.get(chat_id, 0) + 1
+                    _failures[chat_id] = failures
+                    delay = _retry_delay(failures)
+                    _restart_at[chat_id] = time.monotonic() + delay
+                    log_event({"type": "summarizer.restart_scheduled", "chat_id": chat_id,
+                               "failures": failures, "delay_s": delay})
+                if time.monotonic() < _restart_at[chat_id]:
+                    continue
+                # Упавший конвейер перезапускается с водяными знаками из БД, остальные не трогаем.
+                # До перезапуска он остаётся в _pipelines: on_flush копит ему pending.
+                del _restart_at[chat_id]
+                _pipelines.pop(chat_id, None)
+                _tasks.pop(chat_id, None)
+                _start_pipeline(chat_id)
+    finally:
+        for task in _tasks.values():
+            task.cancel()
+
+
+async def ingest_flush_loop():
+    """Сбрасывает буфер входящих сообщений по возрасту (по размеру сбрасывает сам on_msg)."""
     while True:
-        last_to = get_last_summarized_msg_id()
-        msgs = get_next_batch(last_to, N)
-        if len(msgs) < N:
-            await asyncio.sleep(2)
-            continue
-        batch_id = (msgs[-1].tg_msg_id // N)
-        text, ti, to = await summarize_messages(msgs)
-        insert_summary(batch_id, msgs, text, ti, to)
-        await maybe_make_context()
-
-
-async def maybe_make_context():
-    last_ctx_to = get_last_context_batch_id()
-    rows = get_ch().query(
-        "SELECT batch_id, text, from_ts, to_ts "
-        "FROM tg_summaries WHERE batch_id > %(b)s ORDER BY batch_id ASC LIMIT %(k)s",
-        parameters={'b': last_ctx_to, 'k': K}
-    ).result_rows
-    if len(rows) < K:
+        await asyncio.sleep(0.5)
+        if flush_due():
+            await flush_messages_async()
+
+
+async def log_writer_loop():
+    """Пишет очередь событий в logs пачками: по размеру LOG_BATCH_SIZE или раз в LOG_FLUSH_INTERVAL."""
+    while True:
+        await asyncio.sleep(0.2)
+        if logs_flush_due():
+            await run_db(flush_logs)
+
+
+async def online_migrations():
+    """
+    Долгие (online) миграции — в фоне, пока бот принимает сообщения. Сбой не роняет бота:
+    миграция не записывается как применённая и повторится при следующем старте.
+    """
+    try:
+        applied = await run_db(apply_migrations)
+    except Exception:
+        log_exception(ctx="online migrations")
         return
-    sums_texts = [r[1] for r in rows]
-    ctx_text, ti, to = await summarize_summaries(sums_texts)
-    context_id = rows[-1][0] // K
-    insert_context(context_id, rows, ctx_text, ti, to)
+    if applied:
+        log_event({"type": "db.online_migrations_done", "versions": applied})
+
+
+def _retry_delay(failures: int) -> float:
+    """Пауза перед повтором после failures сбоев подряд: экспоненциально, с потолком."""
+    return min(WORKER_RETRY_BASE_DELAY * 2 ** max(failures - 1, 0), WORKER_RETRY_MAX_DELAY)
+
+
+async def _backfill_chat(chat_id: int, after: int, upto: int, legacy: bool) -> None:
+    t0 = time.perf_counter()
+    log_event({"type": "search.backfill_start", "chat_id": chat_id,
+               "after_msg_id": after, "upto_msg_id": upto})
+    dedupe = legacy or after > 0
+    failures = 0
+    while after < upto:
+        try:
+            after = await backfill_search_index(chat_id, upto, after, dedupe, legacy)
+        except Exception:
+            # Отметка в БД не дальше after: повтор с неё, порция сверяется с индексом —
+            # она могла проиндексироваться до сбоя.
+            failures += 1
+            log_exception(ctx=f"search backfill chat_id={chat_id} after={after}")
+            dedupe = True
+            await asyncio.sleep(_retry_delay(failures))
+            continue
+        failures = 0
+        dedupe = legacy
+    log_event({"type": "search.backfill_done", "chat_id": chat_id,
+               "elapsed_s": round(time.perf_counter() - t0, 1)})
+
+async def backfill_search(bounds: Dict[int, Tuple[int, int, bool]]):
+    """
+    Доиндексирует историю, записанную до появления поискового индекса:
+    chat_id -> (after, upto, legacy) из search_backfill_bound. Порциями, чтобы не занимать
+    пул БД надолго; отметка сдвигается после каждой, перезапуск продолжает с неё.
+    С индексом сверяется первая порция после перезапуска или сбоя, у legacy-чата — каждая.
+    Сбои БД не выходят наружу: порция повторяется с паузой, процесс бота не падает.
+    """
+    for chat_id, (after, upto, legacy) in bounds.items():
+        if upto:
+            await _backfill_chat(chat_id, after, upto, legacy)
+
+
+async def search_repair_loop():
+    """Доиндексирует пачки, которые insert_messages записал, но не смог проиндексировать."""
+    failures = 0
+    while True:
+        await asyncio.sleep(_retry_delay(failures) if failures else SEARCH_REPAIR_INTERVAL)
+        try:
+            for chat_id, from_id, to_id in await pending_search_gaps():
+                await repair_search_gap(chat_id, from_id, to_id)
+                log_event({"type": "search.gap_repaired", "chat_id": chat_id,
+                           "from_msg_id": from_id, "to_msg_id": to_id})
+        except Exception:
+            failures += 1
+            log_exception(ctx="search repair")
+            continue
+        failures = 0
@@ -0,0 +1,25 @@
+"""Дымовой тест стенда (bench/smoke.py): заглушка LLM и подделка Telegram без ClickHouse."""
+import importlib.util
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEPS = ("httpx", "telegram", "clickhouse_connect", "pydantic", "tornado")
+MISSING = [name for name in DEPS if importlib.util.find_spec(name) is None]
+
+
+@unittest.skipIf(MISSING, f"не установлены зависимости бота: {', '.join(MISSING)}")
+class BenchSmokeTest(unittest.TestCase):
+    def test_llm_stub_and_fake_telegram(self):
+        # Отдельный процесс: src.configs читает окружение один раз при импорте.
+        proc = subprocess.run(
+            [sys.executable, "-m", "bench.smoke"],
+            cwd=ROOT, capture_output=True, text=True, timeout=180,
+        )
+        self.assertEqual(proc.returncode, 0, proc.stdout + proc.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()